@@ -1,20 +1,70 @@
+import click
 from flask import Flask
-from backend.config import DevelopmentConfig, ProductionConfig
-from backend.extensions import db, migrate, jwt
+from flask.cli import ScriptInfo
+from backend.config import get_config
+from backend.extensions import db, jwt, replica_router, password_hasher, limiter, compressor, coalescer, fault_injector, cache
+from backend.database import apply_engine_options, register_sqlite_pragmas
 from backend.blueprints.sneakers.routes import sneakers_bp
 from backend.blueprints.users.routes import users_bp
+from backend.blueprints.admin.routes import admin_bp
+from backend.blueprints.batch.routes import batch_bp
 from backend.errors import register_error_handlers
+from backend.snapshots import register_snapshot_hooks
+from backend.cache import register_cache_hooks
+from backend.changefeed import change_feed
+from backend.idempotency import idempotency_store
+from backend.similarity import similarity_index, register_similarity_hooks
+from backend.suggest import suggest_index
+from backend.analytics import inventory_analytics
+from backend.image_gc import image_gc
+from backend.batch import batch_dispatcher
+from backend.profiling import request_profiler
+from backend.logs import log_pipeline
+from backend.cli import register_commands
 from flask_cors import CORS
 
 
-def create_app():
+def _is_flask_cli() -> bool:
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.find_object(ScriptInfo) is not None
+
+
+def create_app(config=None):
+    # configにはクラスそのもの、もしくは'development'/'production'/'testing'の名前を渡せる。
+    # 省略した場合は環境変数APP_ENV(またはFLASK_ENV)から選ばれる
+    if config is None or isinstance(config, str):
+        config = get_config(config)
 
     app = Flask(__name__)
-    app.config.from_object(DevelopmentConfig)
+    app.config.from_object(config)
+    # 他の拡張機能の初期化中に出るログもキュー経由にするため最初に設定する
+    log_pipeline.init_app(app)
 
+    # after_requestは登録と逆順に実行されるので、レスポンス圧縮は最後に実行されるよう最初に登録する
+    compressor.init_app(app)
+    apply_engine_options(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    register_sqlite_pragmas(app)
+    replica_router.init_app(app)
+    # Flask-Migrate(Alembic)は重く、マイグレーション用のCLI(flask db ...)でしか使わないので、
+    # flaskコマンド経由で起動された場合だけ読み込む。サーバーレス環境でのコールドスタートには含めない
+    if _is_flask_cli():
+        from flask_migrate import Migrate
+        Migrate(app, db)
     jwt.init_app(app)
+    password_hasher.init_app(app)
+    limiter.init_app(app)
+    coalescer.init_app(app)
+    fault_injector.init_app(app)
+    cache.init_app(app)
+    change_feed.init_app(app)
+    idempotency_store.init_app(app)
+    similarity_index.init_app(app)
+    suggest_index.init_app(app)
+    inventory_analytics.init_app(app)
+    image_gc.init_app(app)
+    batch_dispatcher.init_app(app)
+    request_profiler.init_app(app)
 
     # CORSにより、クロスオリジンでの通信ができるようになるとともに、origins=origins, supports_credentials=True
     # の設定により、cookieもやりとりできるようなる。フロント側ではaxiosのリクエストに{withCredentials: true}を含める　
@@ -24,6 +74,13 @@ def create_app():
     register_error_handlers(app)
     app.register_blueprint(sneakers_bp)
     app.register_blueprint(users_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(batch_bp)
+
+    register_snapshot_hooks(app)
+    register_similarity_hooks(app)
+    register_cache_hooks(app)
+    register_commands(app)
 
 
-    return app
\ No newline at end of file
+    return app
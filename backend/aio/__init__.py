@@ -0,0 +1,53 @@
+"""
+ASGI (asyncio) variant of the sneaker and user API.
+
+Flask版(backend/__init__.py)と同じ設定・モデル・pydanticスキーマ・エラーハンドラー(backend/errors.py)を使い、
+DBアクセスはasync SQLAlchemy(ローカルではaiosqlite)で行う。1プロセスで多数の同時接続を捌けるため、
+閲覧系のトラフィックに向いている。起動例:
+
+    uvicorn asgi:app --workers 2
+"""
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Mount
+from starlette.staticfiles import StaticFiles
+
+from backend import create_app
+from backend.aio.database import AsyncDatabase
+from backend.aio import admin, sneakers, users
+
+
+def create_asgi_app(config=None):
+    # 設定の読み込み、JWTの発行/検証、validate_imageのロギングなどはFlaskアプリのコンテキストを借りて行う
+    flask_app = create_app(config)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        app.state.flask_app = flask_app
+        app.state.config = flask_app.config
+        app.state.db = AsyncDatabase(flask_app.config)
+        # Pillowの検証や画像ファイルの読み書きの退避先(パスワードハッシュはpassword_hasherのプロセスプールで行う)
+        app.state.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_EXECUTOR_WORKERS'], thread_name_prefix='aio-worker'
+        )
+        try:
+            yield
+        finally:
+            app.state.executor.shutdown(wait=True)
+            await app.state.db.dispose()
+
+    routes = [
+        *sneakers.routes,
+        *users.routes,
+        *admin.routes,
+        Mount('/static', app=StaticFiles(directory=flask_app.static_folder), name='static'),
+    ]
+    middleware = [
+        Middleware(CORSMiddleware, allow_origins=["http://localhost:5173"], allow_credentials=True,
+                   allow_methods=['*'], allow_headers=['*']),
+    ]
+    return Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
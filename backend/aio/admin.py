@@ -0,0 +1,53 @@
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from backend.aio.auth import authenticate
+from backend.aio.http import endpoint, json_response
+from backend.analytics import inventory_analytics
+from backend import export
+from backend.schemas.sneaker import static_base_url
+
+
+FORBIDDEN = {"message": "Forbidden: You are not authorized to perform this action", "error_code": "FORBIDDEN"}
+
+
+@endpoint(read_only=True)
+async def get_inventory_analytics(request):
+    _, user = await authenticate(request)
+    if not user.is_admin:
+        return json_response(FORBIDDEN, 403)
+    stats = (await request.state.read_session.execute(inventory_analytics.summary_query())).scalars()
+    return json_response(inventory_analytics.summary(stats), 200)
+
+
+@endpoint()
+async def export_sneakers(request):
+    _, user = await authenticate(request)
+    if not user.is_admin:
+        return json_response(FORBIDDEN, 403)
+    config = request.app.state.config
+    fmt = export.parse_format(request.query_params.get('format'))
+    stmt = export.export_stmt(request.query_params.get('q', ''), config['EXPORT_YIELD_PER'])
+    database = request.app.state.db
+    base_url = str(request.base_url) + 'static/'
+
+    async def generate():
+        # endpoint()のセッションはレスポンスを返した時点で閉じられるので、書き出し用のセッションを開く
+        static_base_url.set(base_url)
+        session = database.session(use_replica=True)
+        try:
+            result = await session.stream(stmt)
+            async for chunk in export.astream(result.scalars(), fmt, config['EXPORT_CHUNK_BYTES']):
+                yield chunk
+        finally:
+            await session.close()
+
+    return StreamingResponse(generate(), media_type=export.FORMATS[fmt],
+                             headers={'Content-Disposition': f'attachment; filename="sneakers.{fmt}"'})
+
+
+routes = [
+    Route('/api/admin/analytics/inventory', get_inventory_analytics, methods=['GET'],
+          name='admin.get_inventory_analytics'),
+    Route('/api/admin/export/sneakers', export_sneakers, methods=['GET'], name='admin.export_sneakers'),
+]
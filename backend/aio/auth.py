@@ -0,0 +1,92 @@
+from uuid import UUID
+
+from flask_jwt_extended import decode_token, create_access_token, create_refresh_token
+from flask_jwt_extended import set_refresh_cookies, unset_jwt_cookies
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import ExpiredSignatureError, InvalidTokenError
+from sqlalchemy import select
+
+from backend.aio.http import AuthError, logger
+from backend.models.user import User, TokenBlocklist
+
+
+def _find_token(request, refresh: bool) -> str | None:
+    # flask-jwt-extendedと同じく、JWT_TOKEN_LOCATIONの順番で最初に見つかったトークンを使う
+    for location in jwt_config.token_location:
+        if location == 'headers':
+            header = request.headers.get(jwt_config.header_name, '')
+            header_type = jwt_config.header_type
+            if header_type and header.startswith(f'{header_type} '):
+                return header[len(header_type) + 1:]
+            if not header_type and header:
+                return header
+        elif location == 'cookies':
+            name = jwt_config.refresh_cookie_name if refresh else jwt_config.access_cookie_name
+            if token := request.cookies.get(name):
+                return token
+    return None
+
+
+async def authenticate(request, refresh: bool = False):
+    """
+    Async counterpart of @jwt_required() + user_lookup_loader + token_in_blocklist_loader.
+
+    Returns (jwt_payload, user) or raises AuthError. Auth lookups always use the
+    primary session so a freshly revoked token is never accepted from a lagging replica.
+    """
+    flask_app = request.app.state.flask_app
+    session = request.state.session
+
+    with flask_app.app_context():
+        encoded_token = _find_token(request, refresh)
+        if encoded_token is None:
+            logger.debug('トークンが存在しないようです')
+            raise AuthError('missing')
+        try:
+            payload = decode_token(encoded_token)
+        except ExpiredSignatureError:
+            raise AuthError('expired')
+        except (InvalidTokenError, JWTExtendedException) as e:
+            logger.debug(f"正しくないトークンです: {e}")
+            raise AuthError('invalid')
+
+    if payload.get('type') != ('refresh' if refresh else 'access'):
+        raise AuthError('invalid')
+
+    stmt = select(TokenBlocklist.id).where(TokenBlocklist.jti == payload['jti'])
+    if (await session.execute(stmt)).first() is not None:
+        raise AuthError('revoked')
+
+    user = await session.get(User, UUID(payload['sub']))
+    if user is None:
+        raise AuthError('revoked')
+    if user.token_predates_valid_from(payload):
+        raise AuthError('revoked')
+
+    return payload, user
+
+
+def create_tokens(request, identity: str) -> tuple[str, str]:
+    with request.app.state.flask_app.app_context():
+        return create_access_token(identity=identity), create_refresh_token(identity=identity)
+
+
+def _copy_cookies(request, response, apply):
+    # クッキーの属性(path, samesite, secureなど)はflask-jwt-extendedの実装をそのまま使い、
+    # 生成されたSet-CookieヘッダーだけをStarletteのレスポンスにコピーする
+    flask_app = request.app.state.flask_app
+    with flask_app.app_context():
+        flask_response = flask_app.response_class()
+        apply(flask_response)
+    for cookie in flask_response.headers.getlist('Set-Cookie'):
+        response.headers.append('set-cookie', cookie)
+    return response
+
+
+def set_refresh_cookie(request, response, refresh_token: str):
+    return _copy_cookies(request, response, lambda r: set_refresh_cookies(r, refresh_token))
+
+
+def unset_cookies(request, response):
+    return _copy_cookies(request, response, unset_jwt_cookies)
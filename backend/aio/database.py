@@ -0,0 +1,72 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from backend.database import listen_sqlite_pragmas
+
+
+# 同期ドライバ名 -> asyncioドライバ名
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def to_async_url(database_url: str):
+    """Converts a sync SQLAlchemy URL (e.g. 'sqlite:///app.db') into its asyncio driver variant."""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if url.drivername != backend:
+        # 'sqlite+aiosqlite'のように既にドライバが指定されている場合はそのまま使う
+        return url
+    try:
+        return url.set(drivername=ASYNC_DRIVERS[backend])
+    except KeyError:
+        raise ValueError(f"No asyncio driver is known for '{backend}'. Set ASYNC_DATABASE_URL explicitly.")
+
+
+def create_engine_from_config(config, database_url: str):
+    url = to_async_url(database_url)
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        options['poolclass'] = StaticPool
+
+    engine = create_async_engine(url, **options)
+    pragmas = config.get('SQLITE_PRAGMAS') or {}
+    if url.get_backend_name() == 'sqlite' and pragmas:
+        listen_sqlite_pragmas(engine.sync_engine, pragmas)
+    return engine
+
+
+class AsyncDatabase:
+    """
+    Holds the async engines of the ASGI app.
+
+    Flask版のRoutingSessionと同じく、レプリカ(SQLALCHEMY_BINDS['replica'])が設定されていれば
+    読み取り専用のエンドポイントはレプリカ用のセッションを使う。
+    expire_on_commit=Falseにしているのは、コミット後の属性アクセスで暗黙のI/O(再SELECT)が
+    発生するとasyncioでは例外になるため。
+    """
+
+    def __init__(self, config):
+        self.primary = create_engine_from_config(
+            config, config.get('ASYNC_DATABASE_URL') or config['SQLALCHEMY_DATABASE_URI']
+        )
+        replica_url = (config.get('SQLALCHEMY_BINDS') or {}).get('replica')
+        self.replica = create_engine_from_config(config, replica_url) if replica_url else None
+
+        self._primary_sessions = async_sessionmaker(self.primary, expire_on_commit=False)
+        self._replica_sessions = (
+            async_sessionmaker(self.replica, expire_on_commit=False) if self.replica else None
+        )
+
+    def session(self, use_replica: bool = False):
+        if use_replica and self._replica_sessions is not None:
+            return self._replica_sessions()
+        return self._primary_sessions()
+
+    async def dispose(self):
+        await self.primary.dispose()
+        if self.replica is not None:
+            await self.replica.dispose()
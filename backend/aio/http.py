@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+import time
+from functools import wraps
+
+from flask.json.provider import DefaultJSONProvider
+from starlette.responses import Response
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+from backend.errors import build_error_response, JWT_ERROR_RESPONSES
+from backend.extensions import coalescer, fault_injector
+from backend.faults import db_latency_var, HEADER as FAULT_INJECTION_HEADER
+from backend.logs import request_id_var, new_request_id, REQUEST_ID_HEADER
+from backend.idempotency import (
+    idempotency_store, validate_key, fingerprint, IdempotencyKeyInProgress, HEADER as IDEMPOTENCY_HEADER,
+    PENDING, POLL_INTERVAL,
+)
+from backend.schemas.sneaker import static_base_url
+
+logger = logging.getLogger('backend.aio')
+
+
+class AuthError(Exception):
+    """Raised when a request cannot be authenticated. `kind` is a key of JWT_ERROR_RESPONSES."""
+
+    def __init__(self, kind: str):
+        super().__init__(kind)
+        self.kind = kind
+
+
+def json_response(body, status: int = 200, headers: dict | None = None) -> Response:
+    """Serializes like Flask's jsonify (sorted keys, HTTP dates, Decimal/UUID as strings)."""
+    content = json.dumps(body, default=DefaultJSONProvider.default, sort_keys=True, separators=(',', ':'))
+    return Response(content + '\n', status_code=status, headers=headers, media_type='application/json')
+
+
+def empty_response(status: int = 204) -> Response:
+    return Response(status_code=status)
+
+
+def client_ip(request) -> str:
+    """Counterpart of backend.ratelimit.client_ip."""
+    ip = request.client.host if request.client else 'unknown'
+    if request.app.state.config.get('RATE_LIMIT_TRUST_FORWARDED_FOR'):
+        ip = request.headers.get('x-forwarded-for', ip).split(',')[0].strip()
+    return ip
+
+
+async def run_sync(request, fn, *args, **kwargs):
+    """
+    Runs blocking work (Pillow, file I/O) in the app's executor.
+
+    validate_imageなどはcurrent_app.loggerやcurrent_app.configを参照するので、
+    ワーカースレッド側でFlaskのアプリケーションコンテキストをpushしてから呼び出す。
+    """
+    state = request.app.state
+
+    def call():
+        with state.flask_app.app_context():
+            return fn(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(state.executor, call)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise BadRequest("Failed to decode JSON object.")
+
+
+async def get_form(request):
+    """Returns (text fields, uploaded files) and enforces MAX_CONTENT_LENGTH like Werkzeug does."""
+    max_length = request.app.state.config.get('MAX_CONTENT_LENGTH')
+    content_length = request.headers.get('content-length')
+    if max_length and content_length and content_length.isdigit() and int(content_length) > max_length:
+        raise RequestEntityTooLarge()
+    form = await request.form()
+    fields = {key: value for key, value in form.items() if isinstance(value, str)}
+    files = {key: value for key, value in form.items() if not isinstance(value, str)}
+    return fields, files
+
+
+def int_arg(request, name: str, default: int) -> int:
+    """Same semantics as request.args.get(name, default, type=int) in Flask."""
+    try:
+        return int(request.query_params.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def endpoint(read_only: bool = False):
+    """
+    Wraps an async view: opens DB sessions, sets the static base URL for the schemas and
+    turns exceptions into the same JSON responses as the Flask app (backend/errors.py).
+
+    The view receives the request; `request.state.session` is always the primary session,
+    and `request.state.read_session` is the replica session for read-only views (unless the
+    client is inside its read-your-writes window).
+    """
+    def decorator(fn):
+        # Flaskアプリのエンドポイント名('sneakers.get_items'など)と揃え、障害の注入のルールを共有する
+        name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+        @wraps(fn)
+        async def wrapper(request):
+            state = request.app.state
+            config = state.config
+            pinned_until = request.cookies.get(config['READ_YOUR_WRITES_COOKIE'])
+            pinned = bool(pinned_until) and _as_float(pinned_until) > time.time()
+
+            token = static_base_url.set(str(request.base_url) + 'static/')
+            request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+            request_id_token = request_id_var.set(request_id)
+            session = state.db.session()
+            read_session = state.db.session(use_replica=True) if read_only and not pinned else session
+            request.state.session = session
+            request.state.read_session = read_session
+            db_latency_token = None
+            try:
+                fault = fault_injector.plan(config, name, request.method, request.headers.get(FAULT_INJECTION_HEADER))
+                if fault is not None:
+                    db_latency_token = db_latency_var.set(fault.db_latency)
+                    if fault.latency:
+                        await asyncio.sleep(fault.latency)
+                    if fault.error is not None:
+                        raise fault.error
+                response = await fn(request)
+                if session.info.get('wrote') and state.db.replica is not None:
+                    window = config['READ_YOUR_WRITES_SECONDS']
+                    response.set_cookie(
+                        config['READ_YOUR_WRITES_COOKIE'], str(time.time() + window),
+                        max_age=window, httponly=True, samesite='lax',
+                    )
+            except AuthError as error:
+                await session.rollback()
+                body, status = JWT_ERROR_RESPONSES[error.kind]
+                response = json_response(body, status)
+            except Exception as error:
+                await session.rollback()
+                body, status, *headers = build_error_response(error, logger)
+                response = json_response(body, status, *headers)
+            finally:
+                static_base_url.reset(token)
+                request_id_var.reset(request_id_token)
+                if db_latency_token is not None:
+                    db_latency_var.reset(db_latency_token)
+                await session.close()
+                if read_session is not session:
+                    await read_session.close()
+            response.headers[REQUEST_ID_HEADER] = request_id
+            return response
+        return wrapper
+    return decorator
+
+
+async def coalesced(request, render) -> Response:
+    """
+    Shares one render(request) among concurrent identical requests (see RequestCoalescer).
+
+    認証は各リクエストで行う必要があるので、ビューの中で認証を済ませてから呼び出す。
+    """
+    view = request.scope['endpoint']
+    key = coalescer.make_key(
+        f"{view.__module__.rsplit('.', 1)[-1]}.{view.__name__}",
+        [*request.query_params.multi_items(), *request.path_params.items()],
+        host=request.url.netloc,
+        replica=request.state.read_session is not request.state.session,
+    )
+
+    async def snapshot():
+        # ヘッダーのリストはミドルウェアで書き換えられるので、共有するのは中身だけにする
+        response = await render(request)
+        return response.body, response.status_code, list(response.raw_headers)
+
+    (body, status, raw_headers), is_follower = await coalescer.run_async(key, snapshot)
+    response = Response(body, status_code=status)
+    response.raw_headers = list(raw_headers)
+    if is_follower:
+        response.headers['X-Coalesced'] = 'true'
+    return response
+
+
+async def idempotent(request, scope: str, render) -> Response:
+    """
+    Async counterpart of @idempotent: runs render() once per Idempotency-Key and replays the
+    stored response to retries. `scope` is 'user:<id>' or 'anonymous:<ip>', as in the Flask app.
+
+    テーブルの読み書きはエグゼキュータで行い、処理中の同じキーの完了はイベントループ上で待つ。
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return await render()
+    key = validate_key(key)
+    request_fingerprint = await _request_fingerprint(request)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + idempotency_store.wait_timeout
+    while (stored := await run_sync(request, idempotency_store.try_begin, scope, key, request_fingerprint)) is PENDING:
+        if loop.time() >= deadline:
+            raise IdempotencyKeyInProgress()
+        await asyncio.sleep(POLL_INTERVAL)
+    if stored is not None:
+        logger.info(f"Replaying the stored response for Idempotency-Key {key}")
+        return Response(stored.body, status_code=stored.status, headers={**stored.headers, 'Idempotent-Replayed': 'true'})
+
+    try:
+        response = await render()
+    except Exception:
+        await run_sync(request, idempotency_store.release, scope, key)
+        raise
+    await run_sync(request, idempotency_store.complete, scope, key,
+                   response.status_code, response.headers.items(), response.body)
+    return response
+
+
+async def _request_fingerprint(request) -> str:
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith(('multipart/form-data', 'application/x-www-form-urlencoded')):
+        fields, files = await get_form(request)
+        contents = []
+        for name, upload in files.items():
+            contents.append((name, upload.filename, await upload.read()))
+            # ビューで保存できるよう読み出し位置を戻す
+            await upload.seek(0)
+        return fingerprint(request.method, request.url.path, fields=fields.items(), files=contents)
+    return fingerprint(request.method, request.url.path, body=await request.body())
+
+
+async def commit(session):
+    await session.commit()
+    session.info['wrote'] = True
+
+
+def _as_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
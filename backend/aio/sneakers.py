@@ -0,0 +1,290 @@
+import asyncio
+import math
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, func, or_, delete
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import NotFound
+
+from backend.aio.auth import authenticate
+from backend.aio.http import endpoint, coalesced, idempotent, commit, get_form, int_arg, json_response, empty_response, run_sync
+from backend.database import flush_returning_stored
+from backend.changefeed import change_feed, record_change, parse_last_event_id, format_event, RETRY_MILLISECONDS
+from backend.extensions import cache
+from backend.models.sneaker import Sneaker
+from backend.signals import column_values
+from backend.similarity import similarity_index, apply_changes, affects_similarity
+from backend.suggest import suggest_index
+from backend.analytics import inventory_analytics
+from backend import sync
+from backend.schemas.sneaker import CreateSneaker, ReadSneaker, PublicSneaker, UpdateSneaker
+from backend.utils_image import save_image, remove_old_image
+
+
+FORBIDDEN = {"message": "Forbidden: You are not authorized to perform this action", "error_code": "FORBIDDEN"}
+
+
+async def _get_or_404(session, sneaker_id: int) -> Sneaker:
+    sneaker = await session.get(Sneaker, sneaker_id)
+    if sneaker is None:
+        raise NotFound()
+    return sneaker
+
+
+def _to_file_storage(upload) -> FileStorage:
+    # validate_image / save_image はWerkzeugのFileStorageを前提にしているので、StarletteのUploadFileを包む
+    return FileStorage(stream=upload.file, filename=upload.filename, content_type=upload.content_type)
+
+
+async def _render_items(request):
+    session = request.state.read_session
+
+    q = request.query_params.get('q', '')
+    page = int_arg(request, 'page', 1)
+    per_page = int_arg(request, 'per_page', 6)
+    # Flask-SQLAlchemyのpaginate(error_out=False, max_per_page=...)と同じ補正
+    page = page if page >= 1 else 1
+    per_page = min(per_page if per_page >= 1 else 20, request.app.state.config['ITEMS_MAX_PER_PAGE'])
+
+    stmt = select(Sneaker)
+    if q:
+        stmt = stmt.where(or_(
+            Sneaker.name.ilike(f"%{q}%"),
+            Sneaker.description.ilike(f"%{q}%"),
+            Sneaker.category.ilike(f"%{q}%")
+        ))
+    total = (await session.execute(select(func.count()).select_from(stmt.order_by(None).subquery()))).scalar_one()
+    stmt = stmt.order_by(Sneaker.id.desc()).limit(per_page).offset((page - 1) * per_page)
+    sneakers = (await session.execute(stmt)).scalars().all()
+
+    data = [ ReadSneaker.model_validate(sneaker).model_dump() for sneaker in sneakers ]
+    response = {
+        "items": data,
+        "meta": {
+            "page": page,
+            "per_page": per_page,
+            "total_pages": math.ceil(total / per_page) if total else 0,
+            "total_items": total
+        }
+    }
+    return json_response(response, 200)
+
+
+@endpoint(read_only=True)
+async def get_items(request):
+    return await coalesced(request, _render_items)
+
+
+async def _render_item(request):
+    sneaker = await _get_or_404(request.state.read_session, request.path_params['sneaker_id'])
+    data = ReadSneaker.model_validate(sneaker).model_dump()
+    return json_response(data, 200)
+
+
+@endpoint(read_only=True)
+async def get_item(request):
+    await authenticate(request)
+    return await coalesced(request, _render_item)
+
+
+async def _render_similar_items(request):
+    session = request.state.read_session
+    sneaker_id = request.path_params['sneaker_id']
+    limit = min(max(int_arg(request, 'limit', 6), 1), request.app.state.config['SIMILARITY_TOP_K'])
+
+    # memory-mapしたインデックスから1行読むだけなのでイベントループ上で行う
+    neighbors = similarity_index.neighbors(sneaker_id, limit)
+    if neighbors is None:
+        await _get_or_404(session, sneaker_id)
+        neighbors = []
+
+    scores = dict(neighbors)
+    sneakers = (await session.execute(select(Sneaker).where(Sneaker.id.in_(scores)))).scalars() if scores else []
+    by_id = {sneaker.id: sneaker for sneaker in sneakers}
+    data = [
+        {**ReadSneaker.model_validate(by_id[i]).model_dump(), "score": score}
+        for i, score in neighbors if i in by_id
+    ]
+    return json_response({"sneaker_id": sneaker_id, "items": data}, 200)
+
+
+@endpoint(read_only=True)
+async def get_similar_items(request):
+    return await coalesced(request, _render_similar_items)
+
+
+async def _render_changes(request):
+    # 遅延のあるレプリカではなくプライマリから読む(Flaskアプリのget_changesを参照)
+    session = request.state.session
+    config = request.app.state.config
+    limit = min(max(int_arg(request, 'limit', config['SYNC_PAGE_SIZE']), 1), config['SYNC_MAX_PAGE_SIZE'])
+    now = datetime.now(timezone.utc)
+    upper = now - timedelta(seconds=config['SYNC_SETTLE_SECONDS'])
+    cursor = sync.parse_since(request.query_params.get('since'), now, upper, config['SYNC_TOMBSTONE_RETENTION_DAYS'])
+
+    sneakers = (await session.execute(sync.changes_stmt(cursor, upper, limit))).scalars().all()
+    tombstones = (await session.execute(sync.tombstones_stmt(cursor, upper, limit))).all()
+    return json_response(sync.build_page(cursor, upper, sneakers, tombstones, limit), 200)
+
+
+@endpoint()
+async def get_changes(request):
+    return await coalesced(request, _render_changes)
+
+
+@endpoint()
+async def create_item(request):
+    _, user = await authenticate(request)
+    if not user.is_admin:
+        return json_response(FORBIDDEN, 403)
+    return await idempotent(request, f"user:{user.id}", lambda: _create_item(request))
+
+
+async def _create_item(request):
+    session = request.state.session
+
+    input_data, files = await get_form(request)
+    dto = CreateSneaker.model_validate(input_data)
+
+    image_filename = None
+    image = files.get('image')
+    if image and image.filename:
+        # Pillowによる検証とディスクへの書き込みはイベントループを塞がないようにエグゼキュータで行う
+        image_filename = await run_sync(request, save_image, _to_file_storage(image))
+
+    sneaker = Sneaker(**dto.model_dump(), image_filename=image_filename)
+    session.add(sneaker)
+    # Flask版と同じく、DBに保存された値(priceの丸めなど)をRETURNINGで読み戻してから変更ログとレスポンスを作る
+    await session.run_sync(flush_returning_stored, sneaker)
+    record_change(session, 'created', sneaker)
+    for stmt in inventory_analytics.changes(None, column_values(sneaker)):
+        await session.execute(stmt)
+    await commit(session)
+    apply_changes(request.app.state.flask_app, sneaker_ids=[sneaker.id])
+    # シグナルは送らないので、Flaskアプリのワーカーと共有しているキャッシュもここで無効にする
+    await run_sync(request, cache.invalidate, 'sneakers')
+
+    data = PublicSneaker.model_validate(sneaker).model_dump()
+    location = str(request.url_for('sneakers.get_item', sneaker_id=sneaker.id))
+    return json_response(data, 201, {'Location': location})
+
+
+@endpoint()
+async def update_item(request):
+    _, user = await authenticate(request)
+    if not user.is_admin:
+        return json_response(FORBIDDEN, 403)
+    return await idempotent(request, f"user:{user.id}", lambda: _update_item(request))
+
+
+async def _update_item(request):
+    session = request.state.session
+
+    sneaker = await _get_or_404(session, request.path_params['sneaker_id'])
+    previous = column_values(sneaker)
+
+    input_data, files = await get_form(request)
+    dto = UpdateSneaker.model_validate(input_data)
+    for key, value in dto.model_dump(exclude_unset=True).items():
+        setattr(sneaker, key, value)
+
+    old_image_filename = None
+    if (image := files.get('image')) is not None:
+        if image.filename:
+            old_image_filename = sneaker.image_filename
+            sneaker.image_filename = await run_sync(request, save_image, _to_file_storage(image))
+    elif input_data.get('delete_image') == 'true':
+        old_image_filename = sneaker.image_filename or None
+        sneaker.image_filename = None
+
+    await session.run_sync(flush_returning_stored, sneaker)
+    record_change(session, 'updated', sneaker, previous)
+    for stmt in inventory_analytics.changes(previous, column_values(sneaker)):
+        await session.execute(stmt)
+    await commit(session)
+    await run_sync(request, cache.invalidate, 'sneakers')
+    if affects_similarity(sneaker, previous):
+        apply_changes(request.app.state.flask_app, sneaker_ids=[sneaker.id])
+
+    if old_image_filename:
+        await run_sync(request, remove_old_image, old_image_filename)
+
+    data = PublicSneaker.model_validate(sneaker).model_dump()
+    return json_response(data, 200)
+
+
+@endpoint()
+async def delete_item(request):
+    _, user = await authenticate(request)
+    if not user.is_admin:
+        return json_response(FORBIDDEN, 403)
+    session = request.state.session
+
+    stmt = delete(Sneaker).where(Sneaker.id == request.path_params['sneaker_id']).returning(*Sneaker.__table__.columns)
+    deleted = (await session.execute(stmt)).one_or_none()
+    if deleted is None:
+        raise NotFound()
+    record_change(session, 'deleted', deleted)
+    for stmt in inventory_analytics.changes(dict(deleted._mapping), None):
+        await session.execute(stmt)
+    for stmt in sync.tombstone_stmts(deleted.id, datetime.now(timezone.utc),
+                                     request.app.state.config['SYNC_TOMBSTONE_RETENTION_DAYS']):
+        await session.execute(stmt)
+    await commit(session)
+    await run_sync(request, cache.invalidate, 'sneakers')
+    apply_changes(request.app.state.flask_app, deleted_ids=[deleted.id])
+    if deleted.image_filename:
+        await run_sync(request, remove_old_image, deleted.image_filename)
+
+    return empty_response(204)
+
+
+async def suggest_items(request):
+    prefix = request.query_params.get('prefix', '')
+    # 変更フィードの読み足しや初回の読み込みでDBに触れることがあるのでエグゼキュータで行う
+    result = await run_sync(request, suggest_index.suggest, prefix, int_arg(request, 'limit', 8))
+    return json_response(result, 200)
+
+
+async def stream_events(request):
+    """SSE change feed. Same protocol as ChangeFeed.stream() in the Flask app, without blocking the loop."""
+    last_event_id = parse_last_event_id(request.headers.get('last-event-id'), request.query_params.get('last_event_id'))
+    if last_event_id is None:
+        last_event_id = await run_sync(request, change_feed.head_id)
+
+    async def generate():
+        cursor = last_event_id
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        loop = asyncio.get_running_loop()
+        started = last_sent = loop.time()
+        while loop.time() - started < change_feed.max_stream_seconds:
+            # バッファの読み足しはDBアクセスを伴うことがあるのでエグゼキュータで行う
+            events = await run_sync(request, change_feed.events_after, cursor)
+            for change in events:
+                yield format_event(change)
+                cursor = change['id']
+            if events:
+                last_sent = loop.time()
+                continue
+            if loop.time() - last_sent >= change_feed.heartbeat_seconds:
+                yield ": keep-alive\n\n"
+                last_sent = loop.time()
+            await asyncio.sleep(change_feed.poll_interval)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+routes = [
+    Route('/api/sneakers/', get_items, methods=['GET'], name='sneakers.get_items'),
+    Route('/api/sneakers/', create_item, methods=['POST'], name='sneakers.create_item'),
+    Route('/api/sneakers/suggest', suggest_items, methods=['GET'], name='sneakers.suggest_items'),
+    Route('/api/sneakers/events', stream_events, methods=['GET'], name='sneakers.stream_events'),
+    Route('/api/sneakers/changes', get_changes, methods=['GET'], name='sneakers.get_changes'),
+    Route('/api/sneakers/{sneaker_id:int}', get_item, methods=['GET'], name='sneakers.get_item'),
+    Route('/api/sneakers/{sneaker_id:int}', update_item, methods=['PATCH'], name='sneakers.update_item'),
+    Route('/api/sneakers/{sneaker_id:int}', delete_item, methods=['DELETE'], name='sneakers.delete_item'),
+    Route('/api/sneakers/{sneaker_id:int}/similar', get_similar_items, methods=['GET'], name='sneakers.get_similar_items'),
+]
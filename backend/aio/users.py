@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime, timezone
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from starlette.routing import Route
+from werkzeug.exceptions import NotFound
+
+from backend.aio.auth import authenticate, create_tokens, set_refresh_cookie, unset_cookies
+from backend.aio.http import endpoint, idempotent, commit, get_json, json_response, empty_response, logger, run_sync, client_ip
+from backend.database import flush_returning_stored
+from backend.extensions import password_hasher, limiter, cache
+from backend.models.user import User, TokenBlocklist
+from backend.schemas.user import CreateUser, ReadUser, ChangeUsernameUser, ChangePasswordUser, LoginUser
+
+
+FORBIDDEN = {"message": "Forbidden: You are not authorized to perform this action", "error_code": "FORBIDDEN"}
+
+
+# パスワードハッシュはpassword_hasherのプロセスプールで計算し、その完了をイベントループ上で待つ
+async def _hash_password(raw_password: str) -> str:
+    return await asyncio.wrap_future(password_hasher.submit_hash(raw_password))
+
+
+async def _check_password(user: User, raw_password: str) -> bool:
+    return await asyncio.wrap_future(password_hasher.submit_verify(user.password, raw_password))
+
+
+async def _rate_limit(request, scope: str, **identifiers):
+    # limiterのストレージ(SQLite/Redis)へのI/Oはブロックする(SQLiteではbusy_timeoutまで待つこともある)ので、
+    # パスワードハッシュと同じくイベントループの外で行う。run_syncがFlaskのアプリケーションコンテキストをpushする
+    await run_sync(request, limiter.hit, scope, ip=client_ip(request), **identifiers)
+
+
+async def _authenticate_same_user(request, session):
+    """Async counterpart of @jwt_required() + @require_same_user. Returns the user or a 403 response."""
+    payload, _ = await authenticate(request)
+    user_id_from_url = str(UUID(request.path_params['user_id']))
+    if user_id_from_url != payload['sub']:
+        return None, json_response(FORBIDDEN, 403)
+    user = await session.get(User, UUID(user_id_from_url))
+    if user is None:
+        raise NotFound()
+    return user, None
+
+
+@endpoint(read_only=True)
+async def get_user(request):
+    payload, _ = await authenticate(request)
+    user_id_from_url = str(UUID(request.path_params['user_id']))
+    if user_id_from_url != payload['sub']:
+        return json_response(FORBIDDEN, 403)
+    user = await request.state.read_session.get(User, UUID(user_id_from_url))
+    if user is None:
+        raise NotFound()
+    data = ReadUser.model_validate(user).model_dump()
+    return json_response(data, 200)
+
+
+@endpoint()
+async def create_user(request):
+    return await idempotent(request, f"anonymous:{client_ip(request)}", lambda: _create_user(request))
+
+
+async def _create_user(request):
+    session = request.state.session
+    dto = CreateUser.model_validate(await get_json(request))
+    await _rate_limit(request, 'register')
+
+    password_hash = await _hash_password(dto.raw_password)
+    user = User(username=dto.username, email=dto.email, password=password_hash)
+    user.is_admin = True
+    session.add(user)
+    # Flask版と同じく、重複はSELECTで事前に確認せずユニーク制約違反で検出する
+    try:
+        await session.run_sync(flush_returning_stored, user)
+        await commit(session)
+    except IntegrityError:
+        await session.rollback()
+        return json_response({"message": "Username or email already exists", "error_code":"RESOURCE_ALREADY_EXISTS"}, 409)
+    output = ReadUser.model_validate(user).model_dump()
+
+    location = str(request.url_for('users.get_user', user_id=str(user.id)))
+    return json_response(output, 201, {'Location': location})
+
+
+@endpoint()
+async def change_username(request):
+    session = request.state.session
+    user, forbidden = await _authenticate_same_user(request, session)
+    if forbidden:
+        return forbidden
+    return await idempotent(request, f"user:{user.id}", lambda: _change_username(request, user))
+
+
+async def _change_username(request, user):
+    session = request.state.session
+    dto = ChangeUsernameUser.model_validate(await get_json(request))
+
+    user.username = dto.username
+    try:
+        await session.run_sync(flush_returning_stored, user)
+        await commit(session)
+    except IntegrityError:
+        await session.rollback()
+        return json_response({"message": "Username already exists", "error_code":"USERNAME_ALREADY_EXISTS"}, 409)
+    # Flaskアプリのワーカーと共有しているキャッシュを無効にする(バックエンドへのI/Oはエグゼキュータで行う)
+    await run_sync(request, cache.invalidate, 'users')
+    output = ReadUser.model_validate(user).model_dump()
+    return json_response({'user_data': output}, 200)
+
+
+@endpoint()
+async def change_password(request):
+    session = request.state.session
+    user, forbidden = await _authenticate_same_user(request, session)
+    if forbidden:
+        return forbidden
+    dto = ChangePasswordUser.model_validate(await get_json(request))
+
+    if not await _check_password(user, dto.old_raw_password):
+        return json_response({"message": "Old password is not correct", "error_code":"INVALID_CREDENTIALS"}, 400)
+    user.password = await _hash_password(dto.new_raw_password)
+    user.tokens_valid_from = datetime.now(timezone.utc)
+    await commit(session)
+
+    return unset_cookies(request, empty_response(204))
+
+
+@endpoint()
+async def delete_user(request):
+    session = request.state.session
+    user, forbidden = await _authenticate_same_user(request, session)
+    if forbidden:
+        return forbidden
+    await session.delete(user)
+    await commit(session)
+    await run_sync(request, cache.invalidate, 'users')
+    return unset_cookies(request, empty_response(204))
+
+
+@endpoint()
+async def login_user(request):
+    session = request.state.session
+    dto = LoginUser.model_validate(await get_json(request))
+    await _rate_limit(request, 'login', email=dto.email)
+    user = (await session.execute(select(User).where(User.email == dto.email))).scalar_one_or_none()
+    if not user or not await _check_password(user, dto.raw_password):
+        return json_response({"message": "Invalid email or password", "error_code": "INVALID_CREDENTIALS"}, 401)
+
+    if user.password_needs_rehash():
+        user.password = await _hash_password(dto.raw_password)
+        await commit(session)
+
+    user_data = ReadUser.model_validate(user).model_dump()
+    access_token, refresh_token = create_tokens(request, str(user.id))
+    response = json_response({"user_data": user_data, "access_token": access_token}, 200)
+    return set_refresh_cookie(request, response, refresh_token)
+
+
+@endpoint()
+async def logout(request):
+    session = request.state.session
+    payload, _ = await authenticate(request, refresh=True)
+    session.add(TokenBlocklist(jti=payload['jti']))
+    await commit(session)
+    return unset_cookies(request, json_response({"message": "Successfully logged out."}, 200))
+
+
+@endpoint()
+async def refresh(request):
+    session = request.state.session
+    payload, user = await authenticate(request, refresh=True)
+    await _rate_limit(request, 'refresh', user=payload['sub'])
+    logger.info('古いトークンをブロックリストに入れます')
+    session.add(TokenBlocklist(jti=payload['jti']))
+    await commit(session)
+
+    user_data = ReadUser.model_validate(user).model_dump()
+    access_token, refresh_token = create_tokens(request, str(user.id))
+    response = json_response({"access_token": access_token, "user_data": user_data}, 200)
+    return set_refresh_cookie(request, response, refresh_token)
+
+
+routes = [
+    Route('/api/users/', create_user, methods=['POST'], name='users.create_user'),
+    Route('/api/users/login', login_user, methods=['POST'], name='users.login_user'),
+    Route('/api/users/logout', logout, methods=['POST'], name='users.logout'),
+    Route('/api/users/refresh', refresh, methods=['POST'], name='users.refresh'),
+    Route('/api/users/{user_id:str}', get_user, methods=['GET'], name='users.get_user'),
+    Route('/api/users/{user_id:str}', delete_user, methods=['DELETE'], name='users.delete_user'),
+    Route('/api/users/{user_id:str}/username', change_username, methods=['PATCH'], name='users.change_username'),
+    Route('/api/users/{user_id:str}/password', change_password, methods=['PATCH'], name='users.change_password'),
+]
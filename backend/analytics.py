@@ -0,0 +1,200 @@
+"""
+Inventory analytics for the admin dashboard, served from incrementally maintained aggregates.
+
+集計は inventory_stats テーブル(backend/models/inventory_stat.py)に (カテゴリ, 価格帯) ごとに保持する。
+スニーカーの作成/更新/削除では、変更前の行の寄与を引いて変更後の行の寄与を足す UPSERT を
+書き込みと同じトランザクションで実行するので(changes())、ダッシュボードの読み込みはカタログの大きさに
+関係なく (カテゴリ数 x 価格帯の数) 行を読むだけで済む。
+
+集計がずれた場合(SQLで直接書き換えた、INVENTORY_LOW_STOCK_THRESHOLDを変えた、など)は
+`flask analytics rebuild` でsneakersテーブルから作り直す。
+"""
+from decimal import Decimal
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import make_url
+
+from backend.enums import CategoryEnum
+from backend.models.inventory_stat import InventoryStat
+from backend.models.sneaker import Sneaker
+
+
+# 価格帯の上限(ドル)。最後の価格帯は上限なし
+PRICE_BANDS = (50, 100, 150, 200, 300)
+# 価格が未設定のスニーカーの価格帯
+NO_PRICE = -1
+MEASURES = ('sneaker_count', 'units', 'stock_value', 'price_sum',
+            'featured_count', 'low_stock_count', 'out_of_stock_count')
+CENTS = Decimal('0.01')
+# ON CONFLICT ... DO UPDATE を使えるdialectのinsert()
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def price_band(price) -> int:
+    if price is None:
+        return NO_PRICE
+    for band, upper in enumerate(PRICE_BANDS):
+        if price < upper:
+            return band
+    return len(PRICE_BANDS)
+
+
+def all_keys() -> list[tuple]:
+    """Every (category, price band) row the table is expected to contain."""
+    return [(category, band) for category in CategoryEnum for band in range(NO_PRICE, len(PRICE_BANDS) + 1)]
+
+
+class InventoryAnalytics:
+    """Computes the per-row deltas of catalog writes and formats the dashboard summary."""
+
+    def __init__(self, app=None):
+        self.low_stock_threshold = 5
+        self.dialect = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INVENTORY_LOW_STOCK_THRESHOLD', 5)
+        self.low_stock_threshold = app.config['INVENTORY_LOW_STOCK_THRESHOLD']
+        self.dialect = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        app.extensions['inventory_analytics'] = self
+
+    # --- public API ---
+
+    def changes(self, previous: dict | None, current: dict | None) -> list:
+        """
+        Upserts that move the aggregates from `previous` to `current` (column_values() dicts, None
+        for a created/deleted sneaker). Execute them in the write's transaction.
+        Returns an empty list when no aggregate changes (e.g. only the description was edited).
+        """
+        deltas = {}
+        for sign, values in ((-1, previous), (1, current)):
+            if values is None:
+                continue
+            key, measures = self.contribution(values)
+            delta = deltas.setdefault(key, dict.fromkeys(MEASURES, 0))
+            for name, value in measures.items():
+                delta[name] += sign * value
+
+        statements = []
+        for (category, band), delta in deltas.items():
+            delta = {name: value for name, value in delta.items() if value}
+            if delta:
+                statements.append(self._upsert(category, band, delta))
+        return statements
+
+    def contribution(self, values) -> tuple[tuple, dict]:
+        """The (category, price band) row a sneaker is counted in, and what it adds to each measure."""
+        price, stock = values['price'], values['stock'] or 0
+        measures = {
+            'sneaker_count': 1,
+            'units': stock,
+            'stock_value': (price * stock).quantize(CENTS) if price is not None else Decimal(0),
+            'price_sum': price if price is not None else Decimal(0),
+            'featured_count': int(bool(values['featured'])),
+            'low_stock_count': int(0 < stock <= self.low_stock_threshold),
+            'out_of_stock_count': int(stock == 0),
+        }
+        return (values['category'], price_band(price)), measures
+
+    def rebuild(self, session) -> list[tuple]:
+        """
+        Recomputes every row from the sneakers table and replaces the table's contents.
+        Returns the (category, price band) keys whose stored values had drifted.
+        """
+        totals = {key: dict.fromkeys(MEASURES, 0) for key in all_keys()}
+        stmt = select(Sneaker.category, Sneaker.price, Sneaker.stock, Sneaker.featured)
+        for row in session.execute(stmt):
+            key, measures = self.contribution(row._mapping)
+            for name, value in measures.items():
+                totals[key][name] += value
+
+        stored = {
+            (stat.category, stat.price_band): {name: getattr(stat, name) for name in MEASURES}
+            for stat in session.execute(select(InventoryStat)).scalars()
+        }
+        # 行はUPSERTで必要になったときに作られるので、無い行は全て0として比べる
+        zeros = dict.fromkeys(MEASURES, 0)
+        drifted = sorted((key for key in totals.keys() | stored.keys()
+                          if stored.get(key, zeros) != totals.get(key, zeros)),
+                         key=lambda key: (key[0].value, key[1]))
+
+        session.execute(delete(InventoryStat))
+        session.execute(insert(InventoryStat), [
+            {'category': category, 'price_band': band, **measures} for (category, band), measures in totals.items()
+        ])
+        return drifted
+
+    def summary_query(self):
+        return select(InventoryStat).order_by(InventoryStat.category, InventoryStat.price_band)
+
+    def summary(self, stats) -> dict:
+        """Dashboard payload from the rows of summary_query(): per-category totals and price distribution."""
+        categories = {}
+        totals = self._empty_totals()
+        for stat in stats:
+            entry = categories.get(stat.category)
+            if entry is None:
+                entry = categories[stat.category] = self._empty_totals()
+                entry['price_distribution'] = [
+                    {'min': lower, 'max': upper, 'count': 0}
+                    for lower, upper in zip((0, *PRICE_BANDS), (*PRICE_BANDS, None))
+                ]
+                entry['unpriced_count'] = 0
+            for target in (entry, totals):
+                for name in MEASURES:
+                    target[name] += getattr(stat, name)
+                target['priced_count'] += stat.sneaker_count if stat.price_band != NO_PRICE else 0
+            if stat.price_band == NO_PRICE:
+                entry['unpriced_count'] += stat.sneaker_count
+            else:
+                entry['price_distribution'][stat.price_band]['count'] += stat.sneaker_count
+
+        return {
+            'low_stock_threshold': self.low_stock_threshold,
+            'categories': [
+                {'category': category.value, **self._format(entry)}
+                for category, entry in sorted(categories.items(), key=lambda item: item[0].value)
+            ],
+            'totals': self._format(totals),
+        }
+
+    # --- internals ---
+
+    def _upsert(self, category, band, delta: dict):
+        # create_allで作った直後やCategoryEnumに値を追加した後は行が無いので、UPDATEだけだと差分が失われる。
+        # 行が無ければ差分をそのまま値として挿入し、あれば(同時に書き込まれても失われないよう)列に差分を足す
+        row = {'category': category, 'price_band': band, **delta}
+        if self.dialect in UPSERT_INSERTS:
+            stmt = UPSERT_INSERTS[self.dialect](InventoryStat).values(row)
+            return stmt.on_conflict_do_update(
+                index_elements=[InventoryStat.category, InventoryStat.price_band],
+                set_={name: getattr(InventoryStat, name) + stmt.excluded[name] for name in delta},
+            )
+        if self.dialect == 'mysql':
+            stmt = mysql.insert(InventoryStat).values(row)
+            return stmt.on_duplicate_key_update(
+                {name: getattr(InventoryStat, name) + stmt.inserted[name] for name in delta}
+            )
+        # UPSERTの無いdatabaseでは既存の行の更新だけ行う(行が無ければ `flask analytics rebuild` で作る)
+        return (
+            update(InventoryStat)
+            .where(InventoryStat.category == category, InventoryStat.price_band == band)
+            .values({name: getattr(InventoryStat, name) + value for name, value in delta.items()})
+        )
+
+    @staticmethod
+    def _empty_totals() -> dict:
+        return {**dict.fromkeys(MEASURES, 0), 'priced_count': 0}
+
+    @staticmethod
+    def _format(entry: dict) -> dict:
+        priced_count = entry.pop('priced_count')
+        price_sum = Decimal(entry.pop('price_sum'))
+        entry['stock_value'] = str(Decimal(entry['stock_value']).quantize(CENTS))
+        entry['average_price'] = str((price_sum / priced_count).quantize(CENTS)) if priced_count else None
+        return entry
+
+
+inventory_analytics = InventoryAnalytics()
@@ -0,0 +1,63 @@
+"""
+Deferred work run on a background thread after the request has returned.
+
+書き込みの後に行う重い処理(スナップショットの書き換え、類似度インデックスの差分更新)をリクエストのスレッドから外す。
+処理はプロセスごとに1本のデーモンスレッドで順に実行する。同じ関数の呼び出しが待っている間に投入されたものは
+引数(IDなどの集合)を合わせて1回の呼び出しにまとめるので、書き込みが続いても処理が溜まり続けることはない。
+
+待っている処理はプロセスの終了時に失われる。どちらも `flask snapshots build` / `flask similarity build` で
+作り直せるものだけをここで扱う。
+"""
+import threading
+
+
+class DeferredWork:
+    """Runs functions on one daemon thread inside an app context, merging pending calls of the same function."""
+
+    def __init__(self, name: str = 'deferred-work'):
+        self.name = name
+        self._pending = {}
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, app, fn, **id_sets):
+        """Queues fn(**id_sets). Each argument is a collection; it is merged into a pending call's."""
+        with self._condition:
+            pending = self._pending.get(fn)
+            if pending is None:
+                self._pending[fn] = (app, {name: set(values) for name, values in id_sets.items()})
+            else:
+                for name, values in id_sets.items():
+                    pending[1].setdefault(name, set()).update(values)
+            # スレッドは最初の投入時に作る(gunicornの--preloadなどでforkされる前のプロセスでは作らない)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Blocks until every queued call has finished (for the CLI and tests). False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._running, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                # 古いものから順に処理する
+                fn = next(iter(self._pending))
+                app, kwargs = self._pending.pop(fn)
+                self._running = True
+            try:
+                with app.app_context():
+                    fn(**kwargs)
+            except Exception:
+                app.logger.exception(f"Deferred {fn.__qualname__} failed")
+            finally:
+                with self._condition:
+                    self._running = False
+                    self._condition.notify_all()
+
+
+deferred_work = DeferredWork()
@@ -0,0 +1,195 @@
+"""
+Batched sub-requests (POST /api/batch).
+
+ログイン直後のSPAは get_user・カタログの1ページ目・おすすめ…と複数のリクエストを送り、そのたびに
+TLS・JWTの検証・ブロックリストとユーザーの確認(token_in_blocklist_loader / user_lookup_loader)の
+コストを払っている。/api/batch はそれらを1回のHTTPリクエストにまとめ、アプリの中で順に処理する:
+
+    POST /api/batch
+    {"requests": [
+        {"id": "me", "method": "GET", "path": "/api/users/<id>"},
+        {"id": "page1", "method": "GET", "path": "/api/sneakers/?page=1"},
+        {"method": "PATCH", "path": "/api/users/<id>/username", "body": {"username": "new"},
+         "headers": {"Idempotency-Key": "..."}}
+    ]}
+
+    -> {"responses": [{"id": "me", "status": 200, "headers": {...}, "body": {...}}, ...]}
+
+- サブリクエストは通常のリクエストと同じ経路(before_request、デコレーター、エラーハンドラー)で処理され、
+  Authorization / Cookie はバッチのリクエストのものを引き継ぐ。サブリクエストのSet-Cookieはバッチのレスポンスに付ける。
+- サブリクエストはバッチのアプリコンテキストの中で処理されるので、DBセッションとgを共有する。
+  トークンの失効の確認(check_if_token_is_revoked)はgに記録されるので、バッチ全体で1回になる。
+- 書き込み(GET以外)はリクエストの順に1つずつ処理し、その後は失効の確認をやり直す(ログアウトなどに備えて)。
+  連続するGETはBATCH_MAX_CONCURRENCY個のスレッドで並行に処理する。スレッドごとにアプリコンテキストと
+  DBセッションが別になるが(Sessionはスレッド間で共有できない)、失効の確認の結果は引き継ぐ。
+- Idempotency-Keyはサブリクエストごとに指定でき、バッチ自体に付ければバッチ全体のレスポンスが再送時に返される。
+- ストリーミングのレスポンス(変更フィードなど)とバッチの入れ子には対応しない。ストリーミングのエンドポイントは
+  (ビューがDBセッションを返してしまうなど、共有しているものに触れないよう)ビューを呼ぶ前に400にする。
+- Accept-Encodingは引き継がない(サブレスポンスは圧縮せず、バッチのレスポンス全体を圧縮する)。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import current_app, g, request
+from werkzeug.exceptions import BadRequest, HTTPException
+from werkzeug.test import EnvironBuilder
+
+from backend.logs import REQUEST_ID_HEADER, request_id_var
+
+
+BATCH_PATH = '/api/batch'
+# バッチのリクエストから引き継ぐヘッダー。サブリクエストでは上書きできない
+INHERITED_HEADERS = ('Authorization', 'Cookie', 'X-Forwarded-For', 'User-Agent')
+FORBIDDEN_HEADERS = frozenset(h.lower() for h in (*INHERITED_HEADERS, 'Host', 'Content-Length', 'Content-Type',
+                                                   'Accept-Encoding'))
+# レスポンスをストリーミングするエンドポイント。バッチに含めることはできない
+STREAMING_ENDPOINTS = frozenset(('sneakers.stream_events', 'admin.export_sneakers', 'admin.download_profile'))
+STREAMING_ERROR = {"error_code": "BAD_REQUEST", "message": "Streaming responses cannot be batched."}
+# サブリクエストのレスポンスのうち、返さない(もしくはバッチのレスポンスに移す)ヘッダー
+DROPPED_RESPONSE_HEADERS = frozenset(('set-cookie', 'content-length', 'vary', REQUEST_ID_HEADER.lower()))
+
+
+class BatchDispatcher:
+    """Runs the sub-requests of /api/batch through the Flask app."""
+
+    def __init__(self, app=None):
+        self.max_requests = 20
+        self.max_concurrency = 4
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BATCH_MAX_REQUESTS', 20)
+        app.config.setdefault('BATCH_MAX_CONCURRENCY', 4)
+        self.max_requests = app.config['BATCH_MAX_REQUESTS']
+        self.max_concurrency = app.config['BATCH_MAX_CONCURRENCY']
+        app.extensions['batch_dispatcher'] = self
+
+    def dispatch(self, sub_requests: list) -> tuple[list[dict], list[str]]:
+        """
+        Runs the validated sub-requests (schemas.batch.SubRequest) in a request context of /api/batch.
+        Returns (responses in request order, Set-Cookie headers of the sub-responses).
+        """
+        if len(sub_requests) > self.max_requests:
+            raise BadRequest(f"A batch may contain at most {self.max_requests} requests.")
+        app = current_app._get_current_object()
+        base = self._base_environ()
+        results = [None] * len(sub_requests)
+
+        i = 0
+        while i < len(sub_requests):
+            # 連続するGETをまとめて並行に処理する
+            j = i
+            while j < len(sub_requests) and sub_requests[j].method == 'GET':
+                j += 1
+            if j - i > 1 and self.max_concurrency > 1:
+                revoked_tokens = dict(g.get('revoked_tokens', {}))
+                futures = [
+                    self._get_executor().submit(self._run_isolated, app, base, sub_requests[k], revoked_tokens)
+                    for k in range(i, j)
+                ]
+                for k, future in zip(range(i, j), futures):
+                    results[k] = future.result()
+                i = j
+                continue
+
+            sub_request = sub_requests[i]
+            results[i] = self._run(app, base, sub_request)
+            if sub_request.method != 'GET':
+                # ログアウトやパスワードの変更でトークンが失効していることがある
+                g.pop('revoked_tokens', None)
+            i += 1
+
+        cookies = [cookie for _, cookie_list in results for cookie in cookie_list]
+        return [entry for entry, _ in results], cookies
+
+    # --- internals ---
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                        thread_name_prefix='batch-worker')
+        return self._executor
+
+    @staticmethod
+    def _base_environ() -> dict:
+        headers = {name: request.headers[name] for name in INHERITED_HEADERS if name in request.headers}
+        headers[REQUEST_ID_HEADER] = g.get('request_id') or request_id_var.get() or ''
+        return {
+            'base_url': request.root_url,
+            'headers': headers,
+            'environ_base': {'REMOTE_ADDR': request.remote_addr},
+        }
+
+    def _run(self, app, base: dict, sub_request):
+        # サブリクエストのteardownでリクエストIDが消されるので、バッチのIDに戻す
+        request_id = request_id_var.get()
+        try:
+            return self._dispatch_one(app, base, sub_request)
+        finally:
+            request_id_var.set(request_id)
+
+    def _run_isolated(self, app, base: dict, sub_request, revoked_tokens: dict):
+        # 別のスレッドなので、アプリコンテキスト(DBセッション)を新しく作る
+        with app.app_context():
+            g.revoked_tokens = revoked_tokens
+            return self._dispatch_one(app, base, sub_request)
+
+    @staticmethod
+    def _dispatch_one(app, base: dict, sub_request):
+        parts = urlsplit(sub_request.path)
+        headers = {**{k: v for k, v in sub_request.headers.items() if k.lower() not in FORBIDDEN_HEADERS},
+                   **base['headers']}
+        builder = EnvironBuilder(
+            path=parts.path, query_string=parts.query, method=sub_request.method, headers=headers,
+            json=sub_request.body, base_url=base['base_url'], environ_base=base['environ_base'],
+        )
+        entry = {'id': sub_request.id, 'status': 500, 'headers': {}, 'body': None}
+        try:
+            environ = builder.get_environ()
+        finally:
+            builder.close()
+        # アプリコンテキストが既にあるので、request_contextはそれを使い回す(DBセッションとgを共有する)
+        with app.request_context(environ):
+            # URLのマッチングはコンテキストを作るときに済んでいるので、ビューを呼ぶ前に断れる
+            if request.endpoint in STREAMING_ENDPOINTS:
+                entry.update(status=400, body=STREAMING_ERROR)
+                return entry, []
+            try:
+                response = app.full_dispatch_request()
+            except Exception:
+                app.logger.exception(f"Batched request failed: {sub_request.method} {sub_request.path}")
+                entry['body'] = {"error_code": "INTERNAL_SERVER_ERROR",
+                                 "message": "An unexpected internal server error occurred."}
+                return entry, []
+            try:
+                if response.is_streamed:
+                    entry.update(status=400, body=STREAMING_ERROR)
+                    return entry, []
+                try:
+                    if response.is_json:
+                        body = response.get_json()
+                    else:
+                        body = response.get_data(as_text=True) if response.status_code != 204 else None
+                except (ValueError, HTTPException):
+                    # 1件のレスポンスが読めなくてもバッチ全体は失敗させない
+                    app.logger.exception(f"Batched response is not decodable: {sub_request.method} {sub_request.path}")
+                    entry['body'] = {"error_code": "INTERNAL_SERVER_ERROR",
+                                     "message": "The response could not be included in the batch."}
+                    return entry, []
+                entry['status'] = response.status_code
+                entry['headers'] = {k: v for k, v in response.headers.items()
+                                    if k.lower() not in DROPPED_RESPONSE_HEADERS
+                                    and not k.lower().startswith('access-control-')}
+                entry['body'] = body
+                return entry, response.headers.getlist('Set-Cookie')
+            finally:
+                response.close()
+
+
+batch_dispatcher = BatchDispatcher()
@@ -0,0 +1,63 @@
+import os
+
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request, send_file, stream_with_context
+from flask_jwt_extended import jwt_required
+
+from backend.extensions import db, replica_router
+from backend.analytics import inventory_analytics
+from backend import export
+from backend.profiling import request_profiler
+from backend.decorators import require_admin, read_only
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
+
+
+# 在庫ダッシュボード。集計済みのinventory_statsを読むだけなので、カタログの大きさに関係なく一定の行数で済む
+@admin_bp.get('/analytics/inventory')
+@jwt_required()
+@require_admin
+@read_only
+def get_inventory_analytics():
+    stats = db.session.execute(inventory_analytics.summary_query()).scalars()
+    return jsonify(inventory_analytics.summary(stats)), 200
+
+
+# カタログ全件のストリーミングでの書き出し(backend/export.py)。per_pageに上限の無い一覧の代わりに使う
+@admin_bp.get('/export/sneakers')
+@jwt_required()
+@require_admin
+def export_sneakers():
+    fmt = export.parse_format(request.args.get('format'))
+    stmt = export.export_stmt(request.args.get('q', '', type=str), current_app.config['EXPORT_YIELD_PER'])
+    chunk_bytes = current_app.config['EXPORT_CHUNK_BYTES']
+
+    def generate():
+        # ビューから戻った後で実行されるので(@read_onlyは使えない)、レプリカから読むかどうかはここで決める
+        g.use_replica = replica_router.should_use_replica()
+        try:
+            yield from export.stream(db.session.execute(stmt).scalars(), fmt, chunk_bytes)
+        finally:
+            g.use_replica = False
+
+    return Response(stream_with_context(generate()), mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="sneakers.{fmt}"'})
+
+
+# リクエストのプロファイル(backend/profiling.py)の一覧。新しい順
+@admin_bp.get('/profiles')
+@jwt_required()
+@require_admin
+def list_profiles():
+    return jsonify({"profiles": request_profiler.list_profiles()}), 200
+
+
+# kindは 'folded'(flamegraph.plなど) か 'speedscope'(https://www.speedscope.app)
+@admin_bp.get('/profiles/<profile_id>/<kind>')
+@jwt_required()
+@require_admin
+def download_profile(profile_id, kind):
+    path = request_profiler.file_path(profile_id, kind)
+    if path is None:
+        abort(404)
+    mimetype = 'application/json' if kind == 'speedscope' else 'text/plain'
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=os.path.basename(path))
@@ -0,0 +1,23 @@
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required
+
+from backend.batch import batch_dispatcher
+from backend.decorators import idempotent
+from backend.schemas.batch import BatchRequest
+
+batch_bp = Blueprint('batch', __name__, url_prefix='/api/batch')
+
+
+# 複数のAPIリクエストを1回にまとめる(backend/batch.py)。トークンはここで1回だけ検証し、
+# 各サブリクエストでの失効の確認はその結果を使う。トークンが無ければ公開のエンドポイントだけが成功する
+@batch_bp.post('')
+@jwt_required(optional=True)
+@idempotent
+def run_batch():
+    dto = BatchRequest.model_validate(request.get_json())
+    responses, cookies = batch_dispatcher.dispatch(dto.requests)
+
+    response = jsonify({"responses": responses})
+    for cookie in cookies:
+        response.headers.add('Set-Cookie', cookie)
+    return response, 200
@@ -1,24 +1,31 @@
-import os
-import time
-from uuid import uuid4
-from flask import Blueprint, jsonify, request, url_for, current_app
-from sqlalchemy import select, or_
+from datetime import datetime, timedelta, timezone
+
+from flask import Blueprint, Response, abort, jsonify, request, url_for, current_app, stream_with_context
+from sqlalchemy import select, or_, delete
 from flask_jwt_extended import jwt_required
 
 from backend.extensions import db
-from backend.utils_image import validate_image, remove_old_image
+from backend.database import flush_returning_stored
+from backend.utils_image import save_image, remove_old_image
 from backend.models.sneaker import Sneaker
 from backend.schemas.sneaker import CreateSneaker, ReadSneaker, PublicSneaker, UpdateSneaker
-from backend.decorators import require_admin
+from backend.decorators import require_admin, read_only, coalesce, idempotent, cached
+from backend.signals import sneaker_created, sneaker_updated, sneaker_deleted, column_values
+from backend.changefeed import change_feed, record_change, parse_last_event_id
+from backend.similarity import similarity_index
+from backend.suggest import suggest_index
+from backend.analytics import inventory_analytics
+from backend import sync
 
 sneakers_bp =  Blueprint('sneakers', __name__, url_prefix='/api/sneakers')
 
 
 @sneakers_bp.get('/')
+@read_only
+@cached('sneakers')
+@coalesce
 def get_items():
 
-    time.sleep(1)
-
     q = request.args.get('q', '', type=str)
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 6, type=int)
@@ -32,7 +39,9 @@ def get_items():
         ))
     stmt = stmt.order_by(Sneaker.id.desc())
 
-    pagination = db.paginate(stmt, page=page, per_page=per_page, error_out=False)
+    # 1回のリクエストで読み込む行数を制限する。全件が必要な場合は/api/admin/export/sneakers(ストリーミング)を使う
+    pagination = db.paginate(stmt, page=page, per_page=per_page, max_per_page=current_app.config['ITEMS_MAX_PER_PAGE'],
+                             error_out=False)
     sneakers = pagination.items
     data = [ ReadSneaker.model_validate(sneaker).model_dump() for sneaker in sneakers ]
     response = {
@@ -47,24 +56,86 @@ def get_items():
     return jsonify(response), 200
 
 
+# 一覧のポーリングの代わりに使うServer-Sent Eventsの変更フィード(backend/changefeed.py)
+@sneakers_bp.get('/events')
+def stream_events():
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID'), request.args.get('last_event_id'))
+    # ストリーミング中はリクエストのDBセッションを使わないので、ここで接続を返しておく
+    db.session.remove()
+    return Response(
+        stream_with_context(change_feed.stream(last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+# オフラインのミラー向けの差分同期(backend/sync.py)。前回のトークン以降に作成・更新・削除されたものだけを返す。
+# トークンのカーソルより前の行を取りこぼさないよう、遅延のあるレプリカではなくプライマリから読む
+@sneakers_bp.get('/changes')
+@coalesce
+def get_changes():
+    config = current_app.config
+    limit = min(max(request.args.get('limit', config['SYNC_PAGE_SIZE'], type=int), 1), config['SYNC_MAX_PAGE_SIZE'])
+    now = datetime.now(timezone.utc)
+    upper = now - timedelta(seconds=config['SYNC_SETTLE_SECONDS'])
+    cursor = sync.parse_since(request.args.get('since'), now, upper, config['SYNC_TOMBSTONE_RETENTION_DAYS'])
+
+    sneakers = db.session.execute(sync.changes_stmt(cursor, upper, limit)).scalars().all()
+    tombstones = db.session.execute(sync.tombstones_stmt(cursor, upper, limit)).all()
+    return jsonify(sync.build_page(cursor, upper, sneakers, tombstones, limit)), 200
+
+
+# 検索ボックスの入力補完。メモリ上のプレフィックスインデックス(backend/suggest.py)から返し、DBには触れない
+@sneakers_bp.get('/suggest')
+@read_only
+def suggest_items():
+    prefix = request.args.get('prefix', '', type=str)
+    limit = request.args.get('limit', 8, type=int)
+    return jsonify(suggest_index.suggest(prefix, limit)), 200
+
+
 @sneakers_bp.get('/<int:sneaker_id>')
 @jwt_required()
+@read_only
+@cached('sneakers')
+@coalesce
 def get_item(sneaker_id):
 
-    time.sleep(1)
-
     sneaker = db.get_or_404(Sneaker, sneaker_id)
     data = ReadSneaker.model_validate(sneaker).model_dump()
     return jsonify(data), 200
 
 
+# 似ているスニーカー。事前計算したインデックス(backend/similarity.py)から近傍を1行引くだけで、カタログは走査しない
+@sneakers_bp.get('/<int:sneaker_id>/similar')
+@read_only
+@coalesce
+def get_similar_items(sneaker_id):
+    limit = min(max(request.args.get('limit', 6, type=int), 1), current_app.config['SIMILARITY_TOP_K'])
+
+    neighbors = similarity_index.neighbors(sneaker_id, limit)
+    if neighbors is None:
+        # インデックスに無い(まだ作られていない、もしくは作成後に追加された)場合は、存在するかだけ確認する
+        db.get_or_404(Sneaker, sneaker_id)
+        neighbors = []
+
+    scores = dict(neighbors)
+    sneakers = db.session.execute(select(Sneaker).where(Sneaker.id.in_(scores))).scalars() if scores else []
+    by_id = {sneaker.id: sneaker for sneaker in sneakers}
+    # インデックスの作成後に削除されたスニーカーは飛ばす
+    data = [
+        {**ReadSneaker.model_validate(by_id[i]).model_dump(), "score": score}
+        for i, score in neighbors if i in by_id
+    ]
+    return jsonify({"sneaker_id": sneaker_id, "items": data}), 200
+
+
 @sneakers_bp.post('/')
 @jwt_required()
 @require_admin
+@idempotent
 def create_item():
 
-    time.sleep(1)
-
     # request.formは、werkzeug.datastructures.ImmutableMultiDictという、辞書によく似た特別な型のオブジェクト
     input_data = request.form.to_dict()
     dto = CreateSneaker.model_validate(input_data)
@@ -73,18 +144,19 @@ def create_item():
     image = request.files.get('image')
     # 重要な点として、ユーザーがファイルを選択せずに送った時には、image自体は存在し、image.filenameが空文字となる。
     if image and image.filename:
-        safe_basename = validate_image(image)
-        name_part, extension = os.path.splitext(safe_basename)
-        filename = f"{name_part}_{uuid4()}{extension}"
-        save_dir = current_app.config['UPLOAD_FOLDER']
-        save_path = os.path.join(save_dir, filename)
-        image.save(save_path)
-        image_filename = filename
+        image_filename = save_image(image)
 
     sneaker = Sneaker(**dto.model_dump(), image_filename=image_filename)
 
     db.session.add(sneaker)
+    # 変更ログはスニーカーのidを含むので、先にflushしてidを確定させてから同じトランザクションで追記する。
+    # 変更ログ・集計・レスポンスにはDBに保存された値(priceの丸めなど)を使う
+    flush_returning_stored(db.session, sneaker)
+    record_change(db.session, 'created', sneaker)
+    for stmt in inventory_analytics.changes(None, column_values(sneaker)):
+        db.session.execute(stmt)
     db.session.commit()
+    sneaker_created.send(current_app._get_current_object(), sneaker=sneaker)
 
     data = PublicSneaker.model_validate(sneaker).model_dump()
     location = url_for('sneakers.get_item', sneaker_id=sneaker.id, _external=True)
@@ -96,11 +168,11 @@ def create_item():
 @sneakers_bp.patch('/<int:sneaker_id>')
 @jwt_required()
 @require_admin
+@idempotent
 def update_item(sneaker_id):
 
-    time.sleep(1)
-
     sneaker = db.get_or_404(Sneaker, sneaker_id)
+    previous = column_values(sneaker)
 
     input_data = request.form.to_dict()
     dto = UpdateSneaker.model_validate(input_data)
@@ -113,35 +185,33 @@ def update_item(sneaker_id):
 
     # ユーザーが新しいイメージを選択した場合
     if image := request.files.get('image'):
-        current_app.logger.error('imageキーがリクエストに存在します')
         # ファイルが選択されているか（filenameが空でないか）をチェック
         if image.filename:
-            current_app.logger.error('imageキーがリクエストに存在し、さらに実際にイメージが送られてきているようです。')
+            current_app.logger.debug('imageキーがリクエストに存在し、さらに実際にイメージが送られてきているようです。')
             # ★重要: DBを更新する前に、後で削除するために古いファイル名を保持しておく
             old_image_filename = sneaker.image_filename
 
             # 新しい画像を保存し、モデルの属性を更新
-            safe_basename = validate_image(image)
-            name_part, extension = os.path.splitext(safe_basename)
-            filename = f"{name_part}_{uuid4()}{extension}"
-            save_dir = current_app.config['UPLOAD_FOLDER']
-            save_path = os.path.join(save_dir, filename)
-            image.save(save_path)
-            sneaker.image_filename = filename
+            sneaker.image_filename = save_image(image)
         else:
-            current_app.logger.error('imageキーがリクエストに存在しますが、実際にイメージが送られてきていないようです。')
+            current_app.logger.debug('imageキーがリクエストに存在しますが、実際にイメージが送られてきていないようです。')
 
     elif request.form.get('delete_image') == 'true':
-        current_app.logger.error('imageキーがリクエストに存在しません、さらにdelete_imageフラッグがtrueになっています')
+        current_app.logger.debug('imageキーがリクエストに存在しません、さらにdelete_imageフラッグがtrueになっています')
         old_image_filename = sneaker.image_filename or None
         sneaker.image_filename = None
-        current_app.logger.error('ケース２')
 
     # ユーザーが新しいイメージを選択しておらず、なおかつdelete_imageフラッグが'trueではないの場合は何もしない
     else:
-        current_app.logger.error('imageキーがリクエストに存在しません、さらにdelete_imageフラッグがtrueではありません。なので何もしない')
+        current_app.logger.debug('imageキーがリクエストに存在しません、さらにdelete_imageフラッグがtrueではありません。なので何もしない')
 
+    # flushしてupdated_atを確定させ、DBに保存された値(priceの丸めなど)をRETURNINGで読み戻してから変更ログに記録する
+    flush_returning_stored(db.session, sneaker)
+    record_change(db.session, 'updated', sneaker, previous)
+    for stmt in inventory_analytics.changes(previous, column_values(sneaker)):
+        db.session.execute(stmt)
     db.session.commit()
+    sneaker_updated.send(current_app._get_current_object(), sneaker=sneaker, previous=previous)
 
     # ★コミットが成功した後に、保持しておいた古いファイル名の画像を削除する
     if old_image_filename:
@@ -157,14 +227,22 @@ def update_item(sneaker_id):
 @require_admin
 def delete_item(sneaker_id):
 
-    time.sleep(1)
-
-    sneaker = db.get_or_404(Sneaker, sneaker_id)
-    image_filename_to_delete = sneaker.image_filename
-    db.session.delete(sneaker)
+    # 行を読み込まずにDELETEし、シグナルと画像の削除に必要な削除前の値はRETURNINGで受け取る
+    stmt = delete(Sneaker).where(Sneaker.id == sneaker_id).returning(*Sneaker.__table__.columns)
+    deleted = db.session.execute(stmt).one_or_none()
+    if deleted is None:
+        abort(404)
+    previous = dict(deleted._mapping)
+    record_change(db.session, 'deleted', deleted)
+    for stmt in inventory_analytics.changes(previous, None):
+        db.session.execute(stmt)
+    for stmt in sync.tombstone_stmts(sneaker_id, datetime.now(timezone.utc),
+                                     current_app.config['SYNC_TOMBSTONE_RETENTION_DAYS']):
+        db.session.execute(stmt)
     db.session.commit()
-    if image_filename_to_delete:
-        remove_old_image(image_filename_to_delete)
+    sneaker_deleted.send(current_app._get_current_object(), sneaker_id=sneaker_id, previous=previous)
+    if previous['image_filename']:
+        remove_old_image(previous['image_filename'])
 
     return '', 204
 
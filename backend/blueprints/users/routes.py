@@ -3,14 +3,17 @@ from uuid import UUID
 from datetime import datetime, timezone
 import time
 
-from flask import Blueprint, jsonify, request, url_for, current_app, make_response
+from flask import Blueprint, jsonify, request, url_for, current_app, make_response, g
 from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity,get_jwt, set_refresh_cookies, unset_jwt_cookies
-from sqlalchemy import or_, select
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 
-from backend.extensions import db, jwt
-from backend.models.user import User, TokenBlocklist
+from backend.extensions import db, jwt, limiter, cache
+from backend.database import flush_returning_stored
+from backend.ratelimit import client_ip
+from backend.models.user import User, TokenBlocklist, ISSUED_AT_US_CLAIM
 from backend.schemas.user import CreateUser, ReadUser, ChangeUsernameUser, ChangePasswordUser, LoginUser
-from backend.decorators import require_same_user
+from backend.decorators import require_same_user, read_only, idempotent, cached
 
 
 users_bp =Blueprint('users', __name__, url_prefix='/api/users')
@@ -27,6 +30,8 @@ users_bp =Blueprint('users', __name__, url_prefix='/api/users')
 @users_bp.get('/<string:user_id>')
 @jwt_required()
 @require_same_user
+@read_only
+@cached('users')
 def get_user(user_id: str):
     user_id_uuid = UUID(user_id)
     user = db.get_or_404(User, user_id_uuid)
@@ -35,28 +40,25 @@ def get_user(user_id: str):
 
 
 @users_bp.post('/')
+@idempotent
 def create_user():
 
-    time.sleep(1)
-
     data = request.get_json()
     dto = CreateUser.model_validate(data)
-
-    stmt = db.select(User).where(
-        or_(User.username == dto.username, User.email == dto.email)
-    )
-    # .scalar_one_or_none() は、結果が1つもない場合はNone、1つだけの場合はそのオブジェクトを返す
-    # 複数見つかった場合はエラーになるため、unique制約のあるカラムのチェックに最適
-    existing_user = db.session.execute(stmt).scalar_one_or_none()
-
-    if existing_user:
-        return jsonify({"message": "Username or email already exists", "error_code":"RESOURCE_ALREADY_EXISTS"}), 409
+    limiter.hit('register', ip=client_ip())
 
     password_hash = User.create_password_hash(dto.raw_password)
     user = User(username=dto.username, email=dto.email, password=password_hash)
     user.is_admin = True
     db.session.add(user)
-    db.session.commit()
+    # username/emailにはユニーク制約があるので、事前にSELECTで重複を確認せず、INSERTの失敗で検出する
+    try:
+        # expire_on_commit=Falseなので、レスポンスはDBが値を変える列だけをRETURNINGで読み戻して作る(今のUserには無い)
+        flush_returning_stored(db.session, user)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Username or email already exists", "error_code":"RESOURCE_ALREADY_EXISTS"}), 409
     output = ReadUser.model_validate(user).model_dump()
 
     # ここでuser.idはUUID型になるので、str(user.id)としないといけないのでは？
@@ -68,25 +70,24 @@ def create_user():
 @users_bp.patch('/<string:user_id>/username')
 @jwt_required()
 @require_same_user
+@idempotent
 def change_username(user_id: str):
 
-    time.sleep(1)
-
     user_id_uuid = UUID(user_id)
     user = db.get_or_404(User, user_id_uuid)
     data = request.get_json()
     dto = ChangeUsernameUser.model_validate(data)
 
-    # 変更後のユーザー名が、自分以外のユーザーに使われていないかチェック
-    # Usernameが既に存在するかチェック
-    stmt = db.select(User).where(User.username == dto.username, User.id != user_id_uuid)
-    existing_user = db.session.execute(stmt).scalar_one_or_none()
-
-    if existing_user:
-        return jsonify({"message": "Username already exists", "error_code":"USERNAME_ALREADY_EXISTS"}), 409
-
+    # 変更後のユーザー名が自分以外のユーザーに使われている場合は、ユニーク制約違反としてUPDATEが失敗する
     user.username = dto.username
-    db.session.commit()
+    try:
+        flush_returning_stored(db.session, user)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"message": "Username already exists", "error_code":"USERNAME_ALREADY_EXISTS"}), 409
+    # 他のワーカーがキャッシュしているユーザー情報も含めて無効にする
+    cache.invalidate('users')
     output = ReadUser.model_validate(user).model_dump()
 
     return jsonify({'user_data': output}), 200
@@ -97,8 +98,6 @@ def change_username(user_id: str):
 @require_same_user
 def change_password(user_id: str):
 
-    time.sleep(1)
-
     user_id_uuid = UUID(user_id)
 
     data = request.get_json()
@@ -129,12 +128,11 @@ def change_password(user_id: str):
 @require_same_user
 def delete_user(user_id: str):
 
-    time.sleep(1)
-
     user_id_uuid = UUID(user_id)
     user = db.get_or_404(User, user_id_uuid)
     db.session.delete(user)
     db.session.commit()
+    cache.invalidate('users')
 
     # ボディなし 204 を返しつつ、JWT クッキーを削除
     response = make_response('', 204)
@@ -145,15 +143,21 @@ def delete_user(user_id: str):
 @users_bp.post('/login')
 def login_user():
 
-    time.sleep(1)
-
     data = request.get_json()
     dto = LoginUser.model_validate(data)
+    # パスワードのハッシュ計算(高コスト)より前に制限をかける
+    limiter.hit('login', ip=client_ip(), email=dto.email)
     stmt = select(User).where(User.email == dto.email)
     user = db.session.execute(stmt).scalar_one_or_none()
     if not user or not user.check_password(dto.raw_password):
         return jsonify({"message": "Invalid email or password", "error_code": "INVALID_CREDENTIALS"}), 401
 
+    # 保存されているハッシュの方式やコストが現在の設定と異なる場合は、平文パスワードが手元にある今のうちに再ハッシュする
+    if user.password_needs_rehash():
+        current_app.logger.info('パスワードハッシュの方式が古いため再ハッシュします')
+        user.password = User.create_password_hash(dto.raw_password)
+        db.session.commit()
+
     user_data = ReadUser.model_validate(user).model_dump()
     access_token = create_access_token(identity=str(user.id))
     refresh_token = create_refresh_token(identity=str(user.id))
@@ -174,8 +178,6 @@ def login_user():
 @jwt_required(refresh=True)
 def logout():
 
-    time.sleep(1)
-
     jti = get_jwt()["jti"]
     current_app.logger.info('古いトークンをブロックリストに入れます')
     db.session.add(TokenBlocklist(jti=jti))
@@ -189,6 +191,7 @@ def logout():
 @users_bp.post('/refresh')
 @jwt_required(refresh=True)
 def refresh():
+    limiter.hit('refresh', ip=client_ip(), user=get_jwt_identity())
     old_token_payload = get_jwt()
     old_jti = old_token_payload["jti"]
     current_app.logger.info('古いトークンをブロックリストに入れます')
@@ -223,18 +226,32 @@ def user_lookup_callback(_jwt_header, jwt_data):
     identity = jwt_data["sub"] # get_jwt_identity()よりこちらが推奨。なぜなら引数として既にjwt_dataをもらっているから。
     # 404を発生させず、見つからなければNoneを返す
     user = db.session.get(User, UUID(identity)) #同期的に動く
-    current_app.logger.info('ユーザーデータが付与されました。get_current_user()で取得できますが、Noneの可能性もあります。')
+    current_app.logger.debug('ユーザーデータが付与されました。get_current_user()で取得できますが、Noneの可能性もあります。')
     return user
 
 
+# iatは秒単位なので、同じ秒のうちに行われたパスワード変更の前後を区別できるよう、マイクロ秒単位の発行時刻も入れておく
+@jwt.additional_claims_loader
+def add_issued_at_us(identity):
+    return {ISSUED_AT_US_CLAIM: time.time_ns() // 1000}
+
+
 # @jwt_required() や @jwt_optional()、@jwt_refresh_token_required() など、JWT 検証を行うデコレーターが付いたすべての
 # エンドポイントのリクエスト時にトークンの妥当性（有効期限やブロックリスト登録の有無など）をチェックする過程で必ず呼び出されます。
 # 名前に「blocklist」とありますが、中身は「このトークンは OK／NG？」の判定機能です。ブロックリスト判定に限らず、
 # ここで任意の“無効化条件”を実装できると考えて差し支えありません。
 @jwt.token_in_blocklist_loader
 def check_if_token_is_revoked(jwt_header, jwt_payload):
+    # /api/batchのサブリクエストはバッチのアプリコンテキスト(g)で処理されるので、同じトークンの確認は1回で済ませる
+    revoked_tokens = g.setdefault('revoked_tokens', {})
+    if jwt_payload["jti"] not in revoked_tokens:
+        revoked_tokens[jwt_payload["jti"]] = _is_token_revoked(jwt_payload)
+    return revoked_tokens[jwt_payload["jti"]]
+
+
+def _is_token_revoked(jwt_payload) -> bool:
     jti = jwt_payload["jti"]
-    current_app.logger.info('Tokenがブロックリストに含まれていないかチェックしています。')
+    current_app.logger.debug('Tokenがブロックリストに含まれていないかチェックしています。')
     stmt = select(TokenBlocklist).where(TokenBlocklist.jti == jti)
     token_in_blocklist = db.session.execute(stmt).scalar_one_or_none()
     if token_in_blocklist is not None:
@@ -243,17 +260,15 @@ def check_if_token_is_revoked(jwt_header, jwt_payload):
     # ユーザーモデルに問い合わせて、tokens_valid_fromで照合
     user_id = jwt_payload["sub"]
     user = db.session.get(User, UUID(user_id))
-    current_app.logger.info('Tokenに記述されているユーザーが存在するかチェックしています。')
+    # セッションのidentity mapは弱参照なので、参照を保持しておかないとuser_lookup_callbackや
+    # ビューでのdb.session.get()のたびに同じユーザーのSELECTが発行されてしまう
+    g.token_user = user
+    current_app.logger.debug('Tokenに記述されているユーザーが存在するかチェックしています。')
     if not user:
         return True # ユーザーが存在しない場合、そのトークンは無効
-    current_app.logger.info('Tokenが妥当な発行日なのかチェックしています')
-    # トークンの発行日時(iat)を取得
-    token_issued_at = datetime.fromtimestamp(jwt_payload["iat"], tz=timezone.utc)
-
+    current_app.logger.debug('Tokenが妥当な発行日なのかチェックしています')
     # トークンの発行日時が、ユーザーに設定された有効日時より古い場合は無効
-    tokens_valid_from_aware = user.tokens_valid_from.replace(tzinfo=timezone.utc)
-    if token_issued_at < tokens_valid_from_aware:
-
+    if user.token_predates_valid_from(jwt_payload):
         return True # トークンは古いので無効
 
     return False # トークンは有効
@@ -0,0 +1,508 @@
+"""
+Cache shared by the worker processes, with pluggable backends.
+
+CACHE_URL でバックエンドを選ぶ(どれも同じAPI: get/set/delete, get_many/set_many/delete_many, incr):
+
+    'null'                       キャッシュしない(既定)
+    'memory'                     ワーカーごとのLRU + TTL。ワーカーが1つの開発サーバーやテスト向け
+    'sqlite:////tmp/cache.db'    同一ホストの全ワーカーで共有するSQLiteファイル
+    'redis://:password@host:6379/0'  Redisプロトコルのサーバー(依存ライブラリなしの最小限のクライアント)
+
+値はネームスペース(cache.namespace('sneakers'))ごとにバージョン付きのキーで保存する。
+invalidate()はバックエンド上のバージョン番号を1つ増やすだけなので、共有バックエンドを使っていれば
+すべてのワーカーの古いエントリーが次の読み込みから一斉に参照されなくなる(古いエントリーはTTLで消える)。
+キャッシュの障害はミスとして扱い、リクエストは失敗させない。
+"""
+import base64
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote, urlsplit
+
+from backend.signals import sneaker_created, sneaker_updated, sneaker_deleted
+
+
+logger = logging.getLogger(__name__)
+
+# バックエンドへのアクセスが失敗してから、次に試すまでの秒数
+RETRY_AFTER_FAILURE_SECONDS = 5
+
+
+class CacheError(Exception):
+    """An error reply from the cache server."""
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value: bytes, ttl: float | None = None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def get_many(self, keys):
+        return [None] * len(keys)
+
+    def set_many(self, mapping: dict, ttl: float | None = None):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+    def incr(self, key) -> int:
+        return 0
+
+
+class MemoryBackend:
+    """Per-process LRU dict with per-entry expiry (bounded by max_entries)."""
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def set(self, key, value: bytes, ttl: float | None = None):
+        with self._lock:
+            self._set(key, value, ttl, time.monotonic())
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def set_many(self, mapping: dict, ttl: float | None = None):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, ttl, now)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key) -> int:
+        with self._lock:
+            value = int(self._get(key, time.monotonic()) or 0) + 1
+            self._set(key, str(value).encode(), None, time.monotonic())
+            return value
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl, now):
+        self._entries[key] = (value, now + ttl if ttl else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class SQLiteBackend:
+    """
+    Entries in a local SQLite file shared by every worker process on the host.
+
+    期限切れの行は読み込み時に無視し、書き込みのたびに一定の確率でまとめて削除する。
+    """
+
+    PURGE_PROBABILITY = 0.01
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value: bytes, ttl: float | None = None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        placeholders = ','.join('?' * len(keys))
+        rows = self._connect().execute(
+            f"SELECT key, value FROM cache_entries WHERE key IN ({placeholders})"
+            " AND (expires_at IS NULL OR expires_at > ?)", (*keys, time.time())
+        ).fetchall()
+        found = {key: _as_bytes(value) for key, value in rows}
+        return [found.get(key) for key in keys]
+
+    def set_many(self, mapping: dict, ttl: float | None = None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                [(key, value, expires_at) for key, value in mapping.items()],
+            )
+            if random.random() < self.PURGE_PROBABILITY:
+                conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_many(self, keys):
+        if keys:
+            placeholders = ','.join('?' * len(keys))
+            self._connect().execute(f"DELETE FROM cache_entries WHERE key IN ({placeholders})", tuple(keys))
+
+    def incr(self, key) -> int:
+        # UPSERTの1文で増やすので、複数のプロセスから同時に呼ばれても増分が失われない
+        row = self._connect().execute(
+            "INSERT INTO cache_entries (key, value, expires_at) VALUES (?, 1, NULL)"
+            " ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, expires_at = NULL"
+            " RETURNING value", (key,)
+        ).fetchone()
+        return int(row[0])
+
+
+class RedisBackend:
+    """
+    Minimal client for the Redis protocol (RESP2) over a plain socket, one connection per thread.
+
+    使うコマンドは GET/SET/DEL/MGET/INCR だけなので、Redis互換のサーバー(Valkey、KeyDBなど)でも動く。
+    複数のキーの書き込みはパイプライン化して1往復で送る。
+    """
+
+    def __init__(self, url: str, timeout: float = 1.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, key):
+        return self._execute(('GET', key))[0]
+
+    def set(self, key, value: bytes, ttl: float | None = None):
+        self._execute(self._set_command(key, value, ttl))
+
+    def delete(self, key):
+        self._execute(('DEL', key))
+
+    def get_many(self, keys):
+        return self._execute(('MGET', *keys))[0] if keys else []
+
+    def set_many(self, mapping: dict, ttl: float | None = None):
+        if mapping:
+            self._execute(*(self._set_command(key, value, ttl) for key, value in mapping.items()))
+
+    def delete_many(self, keys):
+        if keys:
+            self._execute(('DEL', *keys))
+
+    def incr(self, key) -> int:
+        return self._execute(('INCR', key))[0]
+
+    @staticmethod
+    def _set_command(key, value, ttl):
+        return ('SET', key, value, 'PX', int(ttl * 1000)) if ttl else ('SET', key, value)
+
+    # --- protocol ---
+
+    def _execute(self, *commands) -> list:
+        """Sends the commands in one write and returns their replies. Reconnects once on a dropped connection."""
+        payload = b''.join(_encode(command) for command in commands)
+        for attempt in (1, 2):
+            conn = self._connect()
+            try:
+                conn.sendall(payload)
+                replies = [_read_reply(self._local.reader) for _ in commands]
+            except (ConnectionError, socket.timeout, OSError):
+                self._close()
+                if attempt == 2:
+                    raise
+                continue
+            for reply in replies:
+                if isinstance(reply, CacheError):
+                    raise reply
+            return replies
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.conn = conn
+            self._local.reader = conn.makefile('rb')
+            setup = []
+            if self.password:
+                setup.append(('AUTH', self.password))
+            if self.db:
+                setup.append(('SELECT', self.db))
+            if setup:
+                conn.sendall(b''.join(_encode(command) for command in setup))
+                for _ in setup:
+                    reply = _read_reply(self._local.reader)
+                    if isinstance(reply, CacheError):
+                        self._close()
+                        raise reply
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            try:
+                self._local.reader.close()
+                conn.close()
+            except OSError:
+                pass
+        self._local.conn = None
+
+
+def _as_bytes(value) -> bytes:
+    # incr()で保存したカウンターはINTEGERとして読み出される
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+def _encode(command) -> bytes:
+    parts = [f"*{len(command)}\r\n".encode()]
+    for arg in command:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Connection closed by the cache server')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        return CacheError(rest.decode(errors='replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError('Connection closed by the cache server')
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        return None if length < 0 else [_read_reply(reader) for _ in range(length)]
+    raise CacheError(f"Unexpected reply from the cache server: {line!r}")
+
+
+def create_backend(url: str, max_entries: int = 10_000):
+    """'null', 'memory', 'sqlite:///path/to/cache.db' or 'redis://host:port/db'"""
+    if not url or url == 'null':
+        return NullBackend()
+    if url == 'memory':
+        return MemoryBackend(max_entries)
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith('redis://'):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported CACHE_URL: {url}")
+
+
+def dumps_entry(entry) -> bytes:
+    """Serializes a cached response (body bytes, status, [(header, value)]) as JSON, the body base64-encoded."""
+    body, status, headers = entry
+    return json.dumps([base64.b64encode(body).decode('ascii'), status, headers], separators=(',', ':')).encode()
+
+
+def loads_entry(data: bytes):
+    """The entry written by dumps_entry(), or None (a miss) for anything else."""
+    # 共有バックエンドの値は他のプロセスも書き込めるので、pickleのように任意のオブジェクトは復元しない
+    try:
+        body, status, headers = json.loads(data)
+        return base64.b64decode(body, validate=True), int(status), [(str(k), str(v)) for k, v in headers]
+    except (ValueError, TypeError):
+        return None
+
+
+class Namespace:
+    """
+    A group of keys that can be invalidated together. Values are cached responses (see dumps_entry()).
+
+    キーは '<prefix>:<namespace>:v<version>:<key>'。バージョンはバックエンドの '<prefix>:<namespace>' に
+    保存されていて、CACHE_VERSION_CHECK_SECONDS秒ごとに読み直す(0なら毎回読むので、他のワーカーの
+    invalidate()がすぐに反映される)。
+    """
+
+    def __init__(self, cache: 'Cache', name: str):
+        self.cache = cache
+        self.name = name
+        self.version_key = f"{cache.key_prefix}:{name}"
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self, key, default=None):
+        value = self.get_many([key])[0]
+        return default if value is None else value
+
+    def set(self, key, value, ttl: float | None = None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def get_many(self, keys, version: int | None = None) -> list:
+        """Values for the keys, None for misses."""
+        version = self._current_version() if version is None else version
+        values = self.cache.call('get_many', [self._key(key, version) for key in keys])
+        return [loads_entry(value) if value is not None else None for value in values or [None] * len(keys)]
+
+    def set_many(self, mapping: dict, ttl: float | None = None, version: int | None = None):
+        version = self._current_version() if version is None else version
+        ttl = self.cache.default_ttl if ttl is None else ttl
+        self.cache.call('set_many', {
+            self._key(key, version): dumps_entry(value) for key, value in mapping.items()
+        }, ttl)
+
+    def delete_many(self, keys):
+        version = self._current_version()
+        self.cache.call('delete_many', [self._key(key, version) for key in keys])
+
+    def get_or_set(self, key, fn, ttl: float | None = None):
+        """Returns the cached value, or computes it with fn() and caches it (None is not cached)."""
+        # 読み込み時のバージョンで保存する。fn()の実行中にinvalidate()されても、古い値は新しいバージョンに入らない
+        version = self._current_version()
+        value = self.get_many([key], version)[0]
+        if value is None:
+            value = fn()
+            if value is not None:
+                self.set_many({key: value}, ttl, version)
+        return value
+
+    def invalidate(self):
+        """Drops every entry of the namespace, in every worker that shares the backend."""
+        version = self.cache.call('incr', self.version_key)
+        if version is not None:
+            self._version, self._checked_at = version, time.monotonic()
+
+    def _current_version(self) -> int:
+        now = time.monotonic()
+        if self._version is None or now - self._checked_at >= self.cache.version_check_seconds:
+            value = self.cache.call('get', self.version_key)
+            self._version, self._checked_at = int(value or 0), now
+        return self._version
+
+    def _key(self, key, version: int) -> str:
+        return f"{self.version_key}:v{version}:{key}"
+
+
+class Cache:
+    """The app's cache: a backend chosen by CACHE_URL plus named, versioned namespaces."""
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.key_prefix = 'cache'
+        self.default_ttl = 300
+        self.version_check_seconds = 0
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_URL', 'null')
+        app.config.setdefault('CACHE_KEY_PREFIX', 'cache')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10_000)
+        app.config.setdefault('CACHE_VERSION_CHECK_SECONDS', 0)
+        self.backend = create_backend(app.config['CACHE_URL'], app.config['CACHE_MAX_ENTRIES'])
+        self.key_prefix = app.config['CACHE_KEY_PREFIX']
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        self.version_check_seconds = app.config['CACHE_VERSION_CHECK_SECONDS']
+        self._namespaces = {}
+        app.extensions['cache'] = self
+
+    @property
+    def enabled(self) -> bool:
+        return not isinstance(self.backend, NullBackend)
+
+    def namespace(self, name: str) -> Namespace:
+        namespace = self._namespaces.get(name)
+        if namespace is None:
+            with self._lock:
+                namespace = self._namespaces.setdefault(name, Namespace(self, name))
+        return namespace
+
+    def invalidate(self, *names: str):
+        for name in names:
+            self.namespace(name).invalidate()
+
+    def call(self, method: str, *args, default=None):
+        """Calls a backend method; failures are logged and treated as a miss."""
+        # 障害中のサーバーにリクエストのたびに接続を試みて待たされないよう、失敗後しばらくは呼ばない
+        if self._down_until and time.monotonic() < self._down_until:
+            return default
+        try:
+            return getattr(self.backend, method)(*args)
+        except (OSError, sqlite3.Error, CacheError) as e:
+            logger.warning(f"Cache {method} failed: {e}")
+            self._down_until = time.monotonic() + RETRY_AFTER_FAILURE_SECONDS
+            return default
+
+
+def register_cache_hooks(app):
+    """Invalidates the 'sneakers' namespace whenever a sneaker write is committed."""
+    cache = app.extensions['cache']
+    if not cache.enabled:
+        return
+
+    def on_change(sender, **extra):
+        cache.invalidate('sneakers')
+
+    sneaker_created.connect(on_change, sender=app, weak=False)
+    sneaker_updated.connect(on_change, sender=app, weak=False)
+    sneaker_deleted.connect(on_change, sender=app, weak=False)
@@ -0,0 +1,240 @@
+"""
+Server-Sent Events change feed of the catalog.
+
+スニーカーの作成/更新/削除は、コミットと同じトランザクションで catalog_changes テーブルに
+追記される(record_change)。テーブルのidがそのままSSEのイベントidになるので、クライアントは
+再接続時にLast-Event-IDを送れば取りこぼした分から受信を再開できる。
+
+各ワーカープロセスは直近 CHANGE_FEED_BUFFER_SIZE 件のイベントをリングバッファに保持し、
+接続中の全クライアントで共有する。バッファはテーブルから id > 最後に読んだid の範囲を読み足すことで
+更新されるので、他のワーカーでコミットされた変更も配信される。読み足しはプロセス内で
+CHANGE_FEED_POLL_INTERVAL 秒に1回までに抑えられ、このプロセスでコミットされた場合はすぐに行われる。
+
+idはコミット時ではなくINSERT時に採番されるので、PostgreSQL/MySQLでは大きいidが先にコミットされることがある。
+クライアントはLast-Event-IDより小さいidを受け取らないので、idに欠番があればその先は配信せずに待ち、
+欠番の後の行がCHANGE_FEED_SETTLE_SECONDS秒より古くなったら(ロールバックなどで)欠番のままと判断して先へ進む。
+
+イベントの種類:
+    created  {"sneaker_id", "sneaker": ReadSneaker}
+    updated  {"sneaker_id", "sneaker": ReadSneaker, "changed": [変更されたフィールド]}
+    stock    {"sneaker_id", "stock"}   在庫だけが変わった場合
+    deleted  {"sneaker_id"}
+"""
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from backend.extensions import db
+from backend.models.catalog_change import CatalogChange
+from backend.schemas.sneaker import ReadSneaker
+from backend.signals import column_values
+
+
+_PENDING_KEY = 'catalog_changes'
+# 切断されたクライアントが再接続するまでの待ち時間(EventSourceのretry)
+RETRY_MILLISECONDS = 3000
+
+
+def record_change(session, event_name: str, sneaker, previous: dict | None = None) -> CatalogChange | None:
+    """
+    Adds a change-log row for the sneaker to the session (call before commit, after the
+    sneaker has an id). For updates, `previous` is column_values() taken before the changes;
+    nothing is recorded when no column changed. For deletions `sneaker` may also be the row
+    returned by DELETE ... RETURNING (only its id is used).
+    """
+    data = {"sneaker_id": sneaker.id}
+    if event_name == 'updated':
+        current = column_values(sneaker)
+        changed = sorted(key for key, value in current.items()
+                         if key != 'updated_at' and previous.get(key) != value)
+        if not changed:
+            return None
+        if changed == ['stock']:
+            event_name = 'stock'
+            data["stock"] = sneaker.stock
+        else:
+            data["changed"] = changed
+    if event_name in ('created', 'updated'):
+        data["sneaker"] = ReadSneaker.model_validate(sneaker).model_dump(mode='json')
+
+    change = CatalogChange(event=event_name, sneaker_id=sneaker.id, data=data)
+    session.add(change)
+    session.info.setdefault(_PENDING_KEY, []).append(change)
+    return change
+
+
+def parse_last_event_id(header: str | None, query: str | None) -> int | None:
+    """
+    Last-Event-ID header, or the last_event_id query parameter (EventSource cannot send
+    custom headers on its first connection). Returns None when absent or malformed.
+    """
+    value = header or query
+    try:
+        return max(0, int(value)) if value else None
+    except ValueError:
+        return None
+
+
+def format_event(change: dict) -> str:
+    return f"id: {change['id']}\nevent: {change['event']}\ndata: {json.dumps(change['data'], separators=(',', ':'))}\n\n"
+
+
+class ChangeFeed:
+    """Per-process ring buffer of the change log, shared by every connected SSE client."""
+
+    def __init__(self, app=None):
+        self.buffer_size = 1000
+        self.poll_interval = 2.0
+        self.heartbeat_seconds = 15
+        self.max_stream_seconds = 300
+        self.settle_seconds = 5
+        self._events = deque(maxlen=self.buffer_size)
+        self._last_id = None
+        self._last_refresh = 0.0
+        # このプロセスでのコミット回数と、最後に読み足した時点でのその値。異なればすぐに読み足す
+        self._commit_seq = 0
+        self._refreshed_seq = 0
+        self._refresh_lock = threading.Lock()
+        self._changed = threading.Condition()
+        # コミットされたことを知るためにSessionの全インスタンスを監視する(aio版のAsyncSessionの中身も含む)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CHANGE_FEED_BUFFER_SIZE', 1000)
+        app.config.setdefault('CHANGE_FEED_POLL_INTERVAL', 2)
+        app.config.setdefault('CHANGE_FEED_HEARTBEAT_SECONDS', 15)
+        app.config.setdefault('CHANGE_FEED_MAX_STREAM_SECONDS', 300)
+        app.config.setdefault('CHANGE_FEED_SETTLE_SECONDS', 5)
+        self.buffer_size = app.config['CHANGE_FEED_BUFFER_SIZE']
+        self.poll_interval = app.config['CHANGE_FEED_POLL_INTERVAL']
+        self.heartbeat_seconds = app.config['CHANGE_FEED_HEARTBEAT_SECONDS']
+        self.max_stream_seconds = app.config['CHANGE_FEED_MAX_STREAM_SECONDS']
+        self.settle_seconds = app.config['CHANGE_FEED_SETTLE_SECONDS']
+        self._events = deque(self._events, maxlen=self.buffer_size)
+        app.extensions['change_feed'] = self
+
+    # --- public API ---
+
+    def head_id(self) -> int:
+        """The id of the latest event (0 when the log is empty). New clients start from here."""
+        self.refresh()
+        return self._last_id or 0
+
+    def events_after(self, last_event_id: int, limit: int = 500) -> list[dict]:
+        """Events with id > last_event_id, from the ring buffer or, when they fell out of it, the table."""
+        self.refresh()
+        events = list(self._events)
+        if events and last_event_id >= events[0]['id'] - 1:
+            return [e for e in events if e['id'] > last_event_id][:limit]
+        if not events and last_event_id >= (self._last_id or 0):
+            return []
+        # バッファより古いidからの再開。追記専用のテーブルから直接読む(欠番を待っている範囲の先は返さない)
+        return self._fetch((CatalogChange.id > last_event_id) & (CatalogChange.id <= (self._last_id or 0)), limit)
+
+    def stream(self, last_event_id: int | None):
+        """
+        Yields SSE messages: events after last_event_id (or only new ones when None) and a
+        comment line every CHANGE_FEED_HEARTBEAT_SECONDS while idle.
+
+        接続はCHANGE_FEED_MAX_STREAM_SECONDS秒で閉じる(サーバーレス環境の実行時間の上限対策)。
+        EventSourceは自動で再接続し、Last-Event-IDから受信を再開する。
+        """
+        cursor = self.head_id() if last_event_id is None else last_event_id
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < self.max_stream_seconds:
+            events = self.events_after(cursor)
+            for change in events:
+                yield format_event(change)
+                cursor = change['id']
+            if events:
+                last_sent = time.monotonic()
+                continue
+            if time.monotonic() - last_sent >= self.heartbeat_seconds:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            self.wait(self.poll_interval)
+
+    def wait(self, timeout: float):
+        """Blocks until this process commits a change or the timeout expires."""
+        with self._changed:
+            if not self._is_dirty():
+                self._changed.wait(timeout)
+
+    def refresh(self, force: bool = False):
+        """Appends rows newer than the buffer's last id. Runs at most once per poll interval unless dirty."""
+        if not (force or self._needs_refresh()):
+            return
+        with self._refresh_lock:
+            # 待っている間に他のスレッドが読み足していれば何もしない
+            if not (force or self._needs_refresh()):
+                return
+            seq = self._commit_seq
+            if self._last_id is None:
+                # 起動直後はテーブルの末尾をバッファの大きさだけ読み込む
+                stmt = select(CatalogChange).order_by(CatalogChange.id.desc()).limit(self.buffer_size)
+                events = list(reversed(self._execute(stmt)))
+                # バッファに入る範囲より前は配信済みとして扱う
+                self._last_id = events[0]['id'] - 1 if events else 0
+            else:
+                events = self._fetch(CatalogChange.id > self._last_id, self.buffer_size)
+            for e in self._settled(events):
+                self._events.append(e)
+                self._last_id = e['id']
+            self._last_refresh = time.monotonic()
+            self._refreshed_seq = seq
+
+    # --- internals ---
+
+    def _is_dirty(self) -> bool:
+        return self._commit_seq != self._refreshed_seq
+
+    def _needs_refresh(self) -> bool:
+        return self._is_dirty() or time.monotonic() - self._last_refresh >= self.poll_interval
+
+    def _settled(self, events: list[dict]):
+        """The leading events that can be delivered: no id before them may still be committed."""
+        horizon = datetime.now(timezone.utc) - timedelta(seconds=self.settle_seconds)
+        expected = self._last_id + 1
+        for e in events:
+            if e['id'] != expected and e['created_at'] > horizon:
+                # 欠番のidがまだコミットされていないトランザクションのものかもしれない
+                return
+            expected = e['id'] + 1
+            yield e
+
+    def _fetch(self, condition, limit: int) -> list[dict]:
+        return self._execute(select(CatalogChange).where(condition).order_by(CatalogChange.id).limit(limit))
+
+    def _execute(self, stmt) -> list[dict]:
+        # ストリーミング中はリクエストのセッションを使わず、読み終えたらすぐに接続を返す
+        with Session(db.engine) as session:
+            return [
+                {'id': change.id, 'event': change.event, 'data': change.data, 'created_at': _as_utc(change.created_at)}
+                for change in session.execute(stmt).scalars()
+            ]
+
+    def _after_commit(self, session):
+        if session.info.pop(_PENDING_KEY, None):
+            with self._changed:
+                self._commit_seq += 1
+                self._changed.notify_all()
+
+    def _after_rollback(self, session):
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLiteはタイムゾーンを保存しないので、読み出した値はnaiveなUTCになる
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+change_feed = ChangeFeed()
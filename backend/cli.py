@@ -0,0 +1,213 @@
+import json
+import os
+import subprocess
+import sys
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from backend import query_plans, similarity, snapshots
+from backend.image_backfill import run_backfill
+from backend.analytics import inventory_analytics
+from backend.image_gc import image_gc
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+
+
+snapshots_cli = AppGroup('snapshots', help='Pre-rendered static catalog snapshots.')
+
+
+@snapshots_cli.command('build')
+def build_snapshots():
+    """Regenerates every snapshot file (unchanged files are skipped)."""
+    writer = snapshots.build_all()
+    click.echo(f"{len(writer.written)} files written, {len(writer.removed)} removed.")
+
+
+@snapshots_cli.command('refresh')
+@click.argument('sneaker_ids', nargs=-1, type=int)
+def refresh_snapshots(sneaker_ids):
+    """Refreshes the listings and the given sneakers' files."""
+    sneakers = [db.session.get(Sneaker, sneaker_id) for sneaker_id in sneaker_ids]
+    categories = [sneaker.category for sneaker in sneakers if sneaker is not None]
+    writer = snapshots.refresh(sneaker_ids=sneaker_ids, categories=categories)
+    click.echo(f"{len(writer.written)} files written, {len(writer.removed)} removed.")
+
+
+similarity_cli = AppGroup('similarity', help='Nearest-neighbour index of similar sneakers.')
+
+
+@similarity_cli.command('build')
+def build_similarity():
+    """Rebuilds the whole similarity index from the database."""
+    count = similarity.build_index()
+    click.echo(f"{count} sneakers indexed.")
+
+
+analytics_cli = AppGroup('analytics', help='Inventory aggregates of the admin dashboard.')
+
+
+@analytics_cli.command('rebuild')
+def rebuild_analytics():
+    """Recomputes inventory_stats from the sneakers table (repairs drifted aggregates)."""
+    drifted = inventory_analytics.rebuild(db.session)
+    db.session.commit()
+    for category, band in drifted:
+        click.echo(f"drifted: {category.value} price band {band}")
+    click.echo(f"inventory_stats rebuilt ({len(drifted)} drifted rows).")
+
+
+images_cli = AppGroup('images', help='Maintenance of uploaded images.')
+
+
+@images_cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='Only report the orphaned images.')
+@click.option('--grace-seconds', type=int, default=None, help='Override IMAGE_GC_GRACE_SECONDS.')
+@click.option('--batch-size', type=int, default=None, help='Override IMAGE_GC_BATCH_SIZE.')
+@click.option('--verbose', '-v', is_flag=True, help='List every orphaned image.')
+def collect_images(dry_run, grace_seconds, batch_size, verbose):
+    """Removes uploaded images that no sneaker references."""
+    def on_orphan(name, size):
+        if verbose or dry_run:
+            click.echo(f"{'orphan' if dry_run else 'removed'}: {name} ({size} bytes)")
+
+    report = image_gc.collect(dry_run=dry_run, grace_seconds=grace_seconds, batch_size=batch_size,
+                              on_orphan=on_orphan)
+    if report is None:
+        raise click.ClickException("Another image GC is already running.")
+    action = 'would remove' if dry_run else 'removed'
+    click.echo(f"{report.scanned} files scanned, {report.referenced} referenced, {report.skipped} skipped; "
+               f"{action} {report.orphaned} orphans ({report.orphaned_bytes} bytes), "
+               f"{report.failed} failed in {report.elapsed:.2f}s.")
+
+
+@images_cli.command('backfill')
+@click.option('--workers', type=int, default=None, help='Override IMAGE_BACKFILL_WORKERS.')
+@click.option('--batch-size', type=int, default=None, help='Override IMAGE_BACKFILL_BATCH_SIZE.')
+@click.option('--verify', is_flag=True, help='Also re-check checkpointed images by hash.')
+@click.option('--limit', type=int, default=None, help='Stop after processing this many images.')
+@click.option('--verbose', '-v', is_flag=True, help='List every re-encoded or failed image.')
+def backfill_images(workers, batch_size, verify, limit, verbose):
+    """Re-encodes the referenced images that do not match IMAGE_FORMAT / IMAGE_MAX_DIMENSION."""
+    def on_result(result):
+        if result['status'] == 'failed' or (verbose and result['status'] in ('reencoded', 'skipped', 'missing')):
+            detail = result['error'] or f"{result['bytes_in']} -> {result['bytes_out']} bytes"
+            click.echo(f"{result['status']}: {result['filename']} -> {result['new_filename']} ({detail})")
+
+    def on_batch(report):
+        click.echo(f"{report.processed} processed, {report.counts['checkpointed']} already done; "
+                   f"{report.throughput()}")
+
+    try:
+        report = run_backfill(workers=workers, batch_size=batch_size, verify=verify, limit=limit,
+                              on_batch=on_batch, on_result=on_result)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        raise click.ClickException("Interrupted; finished batches are checkpointed, run again to resume.")
+    counts = report.counts
+    click.echo(f"profile {report.profile}: {report.processed} processed ({counts['reencoded']} re-encoded, "
+               f"{counts['conforming']} conforming, {counts['unchanged']} unchanged, {counts['skipped']} skipped, "
+               f"{counts['missing']} missing, {counts['failed']} failed), {counts['checkpointed']} already done, "
+               f"{report.renamed} rows renamed; {report.bytes_in} -> {report.bytes_out} bytes "
+               f"in {report.elapsed:.2f}s ({report.throughput()}).")
+
+
+sql_plans_cli = AppGroup('sql-plans', help='Query-plan regression checks of the hot SQL paths.')
+
+
+@sql_plans_cli.command('record')
+@click.argument('scenarios', nargs=-1, type=click.Choice(sorted(query_plans.SCENARIOS)))
+def record_sql_plans(scenarios):
+    """Rewrites the expected-plan fixtures from the current schema."""
+    directory = current_app.config['QUERY_PLAN_FIXTURES_DIR']
+    for name, fixture in query_plans.capture_plans(scenarios).items():
+        query_plans.write_fixture(directory, fixture)
+        flagged = [line.strip() for q in fixture['queries'] for line in q['plan'] if query_plans.is_flagged(line)]
+        click.echo(f"{name}: {len(fixture['queries'])} queries recorded"
+                   + (f" (accepted: {'; '.join(flagged)})" if flagged else ''))
+
+
+@sql_plans_cli.command('check')
+@click.argument('scenarios', nargs=-1, type=click.Choice(sorted(query_plans.SCENARIOS)))
+@click.option('--strict', is_flag=True, help='Also fail when a plan changed without a new scan or temp B-tree.')
+def check_sql_plans(scenarios, strict):
+    """Fails when a hot query newly falls back to a full scan or a temp B-tree sort."""
+    directory = current_app.config['QUERY_PLAN_FIXTURES_DIR']
+    failed = False
+    for name, actual in query_plans.capture_plans(scenarios).items():
+        failures, notes = query_plans.compare(query_plans.load_fixture(directory, name), actual)
+        if strict:
+            failures, notes = failures + notes, []
+        click.echo(f"{'FAIL' if failures else 'ok'}  {name}")
+        for message in failures:
+            click.echo(f"    regression: {message}")
+        for message in notes:
+            click.echo(f"    note: {message}")
+        failed = failed or bool(failures)
+    if failed:
+        raise SystemExit(1)
+
+
+def parse_importtime(output: str) -> list[dict]:
+    """Parses `python -X importtime` output into [{'module', 'self_us', 'cumulative_us', 'depth'}]."""
+    records = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        records.append({
+            'module': name.strip(),
+            'self_us': int(self_us),
+            'cumulative_us': int(cumulative_us),
+            # インデントの深さ(2スペースごとに1段)がインポートの入れ子の深さを表す
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+        })
+    return records
+
+
+@click.command('profile-imports')
+@click.option('--module', default='app', show_default=True, help='Entry point module to import.')
+@click.option('--top', default=20, show_default=True, help='Number of modules to list.')
+@click.option('--sort', type=click.Choice(['cumulative', 'self']), default='cumulative', show_default=True)
+@click.option('--json', 'as_json', is_flag=True, help='Print every record as JSON.')
+def profile_imports(module, top, sort, as_json):
+    """Measures the import cost of the entry point module per module (python -X importtime)."""
+    # 既にインポート済みのモジュールが混ざらないよう、新しいインタプリタでコールドスタートを再現する
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=project_root, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise click.ClickException(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    records = parse_importtime(result.stderr)
+    if as_json:
+        click.echo(json.dumps(records, indent=1))
+        return
+
+    entry = next((r for r in records if r['module'] == module and r['depth'] == 0), None)
+    total_us = entry['cumulative_us'] if entry else sum(record['self_us'] for record in records)
+    packages = {}
+    for record in records:
+        package = record['module'].split('.')[0]
+        packages[package] = packages.get(package, 0) + record['self_us']
+
+    click.echo(f"Importing {module}: {total_us / 1000:.1f}ms, {len(records)} modules")
+    click.echo(f"\nTop {top} modules by {sort} time:")
+    for record in sorted(records, key=lambda r: r[f'{sort}_us'], reverse=True)[:top]:
+        click.echo(f"  {record['cumulative_us'] / 1000:8.1f}ms {record['self_us'] / 1000:8.1f}ms  {record['module']}")
+    click.echo(f"\nTop {top} packages by self time:")
+    for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        click.echo(f"  {self_us / 1000:8.1f}ms  {package}")
+
+
+def register_commands(app):
+    app.cli.add_command(snapshots_cli)
+    app.cli.add_command(similarity_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(sql_plans_cli)
+    app.cli.add_command(profile_imports)
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import threading
+
+from backend.signals import sneaker_created, sneaker_updated, sneaker_deleted
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """One in-flight computation shared by the leader and its followers (thread version)."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class RequestCoalescer:
+    """
+    Single-flight layer for hot read-only views.
+
+    新作の発売直後などに同じ一覧ページ/同じ商品への同一リクエストが同時に大量に届いた場合、
+    最初のリクエスト(リーダー)だけがSQLとシリアライズを実行し、処理中に届いた同一リクエスト
+    (フォロワー)はその結果を待って受け取る。結果をキャッシュするわけではないので、リーダーの
+    処理が終わった後に届いたリクエストは改めて計算される。
+
+    キーは (エンドポイント, 正規化した引数, カタログのバージョン, その他の文脈(ホスト名、レプリカから読むか))。
+    カタログのバージョンはスニーカーの作成/更新/削除のシグナルで進むので、書き込みの後に
+    届いたリクエストが書き込み前に始まった計算に合流することはない。
+    バージョンはワーカープロセスごとのカウンタなので、他のワーカーでの書き込みは反映されないが、
+    合流できるのは処理中の計算だけなので古さは最大でもクエリ1回分の時間に収まる。
+
+        COALESCE_ENABLED       Falseにすると常にリクエストごとに計算する
+        COALESCE_WAIT_TIMEOUT  フォロワーが待つ最大秒数。超えた場合は自分で計算する
+
+    スレッド(Flask)とasyncio(backend/aio)の両方に対応し、stats()で合流した件数を確認できる。
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.wait_timeout = 10.0
+        self.catalog_version = 0
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        for signal in (sneaker_created, sneaker_updated, sneaker_deleted):
+            signal.connect(self._bump_catalog_version, weak=False)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COALESCE_ENABLED', True)
+        app.config.setdefault('COALESCE_WAIT_TIMEOUT', 10)
+        self.enabled = app.config['COALESCE_ENABLED']
+        self.wait_timeout = app.config['COALESCE_WAIT_TIMEOUT']
+        app.extensions['coalescer'] = self
+
+    # --- public API ---
+
+    def make_key(self, endpoint: str, args, **context) -> tuple:
+        """
+        Builds a key from the endpoint name, its arguments (any iterable of (name, value) pairs)
+        and anything else the response depends on (e.g. host, replica).
+        """
+        args = tuple(sorted((str(name), str(value)) for name, value in args))
+        return endpoint, args, self.catalog_version, tuple(sorted(context.items()))
+
+    def run(self, key: tuple, fn):
+        """Runs fn() once for all concurrent callers with the same key. Returns (result, coalesced)."""
+        if not self.enabled:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+            self._count(key[0], 'leaders' if is_leader else 'coalesced')
+
+        if not is_leader:
+            if call.event.wait(self.wait_timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            # リーダーの処理が長引いている場合は待つのをやめて自分で計算する
+            with self._lock:
+                self._count(key[0], 'timeouts')
+            return fn(), False
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+            self._log_followers(key[0], call.followers)
+
+    async def run_async(self, key: tuple, fn):
+        """asyncio version of run(): `fn` is a coroutine function. Returns (result, coalesced)."""
+        if not self.enabled:
+            return await fn(), False
+
+        future = self._async_calls.get(key)
+        if future is not None:
+            future.followers += 1
+            self._count_locked(key[0], 'coalesced')
+            try:
+                # フォロワーがキャンセルされてもリーダーの計算は止めない
+                return await asyncio.wait_for(asyncio.shield(future), self.wait_timeout), True
+            except asyncio.TimeoutError:
+                self._count_locked(key[0], 'timeouts')
+                return await fn(), False
+
+        future = asyncio.get_running_loop().create_future()
+        future.followers = 0
+        # フォロワーがいないまま例外で終わった場合に"exception was never retrieved"の警告を出さない
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._async_calls[key] = future
+        self._count_locked(key[0], 'leaders')
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result, False
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+            self._log_followers(key[0], future.followers)
+
+    def stats(self) -> dict:
+        """Per-endpoint counters of this process: leaders, coalesced, timeouts and the coalesced ratio."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, s in self._stats.items():
+                total = s['leaders'] + s['coalesced']
+                endpoints[endpoint] = dict(s, coalesced_ratio=round(s['coalesced'] / total, 3) if total else 0.0)
+            return {
+                'catalog_version': self.catalog_version,
+                'in_flight': len(self._calls) + len(self._async_calls),
+                'endpoints': endpoints,
+            }
+
+    # --- internals ---
+
+    def _bump_catalog_version(self, sender, **extra):
+        with self._lock:
+            self.catalog_version += 1
+
+    def _count(self, endpoint: str, name: str):
+        s = self._stats.setdefault(endpoint, {'leaders': 0, 'coalesced': 0, 'timeouts': 0})
+        s[name] += 1
+
+    def _count_locked(self, endpoint: str, name: str):
+        with self._lock:
+            self._count(endpoint, name)
+
+    def _log_followers(self, endpoint: str, followers: int):
+        if followers:
+            logger.info(f"Coalesced {followers} concurrent requests into one for {endpoint}")
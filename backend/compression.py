@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # 任意の依存。無ければbrは提供しない
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # 任意の依存。無ければzstdは提供しない
+    zstandard = None
+
+
+def _compress_gzip(body: bytes, level: int) -> bytes:
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _compress_br(body: bytes, level: int) -> bytes:
+    return brotli.compress(body, quality=level)
+
+
+def _compress_zstd(body: bytes, level: int) -> bytes:
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+COMPRESSORS = {'gzip': _compress_gzip}
+if brotli is not None:
+    COMPRESSORS['br'] = _compress_br
+if zstandard is not None:
+    COMPRESSORS['zstd'] = _compress_zstd
+
+
+class CompressedCache:
+    """
+    LRU of compressed bodies keyed by (sha256 of the uncompressed body, encoding), bounded in bytes.
+
+    キーが内容のハッシュなので、カタログが更新されて一覧の中身が変われば自動的に別のキーになり、
+    どのワーカーから見ても古い圧縮結果を返すことはない。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class Compressor:
+    """
+    Response compression middleware (gzip / br / zstd negotiated via Accept-Encoding).
+
+    - COMPRESS_MIN_SIZE未満のレスポンス、画像など既に圧縮されている形式、ストリーミングレスポンスは圧縮しない
+    - GETの200レスポンスは圧縮結果をCompressedCacheに保持し、同じ一覧ページへの2回目以降のアクセスでは
+      再圧縮せずにキャッシュを返す
+    """
+
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ENABLED', True)
+        app.config.setdefault('COMPRESS_ALGORITHMS', ['br', 'zstd', 'gzip'])
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVELS', {'gzip': 6, 'br': 4, 'zstd': 3})
+        app.config.setdefault('COMPRESS_SKIP_MIMETYPES', ['image/', 'video/', 'audio/', 'application/zip', 'application/gzip'])
+        app.config.setdefault('COMPRESS_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.extensions['compressor'] = self
+        if not app.config['COMPRESS_ENABLED']:
+            return
+        self.algorithms = [a for a in app.config['COMPRESS_ALGORITHMS'] if a in COMPRESSORS]
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.levels = app.config['COMPRESS_LEVELS']
+        self.skip_mimetypes = tuple(app.config['COMPRESS_SKIP_MIMETYPES'])
+        self.cache = CompressedCache(app.config['COMPRESS_CACHE_MAX_BYTES'])
+        app.after_request(self.compress_response)
+
+    def _is_compressible(self, response) -> bool:
+        if response.direct_passthrough or response.is_streamed:
+            return False
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in response.headers:
+            return False
+        return not (response.mimetype or '').startswith(self.skip_mimetypes)
+
+    def _choose_encoding(self) -> str | None:
+        accepted = request.accept_encodings
+        best = None
+        best_quality = 0
+        # サーバー側の優先順位(COMPRESS_ALGORITHMS)を保ちつつ、クライアントのq値が最も高いものを選ぶ
+        for encoding in self.algorithms:
+            quality = accepted[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress_response(self, response):
+        if not self._is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        encoding = self._choose_encoding()
+        if encoding is None:
+            return response
+
+        cacheable = request.method == 'GET' and response.status_code == 200
+        key = (hashlib.sha256(body).digest(), encoding) if cacheable else None
+        compressed = self.cache.get(key) if cacheable else None
+        if compressed is None:
+            compressed = COMPRESSORS[encoding](body, self.levels.get(encoding, 6))
+            if cacheable:
+                self.cache.set(key, compressed)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if response.headers.get('ETag'):
+            # 圧縮形式ごとに異なる表現になるので、ETagも区別する
+            etag, weak = response.get_etag()
+            response.set_etag(f"{etag}-{encoding}", weak=weak)
+        return response
@@ -1,19 +1,86 @@
 from dotenv import load_dotenv
+import json
 import os
 from datetime import timedelta
 
-load_dotenv()
+# Vercel上では環境変数はプラットフォームから渡されるので、.envの探索(コールドスタート時のコスト)を省く
+if not os.environ.get('VERCEL'):
+    load_dotenv()
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_json(name: str, default):
+    value = os.environ.get(name)
+    return json.loads(value) if value not in (None, '') else default
+
+
 class BaseConfig():
     # Flask本体および多くの拡張機能が（セッションの署名、CSRF トークン生成など）で利用する設定キー
     SECRET_KEY = os.environ.get('SECRET_KEY')
 
     # Flask-SQLAlchemy拡張が読み取って動作を制御するための設定キー
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # 読み取り専用のビュー(@read_only)はレプリカに振り分けられる。未設定ならすべてプライマリに行く
+    # ローカルでは別のSQLiteファイルをレプリカ役として指定すれば動作確認できる
+    REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+    SQLALCHEMY_BINDS = {'replica': REPLICA_DATABASE_URL} if REPLICA_DATABASE_URL else {}
+    # 自分が書き込んだ直後の数秒間は、レプリカの遅延を避けるためプライマリから読む
+    READ_YOUR_WRITES_SECONDS = env_int('READ_YOUR_WRITES_SECONDS', 5)
+
+    # SQLite用のエンジンプロファイル。接続のたびにPRAGMAとして適用される(backend/database.py参照)
+    # WALにすることで読み取りが書き込みをブロックしなくなり、busy_timeoutで'database is locked'を即座に返さず待つようになる
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'mmap_size': env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        'cache_size': env_int('SQLITE_CACHE_SIZE', -64000), # 負の値はKiB単位(ここでは約64MB)
+        'busy_timeout': env_int('SQLITE_BUSY_TIMEOUT', 5000), # ミリ秒
+    }
+
+    # サーバー型DB(PostgreSQL/MySQLなど)用のコネクションプール設定。SQLiteの場合は使われない
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 10)
+    DB_POOL_TIMEOUT = env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+    DB_POOL_PRE_PING = env_bool('DB_POOL_PRE_PING', True)
+
+    # ASGI版(backend/aio)の設定。ASYNC_DATABASE_URLが未設定ならSQLALCHEMY_DATABASE_URIからasyncドライバ版を導く
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    ASYNC_EXECUTOR_WORKERS = env_int('ASYNC_EXECUTOR_WORKERS', 4)
+
+    # パスワードハッシュの方式とコスト(werkzeugのmethod文字列)。変更すると既存ユーザーは次回ログイン時に再ハッシュされる
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_SALT_LENGTH = env_int('PASSWORD_HASH_SALT_LENGTH', 16)
+    # ハッシュ計算を行うプロセスプールのサイズ。0にするとリクエストスレッド内で計算する
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 2)
+    PASSWORD_HASH_MP_CONTEXT = os.environ.get('PASSWORD_HASH_MP_CONTEXT', 'spawn')
+
+    # 認証系エンドポイントのレート制限(トークンバケット)。キーの種類ごとに '回数/期間' で指定する
+    RATE_LIMIT_ENABLED = env_bool('RATE_LIMIT_ENABLED', True)
+    RATE_LIMITS = {
+        'login': {'ip': '20/minute', 'email': '5/minute'},
+        'register': {'ip': '5/minute'},
+        'refresh': {'ip': '60/minute', 'user': '10/minute'},
+    }
+    # 'memory'はワーカーごと。'sqlite:////tmp/ratelimit.db'のように指定すると同一ホストの全ワーカーで共有される
+    RATE_LIMIT_STORAGE_URL = os.environ.get('RATE_LIMIT_STORAGE_URL', 'memory')
+    RATE_LIMIT_TRUST_FORWARDED_FOR = env_bool('RATE_LIMIT_TRUST_FORWARDED_FOR', False)
+
     # flask-jwt-extended が内部で参照する設定キー
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=30)
@@ -43,6 +110,109 @@ class BaseConfig():
     # 特にパッケージに依存しないキー
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
 
+    # レスポンス圧縮(backend/compression.py)。COMPRESS_MIN_SIZEバイト未満のレスポンスは圧縮しない
+    COMPRESS_ENABLED = env_bool('COMPRESS_ENABLED', True)
+    COMPRESS_MIN_SIZE = env_int('COMPRESS_MIN_SIZE', 500)
+    COMPRESS_CACHE_MAX_BYTES = env_int('COMPRESS_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+
+    # 同一リクエストの合流(backend/coalescing.py)。フォロワーはCOALESCE_WAIT_TIMEOUT秒までリーダーの結果を待つ
+    COALESCE_ENABLED = env_bool('COALESCE_ENABLED', True)
+    COALESCE_WAIT_TIMEOUT = env_int('COALESCE_WAIT_TIMEOUT', 10)
+
+    # SSEの変更フィード(backend/changefeed.py)。各ワーカーは直近CHANGE_FEED_BUFFER_SIZE件のイベントをメモリに保持する
+    CHANGE_FEED_BUFFER_SIZE = env_int('CHANGE_FEED_BUFFER_SIZE', 1000)
+    CHANGE_FEED_POLL_INTERVAL = env_int('CHANGE_FEED_POLL_INTERVAL', 2) # 他のワーカーでの変更をテーブルから読み足す間隔(秒)
+    CHANGE_FEED_HEARTBEAT_SECONDS = env_int('CHANGE_FEED_HEARTBEAT_SECONDS', 15)
+    CHANGE_FEED_MAX_STREAM_SECONDS = env_int('CHANGE_FEED_MAX_STREAM_SECONDS', 300)
+    CHANGE_FEED_SETTLE_SECONDS = env_int('CHANGE_FEED_SETTLE_SECONDS', 5) # idの欠番をコミット待ちとして扱う時間。これより古い欠番は飛ばす
+
+    # Idempotency-Key(backend/idempotency.py)。保存したレスポンスはIDEMPOTENCY_TTL_SECONDS秒で期限切れになる
+    IDEMPOTENCY_TTL_SECONDS = env_int('IDEMPOTENCY_TTL_SECONDS', 24 * 3600)
+    IDEMPOTENCY_LOCK_SECONDS = env_int('IDEMPOTENCY_LOCK_SECONDS', 60) # これより長く処理中の行は放置されたとみなす
+    IDEMPOTENCY_WAIT_TIMEOUT = env_int('IDEMPOTENCY_WAIT_TIMEOUT', 10)
+
+    # 類似スニーカーのインデックス(backend/similarity.py)。`flask similarity build` で作成する
+    SIMILARITY_ENABLED = env_bool('SIMILARITY_ENABLED', False) # Trueにすると書き込みのたびに影響を受ける行だけを(バックグラウンドで)差分更新する
+    SIMILARITY_INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR') or os.path.join(BASE_DIR, 'instance', 'similarity')
+    SIMILARITY_DIM = env_int('SIMILARITY_DIM', 512) # 変更した場合はインデックスを作り直すこと
+    SIMILARITY_TOP_K = env_int('SIMILARITY_TOP_K', 10)
+
+    # 検索ボックスの入力補完(backend/suggest.py)。1回に返す候補の最大数
+    SUGGEST_MAX_LIMIT = env_int('SUGGEST_MAX_LIMIT', 20)
+
+    # 在庫ダッシュボード(backend/analytics.py)。在庫がこの数以下(0は除く)のスニーカーを在庫僅少として数える
+    INVENTORY_LOW_STOCK_THRESHOLD = env_int('INVENTORY_LOW_STOCK_THRESHOLD', 5) # 変更した場合は `flask analytics rebuild` を実行すること
+
+    # 孤立した画像の掃除(backend/image_gc.py)。最終更新からIMAGE_GC_GRACE_SECONDS秒以内のファイルは消さない
+    IMAGE_GC_GRACE_SECONDS = env_int('IMAGE_GC_GRACE_SECONDS', 3600)
+    IMAGE_GC_BATCH_SIZE = env_int('IMAGE_GC_BATCH_SIZE', 500) # 1回のIN (...)で問い合わせるファイル数
+    IMAGE_GC_INTERVAL_SECONDS = env_int('IMAGE_GC_INTERVAL_SECONDS', 0) # 0より大きいとワーカー内で定期的に実行する
+
+    # 保存する画像の設定。変えたあとに `flask images backfill`(backend/image_backfill.py)で既存の画像を作り直す
+    IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'keep') # 'keep'(元の形式のまま) / 'JPEG' / 'PNG'
+    IMAGE_MAX_DIMENSION = env_int('IMAGE_MAX_DIMENSION', 2000) # 長辺の最大ピクセル数。0なら縮小しない
+    IMAGE_QUALITY = env_int('IMAGE_QUALITY', 85) # JPEGの品質
+    IMAGE_BACKFILL_WORKERS = env_int('IMAGE_BACKFILL_WORKERS', 0) # 0ならCPU数
+    IMAGE_BACKFILL_BATCH_SIZE = env_int('IMAGE_BACKFILL_BATCH_SIZE', 200) # この件数ごとに進捗をコミットする
+    IMAGE_BACKFILL_TASKS_PER_CHILD = env_int('IMAGE_BACKFILL_TASKS_PER_CHILD', 500) # ワーカーのプロセスを作り直す間隔(メモリの増加を抑える)
+    IMAGE_BACKFILL_MP_CONTEXT = os.environ.get('IMAGE_BACKFILL_MP_CONTEXT', 'spawn') # max_tasks_per_childはforkでは使えない
+
+    # `flask sql-plans check/record`(backend/query_plans.py)の期待するクエリプランの置き場所
+    QUERY_PLAN_FIXTURES_DIR = os.path.join(os.path.dirname(BASE_DIR), 'query_plans')
+
+    # ログ(backend/logs.py)。書き出しは別スレッドで行い、リクエストのスレッドはキューに入れるだけ
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.environ.get('LOG_LEVELS', '') # ロガーごとのレベル。例: 'backend.passwords=DEBUG,werkzeug=WARNING'
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json') # 'json' または 'text'
+    LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000) # 一杯のときは待たずに捨てる
+    LOG_DEBUG_SAMPLE_EVERY = env_int('LOG_DEBUG_SAMPLE_EVERY', 10) # DEBUGは呼び出し箇所ごとにN件に1件だけ出す
+
+    # 遅延・障害の注入(backend/faults.py)。ルールの書き方はbackend/faults.pyを参照。環境変数ではJSONで指定する
+    FAULT_INJECTION_ENABLED = env_bool('FAULT_INJECTION_ENABLED', False)
+    FAULT_INJECTION_RULES = env_json('FAULT_INJECTION_RULES', [])
+    # X-Fault-Injectionヘッダーでの指定を許可する。どのクライアントからでも指定できるので、開発環境でも既定では無効
+    FAULT_INJECTION_ALLOW_HEADER = env_bool('FAULT_INJECTION_ALLOW_HEADER', False)
+    FAULT_INJECTION_MAX_LATENCY = float(os.environ.get('FAULT_INJECTION_MAX_LATENCY') or 5) # 注入する遅延の上限(秒)。超える指定は400、分布から引いた値はここで切る
+    FAULT_INJECTION_MAX_DB_LATENCY = float(os.environ.get('FAULT_INJECTION_MAX_DB_LATENCY') or 0.5) # SQLごとの遅延の上限(秒)
+
+    # ワーカー間で共有するキャッシュ(backend/cache.py)。'null' / 'memory' / 'sqlite:///path' / 'redis://host:6379/0'
+    # 'memory'はワーカーごとなので、複数のワーカーで動かす場合はsqliteかredisを指定する
+    CACHE_URL = os.environ.get('CACHE_URL', 'null')
+    CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'sneakers-api')
+    CACHE_DEFAULT_TTL = env_int('CACHE_DEFAULT_TTL', 300)
+    CACHE_MAX_ENTRIES = env_int('CACHE_MAX_ENTRIES', 10000) # 'memory'のエントリー数の上限
+    CACHE_VERSION_CHECK_SECONDS = env_int('CACHE_VERSION_CHECK_SECONDS', 0) # 他のワーカーの無効化が反映されるまでの最大秒数
+
+    # オフラインのミラー向けの差分同期(backend/sync.py、GET /api/sneakers/changes)
+    SYNC_PAGE_SIZE = env_int('SYNC_PAGE_SIZE', 500)
+    SYNC_MAX_PAGE_SIZE = env_int('SYNC_MAX_PAGE_SIZE', 1000)
+    SYNC_SETTLE_SECONDS = env_int('SYNC_SETTLE_SECONDS', 5) # flushからコミットまでにかかる時間の上限の目安。これより新しい変更は次回の同期で返す
+    SYNC_TOMBSTONE_RETENTION_DAYS = env_int('SYNC_TOMBSTONE_RETENTION_DAYS', 30) # これより古い同期トークンは410になる
+
+    # 複数のAPIリクエストを1回にまとめる/api/batch(backend/batch.py)
+    BATCH_MAX_REQUESTS = env_int('BATCH_MAX_REQUESTS', 20)
+    BATCH_MAX_CONCURRENCY = env_int('BATCH_MAX_CONCURRENCY', 4) # 連続するGETを並行に処理するスレッド数。1なら順に処理する
+
+    # 一覧(get_items)のper_pageの上限と、全件のストリーミングでの書き出し(backend/export.py)
+    ITEMS_MAX_PER_PAGE = env_int('ITEMS_MAX_PER_PAGE', 100)
+    EXPORT_YIELD_PER = env_int('EXPORT_YIELD_PER', 500) # 一度にDBから読む行数
+    EXPORT_CHUNK_BYTES = env_int('EXPORT_CHUNK_BYTES', 64 * 1024) # この大きさごとにクライアントへ送る
+
+    # リクエストのプロファイリング(backend/profiling.py)。無効のときはフックを登録しない
+    PROFILING_ENABLED = env_bool('PROFILING_ENABLED', False)
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE') or 0) # X-Profileヘッダーが無くてもプロファイルを取るリクエストの割合
+    PROFILING_MODE = os.environ.get('PROFILING_MODE', 'sampling') # 'sampling' / 'tracing'
+    PROFILING_INTERVAL_MS = env_int('PROFILING_INTERVAL_MS', 2) # samplingでスタックを読む間隔
+    PROFILING_DIR = os.environ.get('PROFILING_DIR') or os.path.join(BASE_DIR, 'instance', 'profiles')
+    PROFILING_MAX_PROFILES = env_int('PROFILING_MAX_PROFILES', 50) # これより古いものは消す
+
+    # 静的カタログスナップショット(backend/snapshots.py)。/static/snapshots/... として配信される
+    SNAPSHOTS_ENABLED = env_bool('SNAPSHOTS_ENABLED', False) # Trueにすると書き込みのたびに差分更新される
+    SNAPSHOT_DIR = os.path.join(BASE_DIR, 'static', 'snapshots')
+    SNAPSHOT_PAGES = env_int('SNAPSHOT_PAGES', 5)
+    SNAPSHOT_PER_PAGE = env_int('SNAPSHOT_PER_PAGE', 6)
+    SNAPSHOT_BASE_URL = os.environ.get('SNAPSHOT_BASE_URL', 'http://localhost:5000') # CLI実行時のimage_urlのホスト
+
     # Werkzeugが、内部的に受信リクエストボディの最大バイト数をチェックするための設定キー
     # これを超えたリクエストで自動的に RequestEntityTooLarge（HTTP 413）が発生
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
@@ -51,7 +221,43 @@ class BaseConfig():
 
 
 class DevelopmentConfig(BaseConfig):
-    pass
+    # 開発中はフロントのローディング表示などを確認できるよう、主なエンドポイントを1秒遅らせる
+    FAULT_INJECTION_ENABLED = env_bool('FAULT_INJECTION_ENABLED', True)
+    FAULT_INJECTION_RULES = env_json('FAULT_INJECTION_RULES', [
+        {'endpoint': ['sneakers.get_items', 'sneakers.get_item', 'sneakers.create_item', 'sneakers.update_item',
+                      'sneakers.delete_item', 'users.create_user', 'users.change_username', 'users.change_password',
+                      'users.delete_user', 'users.login_user', 'users.logout'],
+         'latency': 1},
+    ])
+    # 開発サーバーは1プロセスなので、ワーカーごとのキャッシュで足りる
+    CACHE_URL = os.environ.get('CACHE_URL', 'memory')
 
 class ProductionConfig(BaseConfig):
-    pass
\ No newline at end of file
+    # 本番ではより多くの同時接続を捌けるようにプールを大きめにする
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 20)
+    # 本番では遅延・障害の注入を環境変数でも有効にできないようにする
+    FAULT_INJECTION_ENABLED = False
+    FAULT_INJECTION_ALLOW_HEADER = False
+
+class TestingConfig(BaseConfig):
+    TESTING = True
+    PASSWORD_HASH_WORKERS = 0
+    RATE_LIMIT_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+
+
+config_by_name = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
+
+
+def get_config(name: str | None = None):
+    """Returns the config class for the given name, falling back to APP_ENV / FLASK_ENV."""
+    name = name or os.environ.get('APP_ENV') or os.environ.get('FLASK_ENV') or 'development'
+    try:
+        return config_by_name[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown config name: {name}. Expected one of {sorted(config_by_name)}")
@@ -0,0 +1,87 @@
+from functools import cache
+
+from sqlalchemy import Numeric, cast, event, inspect, literal
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import ClauseElement
+
+from backend.extensions import db
+
+
+def apply_engine_options(app):
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS from the selected config profile.
+
+    SQLite does not use the server pool settings, so they are only applied to
+    server databases (PostgreSQL, MySQL, ...). Options set explicitly in the
+    config take precedence over the generated ones.
+    """
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+    if url.get_backend_name() != 'sqlite':
+        options = {
+            'pool_size': app.config['DB_POOL_SIZE'],
+            'max_overflow': app.config['DB_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+            'pool_recycle': app.config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': app.config['DB_POOL_PRE_PING'],
+        }
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def listen_sqlite_pragmas(engine, pragmas: dict):
+    """Registers a connect listener that applies the given PRAGMAs on every new DBAPI connection."""
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+
+def register_sqlite_pragmas(app):
+    """Applies SQLITE_PRAGMAS on every new DBAPI connection of each SQLite engine."""
+    pragmas = app.config.get('SQLITE_PRAGMAS') or {}
+    if not pragmas:
+        return
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                listen_sqlite_pragmas(engine, pragmas)
+
+
+@cache
+def _returned_columns(model) -> tuple:
+    # DBが丸めて保存する列(scaleのあるNumeric)のうち、RETURNINGで読み戻すよう宣言されている列
+    # (server_default/server_onupdateにFetchedValue、マッパーにeager_defaults。models/sneaker.pyのprice)
+    return tuple(
+        attr.key for attr in inspect(model).column_attrs
+        if isinstance(attr.columns[0].type, Numeric) and attr.columns[0].type.scale is not None
+        and attr.columns[0].server_onupdate is not None
+    )
+
+
+def flush_returning_stored(session, obj):
+    """
+    Flushes so that the INSERT/UPDATE itself returns the stored value of the columns the database rounds.
+
+    expire_on_commit=Falseのセッションでは、コミット後もオブジェクトは代入した値のままになる(price="100"を
+    代入すればDBには100.00と保存されても"100"のまま)。レスポンスや変更ログをDBに保存された値で作るため、
+    そうした列に代入された値をCASTの式に置き換えてからflushする。ORMはSQLの式を代入された列を、
+    INSERT/UPDATEのRETURNINGで読み戻すので、読み直しのSELECTは発行しない(RETURNINGの無いMySQLではSELECTになる)。
+    AsyncSessionでは `await session.run_sync(flush_returning_stored, obj)` として使う。
+    """
+    state = inspect(obj)
+    columns = state.mapper.columns
+    for name in _returned_columns(type(obj)):
+        value = getattr(obj, name)
+        if value is None or isinstance(value, ClauseElement):
+            continue
+        if state.pending or state.attrs[name].history.has_changes():
+            setattr(obj, name, cast(literal(value, columns[name].type), columns[name].type))
+    session.flush()
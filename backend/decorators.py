@@ -1,14 +1,15 @@
 from functools import wraps
-from flask import jsonify, current_app
+from flask import jsonify, current_app, g, request
 from flask_jwt_extended import get_jwt_identity
+from backend.idempotency import idempotency_store, validate_key, fingerprint, HEADER as IDEMPOTENCY_HEADER
 from uuid import UUID
 from backend.models.user import User
-from backend.extensions import db
+from backend.extensions import db, replica_router, coalescer, cache
+from backend.ratelimit import client_ip
 
 def require_same_user(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        print(f"Kwargs in require_same_user: {kwargs}") # ここを追加
         user_id = get_jwt_identity()
 
         user_id_from_url = str(UUID(kwargs.get('user_id')))
@@ -23,10 +24,127 @@ def require_same_user(fn):
 def require_admin(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        print('アドミンデコレータ~')
         user_id = get_jwt_identity()
         user = db.session.get(User, UUID(user_id))
         if not user.is_admin:
             return jsonify({"message": "Forbidden: You are not authorized to perform this action", "error_code": "FORBIDDEN"}), 403
         return fn(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+# 読み取りしか行わないビューに付ける。JWTのブロックリスト確認などはプライマリで行いたいので、
+# @jwt_requiredなどの認証系デコレータよりも内側(下)に置くこと
+def read_only(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        g.use_replica = replica_router.should_use_replica()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            g.use_replica = False
+    return wrapper
+
+# 同時に届いた同一のリクエスト(エンドポイント・クエリ・URL引数が同じ)で1回の計算結果を共有する。
+# レプリカから読むかどうかもキーに含めるので、@read_onlyよりも内側(下)に置くこと
+def coalesce(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = coalescer.make_key(
+            request.endpoint,
+            [*request.args.items(multi=True), *kwargs.items()],
+            # image_urlはホスト名を含むので、ホストが違えば別のレスポンスになる
+            host=request.host,
+            replica=bool(g.get('use_replica')),
+        )
+
+        def render():
+            # Responseオブジェクトはafter_requestで書き換えられるので、共有するのは中身だけにする
+            response = current_app.make_response(fn(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        (body, status, headers), coalesced = coalescer.run(key, render)
+        response = current_app.response_class(body, status=status, headers=headers)
+        if coalesced:
+            response.headers['X-Coalesced'] = 'true'
+        return response
+    return wrapper
+
+# 200のレスポンスを共有キャッシュ(backend/cache.py)のネームスペースに保存し、他のワーカーからも再利用する。
+# ネームスペースは書き込み時に無効化される。レプリカから読んだレスポンスは(遅延で古い可能性があるので)保存しない。
+# 認証の後で使うので、@jwt_requiredなどよりも内側(下)、@read_onlyよりも内側に置くこと
+def cached(namespace: str, ttl: int | None = None):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return fn(*args, **kwargs)
+            items = sorted((str(k), str(v)) for k, v in [*request.args.items(multi=True), *kwargs.items()])
+            # image_urlはホスト名を含むので、ホストが違えば別のレスポンスになる
+            key = f"{request.endpoint}:{request.host}:{items!r}"
+
+            response = None
+
+            def render():
+                nonlocal response
+                response = current_app.make_response(fn(*args, **kwargs))
+                if response.status_code != 200 or g.get('use_replica'):
+                    return None
+                headers = [(k, v) for k, v in response.headers.items() if k != 'X-Coalesced']
+                return response.get_data(), response.status_code, headers
+
+            entry = cache.namespace(namespace).get_or_set(key, render, ttl)
+            if response is not None:
+                return response
+            body, status, headers = entry
+            response = current_app.response_class(body, status=status, headers=headers)
+            response.headers['X-Cache'] = 'hit'
+            return response
+        return wrapper
+    return decorator
+
+# Idempotency-Keyヘッダー付きのリクエストは、最初のレスポンスを保存して再送時にはそれを返す(backend/idempotency.py)。
+# ユーザーごとにキーを区別するので、@jwt_requiredや@require_adminよりも内側(下)に置くこと
+def idempotent(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return fn(*args, **kwargs)
+        key = validate_key(key)
+        scope = _idempotency_scope()
+
+        stored = idempotency_store.begin(scope, key, _request_fingerprint())
+        if stored is not None:
+            current_app.logger.info(f"Replaying the stored response for Idempotency-Key {key}")
+            response = current_app.response_class(stored.body, status=stored.status, headers=stored.headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(fn(*args, **kwargs))
+        except Exception:
+            # バリデーションエラーなども保存せず、再送時に改めて処理する
+            idempotency_store.release(scope, key)
+            raise
+        idempotency_store.complete(scope, key, response.status_code, response.headers.items(), response.get_data())
+        return response
+    return wrapper
+
+
+def _idempotency_scope() -> str:
+    try:
+        user_id = get_jwt_identity()
+    except RuntimeError:  # @jwt_requiredの付いていないビュー(ユーザー登録など)
+        user_id = None
+    # 未ログインのクライアントどうしで、保存されたレスポンス(他人のユーザー情報など)が返らないようにIPアドレスでも区別する
+    return f"user:{user_id}" if user_id else f"anonymous:{client_ip()}"
+
+
+def _request_fingerprint() -> str:
+    if request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        files = []
+        for name, file in request.files.items(multi=True):
+            files.append((name, file.filename, file.stream.read()))
+            # ビューで保存できるよう読み出し位置を戻す
+            file.stream.seek(0)
+        return fingerprint(request.method, request.path, fields=request.form.items(multi=True), files=files)
+    return fingerprint(request.method, request.path, body=request.get_data(cache=True))
@@ -9,146 +9,208 @@ from PIL import UnidentifiedImageError
 from backend.extensions import db, jwt
 from backend.models.user import TokenBlocklist
 from backend.utils_image import ImageValidationError, FileSystemError
+from backend.ratelimit import RateLimitExceeded
+from backend.idempotency import IdempotencyKeyReused, IdempotencyKeyInProgress
 
-def register_error_handlers(app):
-    """Registers custom error handlers for the Flask application."""
 
-    # --- 4xx Client Errors ---
+# 各ハンドラーはフレームワークに依存しない形で (レスポンスボディ, ステータスコード) を返す。
+# 追加のレスポンスヘッダーが必要な場合は (ボディ, ステータスコード, ヘッダー) を返す。
+# Flaskアプリ(register_error_handlers)とASGIアプリ(backend/aio)の両方から使われる。
 
-    @app.errorhandler(ValidationError)
-    def handle_pydantic_validation_error(error: ValidationError):
-        """Handles Pydantic's ValidationError (400 Bad Request)."""
-        db.session.rollback()
-        # Pydantic v2では error.errors() で詳細なエラーリストが取得できる
-        current_app.logger.warning(f"Pydantic validation failed: {error.errors()}")
-        response = {
-            "error_code": "VALIDATION_ERROR",
-            "message": "Input validation failed.",
-            "details": error.errors()
-        }
-        return jsonify(response), 400
-
-    @app.errorhandler(IntegrityError)
-    def handle_database_integrity_error(error: IntegrityError):
-        """Handles database integrity errors (e.g., duplicate unique keys) (409 Conflict)."""
-        db.session.rollback()
-        # origは "original exception" の略で、SQLAlchemyが自身のエラー（IntegrityError）を発生させる
-        # 起源（きっかけ）となった、下位レイヤー（DBAPIドライバ）の元の例外を指します。
-        current_app.logger.error(f"Database integrity error: {error.orig}", exc_info=True)
-        response = {
-            "error_code": "DATABASE_CONFLICT",
-            "message": "The request could not be completed due to a conflict with the current state of the resource. This is often caused by a duplicate unique key."
-        }
-        return jsonify(response), 409
-
-    @app.errorhandler(NotFound)
-    def handle_not_found_error(error: NotFound):
-        """Handles resource not found errors (404 Not Found)."""
-        db.session.rollback()
-        # werkzeug's NotFound has a description attribute.
-        message = error.description or "The requested resource was not found."
-        current_app.logger.warning(f"Resource not found: {message}")
-        response = {
-            "error_code": "RESOURCE_NOT_FOUND",
-            "message": message
-        }
-        return jsonify(response), 404
-
-    @app.errorhandler(BadRequest)
-    def handle_bad_request_error(error: BadRequest):
-        """Handles generic bad requests (400 Bad Request)."""
-        db.session.rollback()
-        message = error.description or "The request was malformed or invalid."
-        current_app.logger.warning(f"Bad request: {message}")
-        response = {
-            "error_code": "BAD_REQUEST",
-            "message": message
-        }
-        return jsonify(response), 400
-
-    @app.errorhandler(ImageValidationError)
-    def handle_image_validation_error(error: ImageValidationError):
-        """Handles custom image validation errors (400 Bad Request)."""
-        db.session.rollback()
-        current_app.logger.warning(f"Image validation failed: {error}")
-        return jsonify({
-            "error_code": "IMAGE_VALIDATION_ERROR",
-            "message": str(error)
-        }), 400
-
-    @app.errorhandler(UnidentifiedImageError)
-    def handle_unidentified_image_error(error: UnidentifiedImageError):
-        """Handles cases where Pillow cannot identify the image format (400 Bad Request)."""
-        db.session.rollback()
-        current_app.logger.warning(f"Unidentified image error: {error}")
-        return jsonify({
-            "error_code": "INVALID_IMAGE_FORMAT",
-            "message": "The provided file could not be identified as an image."
-        }), 400
-
-    # UnidentifiedImageError is a subclass of OSError, so defining this handler after it is intuitive.
-    @app.errorhandler(OSError)
-    def handle_image_os_error(error: OSError):
-        """Handles OS-level errors from Pillow, e.g., reading a corrupted image (400 Bad Request)."""
-        db.session.rollback()
-        current_app.logger.warning(f"Image processing OSError: {error}")
-        return jsonify({
-            "error_code": "CORRUPTED_IMAGE_DATA",
-            "message": "The image data may be corrupted or in an unsupported format."
-        }), 400
+# --- 4xx Client Errors ---
 
+def handle_pydantic_validation_error(error: ValidationError, logger):
+    """Handles Pydantic's ValidationError (400 Bad Request)."""
+    # Pydantic v2では error.errors() で詳細なエラーリストが取得できる
+    logger.warning(f"Pydantic validation failed: {error.errors()}")
+    response = {
+        "error_code": "VALIDATION_ERROR",
+        "message": "Input validation failed.",
+        "details": error.errors()
+    }
+    return response, 400
 
-    # --- 5xx Server Errors ---
+def handle_database_integrity_error(error: IntegrityError, logger):
+    """Handles database integrity errors (e.g., duplicate unique keys) (409 Conflict)."""
+    # origは "original exception" の略で、SQLAlchemyが自身のエラー（IntegrityError）を発生させる
+    # 起源（きっかけ）となった、下位レイヤー（DBAPIドライバ）の元の例外を指します。
+    logger.error(f"Database integrity error: {error.orig}", exc_info=True)
+    response = {
+        "error_code": "DATABASE_CONFLICT",
+        "message": "The request could not be completed due to a conflict with the current state of the resource. This is often caused by a duplicate unique key."
+    }
+    return response, 409
 
-    @app.errorhandler(struct.error)
-    def handle_image_struct_error(error: struct.error):
-        """Handles low-level errors during image parsing (500 Internal Server Error)."""
-        db.session.rollback()
-        # This error is best treated as a server-side issue.
-        current_app.logger.error(f"Image parsing struct.error: {error}", exc_info=True)
-        return jsonify({
-            "error_code": "IMAGE_PARSING_ERROR",
-            "message": "An internal server error occurred during image parsing."
-        }), 500
-
-    @app.errorhandler(FileSystemError)
-    def handle_file_system_error(error: FileSystemError):
-        """Handles custom file system errors (500 Internal Server Error)."""
-        db.session.rollback()
-        # The full traceback is already logged in the remove_old_image function,
-        # but we can log again here to indicate it was caught at the top level.
-        current_app.logger.critical(f"A critical file system error was caught: {error}")
-        return jsonify({
-            "error_code": "FILE_SYSTEM_ERROR",
-            "message": str(error) or "A server-side error occurred while managing files."
-        }), 500
+def handle_not_found_error(error: NotFound, logger):
+    """Handles resource not found errors (404 Not Found)."""
+    # werkzeug's NotFound has a description attribute.
+    message = error.description or "The requested resource was not found."
+    logger.warning(f"Resource not found: {message}")
+    response = {
+        "error_code": "RESOURCE_NOT_FOUND",
+        "message": message
+    }
+    return response, 404
+
+def handle_bad_request_error(error: BadRequest, logger):
+    """Handles generic bad requests (400 Bad Request)."""
+    message = error.description or "The request was malformed or invalid."
+    logger.warning(f"Bad request: {message}")
+    response = {
+        "error_code": "BAD_REQUEST",
+        "message": message
+    }
+    return response, 400
+
+def handle_rate_limit_exceeded(error: RateLimitExceeded, logger):
+    """Handles requests rejected by the rate limiter (429 Too Many Requests)."""
+    logger.warning(f"Rate limit exceeded: {error.scope} by {error.key_type}, retry after {error.retry_after}s")
+    return {
+        "error_code": "RATE_LIMIT_EXCEEDED",
+        "message": error.description,
+        "retry_after": error.retry_after
+    }, 429, {"Retry-After": str(error.retry_after)}
+
+def handle_idempotency_key_reused(error: IdempotencyKeyReused, logger):
+    """Handles an Idempotency-Key reused for a different request (422 Unprocessable Entity)."""
+    logger.warning(f"Idempotency-Key reused: {error.description}")
+    return {
+        "error_code": "IDEMPOTENCY_KEY_REUSED",
+        "message": error.description
+    }, 422
+
+def handle_idempotency_key_in_progress(error: IdempotencyKeyInProgress, logger):
+    """Handles a retry that timed out waiting for the first request with the same key (409 Conflict)."""
+    logger.warning(f"Idempotency-Key still in progress, retry after {error.retry_after}s")
+    return {
+        "error_code": "IDEMPOTENCY_KEY_IN_PROGRESS",
+        "message": error.description
+    }, 409, {"Retry-After": str(error.retry_after)}
+
+def handle_image_validation_error(error: ImageValidationError, logger):
+    """Handles custom image validation errors (400 Bad Request)."""
+    logger.warning(f"Image validation failed: {error}")
+    return {
+        "error_code": "IMAGE_VALIDATION_ERROR",
+        "message": str(error)
+    }, 400
+
+def handle_unidentified_image_error(error: UnidentifiedImageError, logger):
+    """Handles cases where Pillow cannot identify the image format (400 Bad Request)."""
+    logger.warning(f"Unidentified image error: {error}")
+    return {
+        "error_code": "INVALID_IMAGE_FORMAT",
+        "message": "The provided file could not be identified as an image."
+    }, 400
+
+# UnidentifiedImageError is a subclass of OSError, so defining this handler after it is intuitive.
+def handle_image_os_error(error: OSError, logger):
+    """Handles OS-level errors from Pillow, e.g., reading a corrupted image (400 Bad Request)."""
+    logger.warning(f"Image processing OSError: {error}")
+    return {
+        "error_code": "CORRUPTED_IMAGE_DATA",
+        "message": "The image data may be corrupted or in an unsupported format."
+    }, 400
 
 
-    # --- The Ultimate Fallback: Generic Exception Handler ---
+# --- 5xx Server Errors ---
 
-    @app.errorhandler(Exception)
-    def handle_generic_exception(error: Exception):
-        """Catches all unhandled exceptions."""
+def handle_image_struct_error(error: struct.error, logger):
+    """Handles low-level errors during image parsing (500 Internal Server Error)."""
+    # This error is best treated as a server-side issue.
+    logger.error(f"Image parsing struct.error: {error}", exc_info=True)
+    return {
+        "error_code": "IMAGE_PARSING_ERROR",
+        "message": "An internal server error occurred during image parsing."
+    }, 500
+
+def handle_file_system_error(error: FileSystemError, logger):
+    """Handles custom file system errors (500 Internal Server Error)."""
+    # The full traceback is already logged in the remove_old_image function,
+    # but we can log again here to indicate it was caught at the top level.
+    logger.critical(f"A critical file system error was caught: {error}")
+    return {
+        "error_code": "FILE_SYSTEM_ERROR",
+        "message": str(error) or "A server-side error occurred while managing files."
+    }, 500
+
+
+# --- The Ultimate Fallback: Generic Exception Handler ---
+
+def handle_generic_exception(error: Exception, logger):
+    """Catches all unhandled exceptions."""
+    if isinstance(error, HTTPException):
+        # For standard HTTP errors from Werkzeug, use their properties.
+        code = error.code
+        error_code = error.name.upper().replace(" ", "_")
+        message = error.description
+        logger.warning(f"HTTPException caught: {code} - {error.name}")
+    else:
+        # For unexpected, non-HTTP errors, return a generic 500.
+        code = 500
+        error_code = "INTERNAL_SERVER_ERROR"
+        message = "An unexpected internal server error occurred. Please contact the administrator."
+        # Log the full stack trace for debugging.
+        logger.exception("An unhandled exception occurred")
+
+    response = {
+        "error_code": error_code,
+        "message": message
+    }
+    return response, code
+
+
+# Flaskと同様に、例外クラスのMROをたどって最も具体的なハンドラーが選ばれる
+ERROR_HANDLERS = {
+    ValidationError: handle_pydantic_validation_error,
+    IntegrityError: handle_database_integrity_error,
+    NotFound: handle_not_found_error,
+    BadRequest: handle_bad_request_error,
+    RateLimitExceeded: handle_rate_limit_exceeded,
+    IdempotencyKeyReused: handle_idempotency_key_reused,
+    IdempotencyKeyInProgress: handle_idempotency_key_in_progress,
+    ImageValidationError: handle_image_validation_error,
+    UnidentifiedImageError: handle_unidentified_image_error,
+    OSError: handle_image_os_error,
+    struct.error: handle_image_struct_error,
+    FileSystemError: handle_file_system_error,
+    Exception: handle_generic_exception,
+}
+
+
+def build_error_response(error: Exception, logger):
+    """Returns (body, status) or (body, status, headers) using the most specific handler in ERROR_HANDLERS."""
+    for cls in type(error).__mro__:
+        if cls in ERROR_HANDLERS:
+            return ERROR_HANDLERS[cls](error, logger)
+    return handle_generic_exception(error, logger)
+
+
+# JWT関連のエラーレスポンス。flask-jwt-extendedのローダーとASGIアプリの認証処理で共有する
+JWT_ERROR_RESPONSES = {
+    "user_not_found": ({"message": "User not found.", "error_code": "USER_NOT_FOUND"}, 404),
+    "expired": ({"message": "The token has expired", "error_code": "TOKEN_EXPIRED"}, 401),
+    "invalid": ({"message": "Signature verification failed. The token is invalid.", "error_code": "INVALID_TOKEN"}, 401),
+    "missing": ({"message": "Request does not contain an access token.", "error_code": "AUTHORIZATION_REQUIRED"}, 401),
+    "revoked": ({"message": "The token has been revoked.", "error_code": "TOKEN_REVOKED"}, 401),
+}
+
+
+def _flask_error_handler(build_response):
+    def handler(error):
         db.session.rollback()
-        if isinstance(error, HTTPException):
-            # For standard HTTP errors from Werkzeug, use their properties.
-            code = error.code
-            error_code = error.name.upper().replace(" ", "_")
-            message = error.description
-            current_app.logger.warning(f"HTTPException caught: {code} - {error.name}")
-        else:
-            # For unexpected, non-HTTP errors, return a generic 500.
-            code = 500
-            error_code = "INTERNAL_SERVER_ERROR"
-            message = "An unexpected internal server error occurred. Please contact the administrator."
-            # Log the full stack trace for debugging.
-            current_app.logger.exception("An unhandled exception occurred")
-
-        response = {
-            "error_code": error_code,
-            "message": message
-        }
-        return jsonify(response), code
+        body, *rest = build_response(error, current_app.logger)
+        return jsonify(body), *rest
+    handler.__name__ = build_response.__name__
+    handler.__doc__ = build_response.__doc__
+    return handler
+
+
+def register_error_handlers(app):
+    """Registers custom error handlers for the Flask application."""
+
+    for exc_class, build_response in ERROR_HANDLERS.items():
+        app.register_error_handler(exc_class, _flask_error_handler(build_response))
 
 
     # user_lookup_loaderの結果、ユーザーが見つからなかった時(None)のエラーを処理するローダー
@@ -156,49 +218,39 @@ def register_error_handlers(app):
     @jwt.user_lookup_error_loader
     def user_lookup_error_callback(_jwt_header, jwt_data):
         current_app.logger.error(f"user_lookup_loaderでユーザーが見つからなかったようです")
-        return jsonify({
-            "message": "User not found.",
-            "error_code": "USER_NOT_FOUND"
-        }), 404 # 404ステータスコードを返すこともできる
+        body, status = JWT_ERROR_RESPONSES["user_not_found"]
+        return jsonify(body), status # 404ステータスコードを返すこともできる
 
 
     # アクセストークンだけでなくリフレッシュトークンが期限切れになったときにも呼び出されます。
     @jwt.expired_token_loader
     def expired_token_callback(jwt_header, jwt_payload):
         user_identity = jwt_payload.get('sub', 'Unknown user')
-        current_app.logger.info(f"トークンが期限切れのようです。TOKEN_EXPIREDのコードを返します。 User: {user_identity}")
-        return jsonify({
-            "message": "The token has expired",
-            "error_code": "TOKEN_EXPIRED"
-        }), 401
+        current_app.logger.debug(f"トークンが期限切れのようです。TOKEN_EXPIREDのコードを返します。 User: {user_identity}")
+        body, status = JWT_ERROR_RESPONSES["expired"]
+        return jsonify(body), status
 
 
     # トークンが不正な形式の場合（署名改ざんなど）
     @jwt.invalid_token_loader
     def invalid_token_callback(error): # error引数は必須
-        current_app.logger.info(f"正しくないトークンです: {error}")
-        return jsonify({
-            "message": "Signature verification failed. The token is invalid.",
-            "error_code": "INVALID_TOKEN"
-        }), 401
+        current_app.logger.debug(f"正しくないトークンです: {error}")
+        body, status = JWT_ERROR_RESPONSES["invalid"]
+        return jsonify(body), status
 
 
     # トークンが提供されなかった場合
     @jwt.unauthorized_loader
     def missing_token_callback(reason): # error引数は必須
-        current_app.logger.info(f"トークンが存在しないようです: {reason}")
-        return jsonify({
-            "message": "Request does not contain an access token.",
-            "error_code": "AUTHORIZATION_REQUIRED"
-        }), 401
+        current_app.logger.debug(f"トークンが存在しないようです: {reason}")
+        body, status = JWT_ERROR_RESPONSES["missing"]
+        return jsonify(body), status
 
 
     # 失効済みのトークンが使用された場合
     @jwt.revoked_token_loader
     def revoked_token_callback(jwt_header, jwt_payload):
-        current_app.logger.info(f"トークンがブロックリストの中に入っているようです")
-        return jsonify({
-            "message": "The token has been revoked.",
-            "error_code": "TOKEN_REVOKED"
-        }), 401
+        current_app.logger.debug(f"トークンがブロックリストの中に入っているようです")
+        body, status = JWT_ERROR_RESPONSES["revoked"]
+        return jsonify(body), status
 
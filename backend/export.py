@@ -0,0 +1,99 @@
+"""
+Streaming export of the catalog (GET /api/admin/export/sneakers).
+
+一覧(get_items)のper_pageはITEMS_MAX_PER_PAGEまでに制限しているので、全件が必要な管理者向けのクライアントは
+こちらを使う。行はyield_per(EXPORT_YIELD_PER件ずつ。PostgreSQLなどではサーバーサイドカーソル)で読み、
+1件ずつJSONにしてEXPORT_CHUNK_BYTESごとに送り出すので、カタログの大きさに関係なくメモリ使用量は一定になる。
+
+    ?format=ndjson  1行に1件(application/x-ndjson)。既定
+    ?format=json    {"items": [...]}(get_itemsのitemsと同じ形)
+    ?q=...          get_itemsと同じ検索
+"""
+import json
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import select, or_
+from werkzeug.exceptions import BadRequest
+
+from backend.models.sneaker import Sneaker
+from backend.schemas.sneaker import ReadSneaker
+
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+
+
+def parse_format(value: str | None) -> str:
+    value = value or 'ndjson'
+    if value not in FORMATS:
+        raise BadRequest(f"format must be one of: {', '.join(FORMATS)}")
+    return value
+
+
+def export_stmt(q: str, yield_per: int):
+    stmt = select(Sneaker)
+    if q:
+        stmt = stmt.where(or_(
+            Sneaker.name.ilike(f"%{q}%"),
+            Sneaker.description.ilike(f"%{q}%"),
+            Sneaker.category.ilike(f"%{q}%")
+        ))
+    return stmt.order_by(Sneaker.id).execution_options(yield_per=yield_per)
+
+
+def encode(sneaker) -> str:
+    # jsonifyと同じ形式(キーの並び、日時、Decimal)にする
+    return json.dumps(ReadSneaker.model_validate(sneaker).model_dump(), default=DefaultJSONProvider.default,
+                      sort_keys=True, separators=(',', ':'))
+
+
+class ChunkWriter:
+    """Frames encoded rows as NDJSON or a JSON document and groups them into chunks of about chunk_bytes."""
+
+    def __init__(self, fmt: str, chunk_bytes: int):
+        self.fmt = fmt
+        self.chunk_bytes = chunk_bytes
+        self._parts = ['{"items":['] if fmt == 'json' else []
+        self._size = 0
+        self._first = True
+
+    def add(self, sneaker) -> str | None:
+        """Adds one row; returns a chunk to send when the buffer is full."""
+        row = encode(sneaker)
+        if self.fmt == 'ndjson':
+            row += '\n'
+        elif not self._first:
+            row = ',' + row
+        self._first = False
+        self._parts.append(row)
+        self._size += len(row)
+        if self._size < self.chunk_bytes:
+            return None
+        return self._flush()
+
+    def close(self) -> str:
+        if self.fmt == 'json':
+            self._parts.append(']}\n')
+        return self._flush()
+
+    def _flush(self) -> str:
+        chunk = ''.join(self._parts)
+        self._parts, self._size = [], 0
+        return chunk
+
+
+def stream(sneakers, fmt: str, chunk_bytes: int):
+    """Yields the export from an iterable of Sneaker rows (the result of export_stmt)."""
+    writer = ChunkWriter(fmt, chunk_bytes)
+    for sneaker in sneakers:
+        if chunk := writer.add(sneaker):
+            yield chunk
+    yield writer.close()
+
+
+async def astream(sneakers, fmt: str, chunk_bytes: int):
+    """Async counterpart of stream() for AsyncSession.stream() results."""
+    writer = ChunkWriter(fmt, chunk_bytes)
+    async for sneaker in sneakers:
+        if chunk := writer.add(sneaker):
+            yield chunk
+    yield writer.close()
@@ -1,7 +1,90 @@
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask_sqlalchemy.session import Session
 from flask_jwt_extended import JWTManager
+from sqlalchemy.sql.dml import UpdateBase
+
+from backend.cache import Cache
+from backend.coalescing import RequestCoalescer
+from backend.compression import Compressor
+from backend.faults import FaultInjector
+from backend.passwords import PasswordHasher
+from backend.ratelimit import RateLimiter
+
+
+class RoutingSession(Session):
+    """
+    A session that sends reads to the 'replica' bind while a view is marked read-only.
+
+    Writes (flushes and INSERT/UPDATE/DELETE statements) always go to the primary,
+    and any write is remembered on `g` so that ReplicaRouter can pin the client to
+    the primary for a short read-your-writes window.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            is_write = self._flushing or isinstance(clause, UpdateBase)
+            if is_write:
+                g.db_wrote = True
+            elif g.get('use_replica') and 'replica' in self._db.engines:
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Read/write routing helper.
+
+    SQLALCHEMY_BINDS['replica']が設定されている場合のみ有効になる。
+    書き込みを行ったクライアントにはクッキーを発行し、READ_YOUR_WRITES_SECONDSの間は
+    read-onlyのビューであってもプライマリから読むようにする(レプリカの遅延対策)。
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+        app.config.setdefault('READ_YOUR_WRITES_COOKIE', 'rw_pin_until')
+        app.extensions['replica_router'] = self
+        app.after_request(self._pin_writer_to_primary)
+
+    @property
+    def enabled(self) -> bool:
+        return 'replica' in db.engines
+
+    def should_use_replica(self) -> bool:
+        """Returns False while the current client is inside its read-your-writes window."""
+        if not self.enabled:
+            return False
+        if not has_request_context():
+            return True
+        pinned_until = request.cookies.get(current_app.config['READ_YOUR_WRITES_COOKIE'], type=float)
+        return not (pinned_until and pinned_until > time.time())
+
+    def _pin_writer_to_primary(self, response):
+        if g.get('db_wrote') and self.enabled:
+            window = current_app.config['READ_YOUR_WRITES_SECONDS']
+            response.set_cookie(
+                current_app.config['READ_YOUR_WRITES_COOKIE'],
+                str(time.time() + window),
+                max_age=window,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
 
-db = SQLAlchemy()
-migrate = Migrate()
-jwt = JWTManager()
\ No newline at end of file
+# expire_on_commit=False: コミット後にレスポンスを組み立てる際、属性を読み直すSELECTが発行されないようにする
+db = SQLAlchemy(session_options={'class_': RoutingSession, 'expire_on_commit': False})
+jwt = JWTManager()
+replica_router = ReplicaRouter()
+password_hasher = PasswordHasher()
+limiter = RateLimiter()
+compressor = Compressor()
+coalescer = RequestCoalescer()
+fault_injector = FaultInjector()
+cache = Cache()
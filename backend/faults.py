@@ -0,0 +1,207 @@
+"""
+Config-driven latency and fault injection.
+
+以前は各ビューの先頭で time.sleep(1) していたが(ローディング表示などのUX確認用)、本番でもワーカーが
+1秒ずつ塞がってしまうので、設定で有効にしたときだけエンドポイントごとに遅延やエラーを注入する形にした。
+
+ルール(FAULT_INJECTION_RULES)は上から順に照合し、最初に一致したものを使う:
+
+    {'endpoint': 'sneakers.*',            # エンドポイント名のglob(リストも可)。'blueprint名.関数名'
+     'methods': ['GET'],                  # 省略するとすべてのメソッド
+     'latency': 'uniform:0.2:1.5',        # 秒数、または 'fixed:s' / 'uniform:min:max' / 'normal:mean:stddev' / 'exponential:mean'
+     'error_rate': 0.1,                   # この割合のリクエストをerror_statusで失敗させる
+     'error_status': 503,
+     'db_latency': 0.05}                  # SQLの実行ごとに足す遅延(遅いDBの再現)
+
+FAULT_INJECTION_ALLOW_HEADER を有効にすると、ベンチマークのツールなどから
+`X-Fault-Injection: latency=normal:0.3:0.1; error_rate=0.05; db_latency=0.01` のように
+リクエストごとに指定することもできる(ルールより優先される)。どのクライアントからでも送れるので既定では無効で、
+ProductionConfigでは常に無効。遅延は FAULT_INJECTION_MAX_LATENCY / FAULT_INJECTION_MAX_DB_LATENCY(秒)を上限とし、
+これを超える指定や範囲外のerror_rate・error_statusは400で拒否する(ルールの場合は起動時にエラー)。
+分布から引いた遅延も上限で切るので、1つのリクエストがワーカーを上限より長く塞ぐことはない。
+"""
+import asyncio
+import fnmatch
+import math
+import random
+import time
+from contextvars import ContextVar
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.util.concurrency import await_only, in_greenlet
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError, default_exceptions
+
+
+HEADER = 'X-Fault-Injection'
+
+# 現在のリクエストで、SQLの実行ごとに足す遅延(秒)
+db_latency_var: ContextVar[float] = ContextVar('fault_db_latency', default=0.0)
+
+
+def parse_latency(value) -> tuple:
+    """Number or 'distribution:params...' -> (distribution, params)."""
+    if isinstance(value, (int, float)):
+        name, params = 'fixed', (float(value),)
+    else:
+        name, *params = str(value).split(':')
+        if not params:
+            name, params = 'fixed', [name]
+        params = tuple(float(p) for p in params)
+    expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'exponential': 1}.get(name)
+    # nanやinfは上限との比較をすり抜けるので受け付けない
+    if expected is None or len(params) != expected or not all(math.isfinite(p) for p in params):
+        raise ValueError(f"Invalid latency spec: {value!r}")
+    return name, params
+
+
+def sample_latency(spec, maximum: float | None = None) -> float:
+    if spec is None:
+        return 0.0
+    name, params = spec
+    if name == 'fixed':
+        seconds = params[0]
+    elif name == 'uniform':
+        seconds = random.uniform(*params)
+    elif name == 'normal':
+        seconds = random.gauss(*params)
+    else:
+        seconds = random.expovariate(1 / params[0]) if params[0] > 0 else 0.0
+    seconds = max(0.0, seconds)
+    # normalやexponentialは上限の無い分布なので、引いた値を上限で切る
+    return seconds if maximum is None else min(seconds, maximum)
+
+
+class Fault:
+    """What to do to one request: sleep `latency` seconds, then fail with `error` (if any)."""
+
+    def __init__(self, latency: float = 0.0, error: HTTPException | None = None, db_latency: float = 0.0):
+        self.latency = latency
+        self.error = error
+        self.db_latency = db_latency
+
+
+class Rule:
+    def __init__(self, endpoint='*', methods=None, latency=None, error_rate=0.0, error_status=503, db_latency=0.0,
+                 max_latency: float | None = None, max_db_latency: float | None = None):
+        self.endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint)
+        self.methods = {m.upper() for m in methods} if methods else None
+        self.latency = parse_latency(latency) if latency is not None else None
+        self.error_rate = float(error_rate)
+        self.error_status = int(error_status)
+        self.db_latency = float(db_latency)
+        self.max_latency = max_latency
+        if not 0.0 <= self.error_rate <= 1.0:
+            raise ValueError(f"error_rate must be between 0 and 1: {error_rate!r}")
+        if not 400 <= self.error_status <= 599:
+            raise ValueError(f"error_status must be a 4xx or 5xx status: {error_status!r}")
+        # 分布のパラメータ(fixedの秒数、uniformの上端、normalの平均など)がどれも上限以下であること
+        if self.latency is not None and max_latency is not None and max(self.latency[1]) > max_latency:
+            raise ValueError(f"latency exceeds the maximum of {max_latency}s: {latency!r}")
+        if not 0.0 <= self.db_latency <= (max_db_latency if max_db_latency is not None else float('inf')):
+            raise ValueError(f"db_latency must be between 0 and {max_db_latency}s: {db_latency!r}")
+
+    @classmethod
+    def from_header(cls, value: str, **limits) -> 'Rule':
+        options = {}
+        for item in value.split(';'):
+            key, sep, option = item.partition('=')
+            if sep:
+                options[key.strip()] = option.strip()
+        return cls(**{key: options[key] for key in ('latency', 'error_rate', 'error_status', 'db_latency')
+                      if key in options}, **limits)
+
+    def matches(self, endpoint: str, method: str) -> bool:
+        if self.methods is not None and method not in self.methods:
+            return False
+        return any(fnmatch.fnmatchcase(endpoint, pattern) for pattern in self.endpoints)
+
+    def draw(self) -> Fault:
+        error = None
+        if self.error_rate and random.random() < self.error_rate:
+            error = default_exceptions.get(self.error_status, InternalServerError)(
+                description=f"Injected fault ({self.error_status})")
+        return Fault(sample_latency(self.latency, self.max_latency), error, self.db_latency)
+
+
+class FaultInjector:
+    """
+    Decides per request whether to inject latency, an error or slow SQL.
+
+    Flaskアプリではbefore_requestで、ASGIアプリ(backend/aio)ではendpoint()の中で plan() を呼び、
+    それぞれ time.sleep / asyncio.sleep で遅延させる。遅いDBはエンジンのbefore_cursor_executeで再現する。
+    """
+
+    def __init__(self, app=None):
+        self.rules = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FAULT_INJECTION_ENABLED', False)
+        app.config.setdefault('FAULT_INJECTION_RULES', [])
+        app.config.setdefault('FAULT_INJECTION_ALLOW_HEADER', False)
+        app.config.setdefault('FAULT_INJECTION_MAX_LATENCY', 5.0)
+        app.config.setdefault('FAULT_INJECTION_MAX_DB_LATENCY', 0.5)
+        # 設定の誤り(上限を超える遅延も含む)は最初のリクエストではなく起動時に気付けるようにする
+        self.rules = [Rule(**rule, **self._limits(app.config)) for rule in app.config['FAULT_INJECTION_RULES']]
+        app.extensions['fault_injector'] = self
+        if not app.config['FAULT_INJECTION_ENABLED']:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', _slow_db):
+            event.listen(Engine, 'before_cursor_execute', _slow_db)
+        app.before_request(self._inject)
+        app.teardown_request(self._reset)
+
+    def plan(self, config, endpoint: str | None, method: str, header: str | None = None) -> Fault | None:
+        """The fault to inject into a request, or None. `endpoint` is 'blueprint.function'."""
+        # CORSのプリフライトには注入しない
+        if not config['FAULT_INJECTION_ENABLED'] or method == 'OPTIONS':
+            return None
+        if header and config['FAULT_INJECTION_ALLOW_HEADER']:
+            try:
+                rule = Rule.from_header(header, **self._limits(config))
+            except (TypeError, ValueError) as error:
+                raise BadRequest(f"Invalid {HEADER} header: {error}")
+            return rule.draw()
+        if endpoint is None:
+            return None
+        for rule in self.rules:
+            if rule.matches(endpoint, method):
+                return rule.draw()
+        return None
+
+    # --- internals ---
+
+    @staticmethod
+    def _limits(config) -> dict:
+        return {'max_latency': config['FAULT_INJECTION_MAX_LATENCY'],
+                'max_db_latency': config['FAULT_INJECTION_MAX_DB_LATENCY']}
+
+    def _inject(self):
+        fault = self.plan(current_app.config, request.endpoint, request.method, request.headers.get(HEADER))
+        if fault is None:
+            return
+        db_latency_var.set(fault.db_latency)
+        if fault.latency:
+            time.sleep(fault.latency)
+        if fault.error is not None:
+            current_app.logger.debug(f"Injected fault: {fault.error.code} {request.method} {request.path}")
+            raise fault.error
+
+    @staticmethod
+    def _reset(exc):
+        db_latency_var.set(0.0)
+
+
+def _slow_db(conn, cursor, statement, parameters, context, executemany):
+    # 注入が無いリクエストではContextVarを読むだけ
+    seconds = db_latency_var.get()
+    if not seconds:
+        return
+    if in_greenlet():
+        # ASGIアプリのasyncエンジンからの呼び出し。イベントループを止めないようにawaitで待つ
+        await_only(asyncio.sleep(seconds))
+    else:
+        time.sleep(seconds)
@@ -0,0 +1,235 @@
+"""
+Idempotency-Key support for the POST/PATCH endpoints.
+
+クライアントやプロキシがタイムアウトしたリクエストを再送しても二重に作成されないよう、
+Idempotency-Keyヘッダー付きのリクエストは最初のレスポンス(ステータス、ヘッダー、ボディとそのハッシュ)を
+idempotency_keys テーブルに保存し、同じキーの再送には処理を再実行せずに保存したレスポンスを返す。
+
+    1. 最初のリクエストが (scope, key) の行を 'pending' で挿入し(ユニーク制約で1つだけが成功する)、処理を行う
+    2. 処理中に届いた同じキーのリクエストは、行が 'completed' になるまで待ってから同じレスポンスを返す
+       (IDEMPOTENCY_WAIT_TIMEOUT秒を超えた場合は409)
+    3. 同じキーで内容の異なるリクエストが送られてきた場合は422
+    4. 処理が例外や5xxで終わった場合は行を削除し、再送で改めて処理できるようにする
+
+行はIDEMPOTENCY_TTL_SECONDS秒で期限切れになる。'pending'のまま IDEMPOTENCY_LOCK_SECONDS 秒を過ぎた行は
+処理中にワーカーが落ちたものとみなし、次のリクエストが引き継ぐ。
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import BadRequest, Conflict, UnprocessableEntity
+
+from backend.extensions import db
+from backend.models.idempotency_key import IdempotencyKey
+
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# 保存して再送時に返すレスポンスヘッダー(Set-Cookieなどは保存しない)。ASGIアプリのヘッダー名は小文字なので小文字で引く
+REPLAYED_HEADERS = {'content-type': 'Content-Type', 'location': 'Location'}
+# 他のリクエストが処理中の場合に、行が完了したかどうかを確認する間隔(秒)
+POLL_INTERVAL = 0.2
+# try_begin()が返す「他のリクエストが処理中」を表す値
+PENDING = object()
+
+
+class IdempotencyKeyReused(UnprocessableEntity):
+    """The key was already used for a request with a different method, path or body (422)."""
+
+    def __init__(self):
+        super().__init__(description="This Idempotency-Key was already used for a different request.")
+
+
+class IdempotencyKeyInProgress(Conflict):
+    """The first request with this key is still being processed (409)."""
+
+    def __init__(self, retry_after: int = 1):
+        super().__init__(description="A request with this Idempotency-Key is still being processed.")
+        self.retry_after = retry_after
+
+
+def validate_key(key: str) -> str:
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise BadRequest(f"{HEADER} must be between 1 and {MAX_KEY_LENGTH} characters.")
+    return key
+
+
+def fingerprint(method: str, path: str, body: bytes = b'', fields=(), files=()) -> str:
+    """
+    sha256 of the request. For form requests pass the parsed `fields` [(name, value)] and
+    `files` [(name, filename, content)] instead of the raw body, whose multipart boundary
+    changes on every retry.
+    """
+    h = hashlib.sha256(f"{method} {path}\n".encode())
+    h.update(_canonical_json(body))
+    for name, value in sorted(fields):
+        h.update(f"{name}={value}\n".encode())
+    for name, filename, content in sorted(files, key=lambda f: (f[0], f[1] or '')):
+        h.update(f"{name}:{filename}:".encode())
+        h.update(hashlib.sha256(content).digest())
+    return h.hexdigest()
+
+
+def _canonical_json(body: bytes) -> bytes:
+    # クライアントによって空白やキーの順序が異なっても同じリクエストとみなせるよう、JSONは正規化する
+    if body.lstrip()[:1] not in (b'{', b'['):
+        return body
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+    except ValueError:
+        return body
+
+
+class StoredResponse:
+    def __init__(self, status: int, headers: dict, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyStore:
+    """
+    Claims keys and stores responses in the idempotency_keys table.
+
+    リクエストのトランザクションとは独立した短いセッションで読み書きするので、'pending'の行は
+    すぐに他のワーカーから見えるようになり、ビューがロールバックしても消えない。
+    """
+
+    def __init__(self, app=None):
+        self.ttl_seconds = 24 * 3600
+        self.lock_seconds = 60
+        self.wait_timeout = 10.0
+        self._last_purge = 0.0
+        # 同じプロセス内の待機中のリクエストを、ポーリングを待たずに起こすためのイベント
+        self._events = {}
+        self._events_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDEMPOTENCY_TTL_SECONDS', 24 * 3600)
+        app.config.setdefault('IDEMPOTENCY_LOCK_SECONDS', 60)
+        app.config.setdefault('IDEMPOTENCY_WAIT_TIMEOUT', 10)
+        self.ttl_seconds = app.config['IDEMPOTENCY_TTL_SECONDS']
+        self.lock_seconds = app.config['IDEMPOTENCY_LOCK_SECONDS']
+        self.wait_timeout = app.config['IDEMPOTENCY_WAIT_TIMEOUT']
+        app.extensions['idempotency_store'] = self
+
+    # --- public API ---
+
+    def begin(self, scope: str, key: str, request_fingerprint: str) -> StoredResponse | None:
+        """
+        Claims the key. Returns None when the caller should process the request, or the stored
+        response to replay. Raises IdempotencyKeyReused / IdempotencyKeyInProgress.
+        Blocks (in a worker thread) while another request with the same key is being processed.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        try:
+            while True:
+                result = self.try_begin(scope, key, request_fingerprint)
+                if result is not PENDING:
+                    return result
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise IdempotencyKeyInProgress()
+                self._local_event(scope, key).wait(min(POLL_INTERVAL, remaining))
+        finally:
+            # 最初のリクエストが他のワーカーで処理された場合はイベントが残るので、ここで片付ける
+            with self._events_lock:
+                self._events.pop((scope, key), None)
+
+    def try_begin(self, scope: str, key: str, request_fingerprint: str):
+        """Non-blocking begin(): returns None, a StoredResponse or PENDING (used by the ASGI app)."""
+        self._purge_expired()
+        now = datetime.now(timezone.utc)
+        with Session(db.engine) as session:
+            session.add(IdempotencyKey(
+                scope=scope, key=key, fingerprint=request_fingerprint, state='pending',
+                created_at=now, expires_at=now + timedelta(seconds=self.ttl_seconds),
+            ))
+            try:
+                session.commit()
+                return None
+            except IntegrityError:
+                session.rollback()
+
+            record = session.execute(
+                select(IdempotencyKey).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            ).scalar_one_or_none()
+            if record is None:
+                # 先に挿入していたリクエストが失敗して行を削除した。もう一度取りに行く
+                return PENDING
+            if _as_utc(record.expires_at) <= now or (
+                    record.state == 'pending' and _as_utc(record.created_at) <= now - timedelta(seconds=self.lock_seconds)):
+                # 期限切れ、もしくは処理中のまま放置された行は削除して引き継ぐ
+                session.delete(record)
+                session.commit()
+                return PENDING
+            if record.fingerprint != request_fingerprint:
+                raise IdempotencyKeyReused()
+            if record.state == 'pending':
+                return PENDING
+            return StoredResponse(record.response_status, record.response_headers or {}, record.response_body or b'')
+
+    def complete(self, scope: str, key: str, status: int, headers, body: bytes):
+        """Stores the response of the request that claimed the key. 5xx responses release it instead."""
+        if status >= 500:
+            self.release(scope, key)
+            return
+        with Session(db.engine) as session:
+            record = session.execute(
+                select(IdempotencyKey).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            ).scalar_one_or_none()
+            if record is not None:
+                record.state = 'completed'
+                record.response_status = status
+                record.response_headers = {
+                    REPLAYED_HEADERS[name.lower()]: value for name, value in headers if name.lower() in REPLAYED_HEADERS
+                }
+                record.response_body = body
+                record.response_hash = hashlib.sha256(body).hexdigest()
+                session.commit()
+        self._notify(scope, key)
+
+    def release(self, scope: str, key: str):
+        """Deletes the claim so that a retry processes the request again."""
+        with Session(db.engine) as session:
+            session.execute(delete(IdempotencyKey).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key))
+            session.commit()
+        self._notify(scope, key)
+
+    # --- internals ---
+
+    def _purge_expired(self):
+        # 期限切れの行の削除は1分に1回、リクエストのついでに行う
+        if time.monotonic() - self._last_purge < 60:
+            return
+        self._last_purge = time.monotonic()
+        with Session(db.engine) as session:
+            session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.now(timezone.utc)))
+            session.commit()
+
+    def _local_event(self, scope: str, key: str) -> threading.Event:
+        with self._events_lock:
+            return self._events.setdefault((scope, key), threading.Event())
+
+    def _notify(self, scope: str, key: str):
+        with self._events_lock:
+            event = self._events.pop((scope, key), None)
+        if event is not None:
+            event.set()
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLiteはタイムゾーンを保存しないので、読み出した値はnaiveなUTCになる
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+idempotency_store = IdempotencyStore()
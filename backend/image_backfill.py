@@ -0,0 +1,228 @@
+"""
+Re-encoding of the stored images after the image settings change (`flask images backfill`).
+
+IMAGE_FORMAT / IMAGE_MAX_DIMENSION / IMAGE_QUALITY を変えたあとに実行すると、Sneaker.image_filenameから
+参照されている画像のうち設定に合わないもの(形式が違う、長辺が大きすぎる)をプロセスプールで作り直す。
+
+- 進捗はimage_backfillテーブル(backend/models/image_backfill.py)にIMAGE_BACKFILL_BATCH_SIZE件ごとに
+  コミットする。中断しても、再実行すれば同じ設定で処理済みの画像はファイルを開かずにスキップされる。
+- --verify を付けると処理済みの画像もハッシュを比べ、記録と内容が同じならデコードせずにスキップする。
+- ワーカーはJPEGを縮小しながらデコードし(draft)、IMAGE_BACKFILL_TASKS_PER_CHILD件ごとに作り直すので、
+  メモリ使用量は画像1枚分程度に収まる。メインプロセスが持つのも1バッチ分の行だけ。
+- 形式が変わる場合は拡張子を変えた新しいファイルに書き、行のimage_filenameを書き換える。
+  元のファイルはどの行からも参照されなくなるので、`flask images gc` で消える。
+
+新しくアップロードされた画像はimage_backfillに行が無いので、次回の実行で処理される。
+"""
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import delete, insert, select, update
+
+from backend.extensions import db
+from backend.models.image_backfill import ImageBackfill
+from backend.models.sneaker import Sneaker
+from backend.utils_image import MAX_WIDTH, MAX_HEIGHT
+
+
+# 出力できる形式と、そのときの拡張子
+OUTPUT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+EXTENSION_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF'}
+HASH_CHUNK_SIZE = 1024 * 1024
+# 結果のstatusのうち、image_backfillに記録するもの
+DONE_STATUSES = ('unchanged', 'conforming', 'reencoded')
+
+
+def profile_of(config) -> str:
+    """The checkpoint key of the current settings, e.g. 'keep:2000:85'."""
+    return f"{config['IMAGE_FORMAT']}:{config['IMAGE_MAX_DIMENSION']}:{config['IMAGE_QUALITY']}"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_image(filename: str, recorded_sha256: str | None, settings: dict) -> dict:
+    """
+    Runs in a pool worker (no app context). Re-encodes one image if it does not match the settings.
+
+    recorded_sha256は同じ設定で処理済みの場合の記録されたハッシュ。ファイルの内容が同じならデコードしない。
+    """
+    # Pillowはワーカーでしか使わない
+    from PIL import Image, ImageOps
+    Image.MAX_IMAGE_PIXELS = MAX_WIDTH * MAX_HEIGHT
+
+    path = os.path.join(settings['upload_folder'], filename)
+    result = {'filename': filename, 'new_filename': filename, 'status': None,
+              'sha256': None, 'bytes_in': 0, 'bytes_out': 0, 'error': None}
+    try:
+        result['bytes_in'] = os.path.getsize(path)
+        digest = file_sha256(path)
+        if digest == recorded_sha256:
+            return dict(result, status='unchanged', sha256=digest, bytes_out=result['bytes_in'])
+
+        with Image.open(path) as img:
+            source_format = 'JPEG' if img.format == 'MPO' else img.format
+            target_format = source_format if settings['format'] == 'keep' else settings['format']
+            max_dimension = settings['max_dimension']
+            too_large = bool(max_dimension) and max(img.size) > max_dimension
+            if getattr(img, 'n_frames', 1) > 1 or (too_large and target_format not in OUTPUT_EXTENSIONS):
+                # アニメーションGIFなど、作り直すと失われるものがある画像はそのままにする
+                return dict(result, status='skipped', error=f"cannot re-encode {img.format}")
+            if target_format == source_format and not too_large:
+                return dict(result, status='conforming', sha256=digest, bytes_out=result['bytes_in'])
+
+            if max_dimension and source_format == 'JPEG':
+                # 縮小後の大きさに近い解像度でデコードし、元の大きさのビットマップを作らない
+                img.draft('RGB', (max_dimension, max_dimension))
+            output = ImageOps.exif_transpose(img)
+            if max_dimension:
+                output.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            if target_format == 'JPEG' and output.mode not in ('RGB', 'L'):
+                output = output.convert('RGB')
+
+            new_filename = filename
+            if EXTENSION_FORMATS.get(os.path.splitext(filename)[1].lower()) != target_format:
+                new_filename = os.path.splitext(filename)[0] + OUTPUT_EXTENSIONS[target_format]
+            new_path = os.path.join(settings['upload_folder'], new_filename)
+            # 書き終わるまで元の名前では見えないよう、一時ファイル(image_gcが対象にしないドット始まり)に書いて置き換える
+            temp_path = os.path.join(settings['upload_folder'], f".{new_filename}.{os.getpid()}.tmp")
+            try:
+                output.save(temp_path, target_format, quality=settings['quality'], optimize=True)
+                os.replace(temp_path, new_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        return dict(result, status='reencoded', new_filename=new_filename,
+                    sha256=file_sha256(new_path), bytes_out=os.path.getsize(new_path))
+    except FileNotFoundError:
+        return dict(result, status='missing')
+    except Exception as e:
+        return dict(result, status='failed', error=f"{type(e).__name__}: {e}")
+
+
+class BackfillReport:
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.counts = dict.fromkeys(('checkpointed', *DONE_STATUSES, 'skipped', 'missing', 'failed'), 0)
+        self.renamed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def processed(self) -> int:
+        return sum(count for status, count in self.counts.items() if status != 'checkpointed')
+
+    def add(self, result: dict):
+        self.counts[result['status']] += 1
+        self.bytes_in += result['bytes_in']
+        self.bytes_out += result['bytes_out']
+        self.elapsed = time.monotonic() - self.started
+
+    def throughput(self) -> str:
+        seconds = max(self.elapsed, 1e-9)
+        return f"{self.processed / seconds:.1f} images/s, {self.bytes_in / seconds / 1024 / 1024:.1f} MB/s read"
+
+
+def run_backfill(workers: int | None = None, batch_size: int | None = None, verify: bool = False,
+                 limit: int | None = None, on_batch=None, on_result=None) -> BackfillReport:
+    """
+    Processes every referenced image that is not checkpointed with the current settings. Requires an app context.
+    on_batch(report) is called after each committed batch, on_result(result) for each processed image.
+    """
+    config = current_app.config
+    profile = profile_of(config)
+    settings = {
+        'upload_folder': config['UPLOAD_FOLDER'],
+        'format': config['IMAGE_FORMAT'],
+        'max_dimension': config['IMAGE_MAX_DIMENSION'],
+        'quality': config['IMAGE_QUALITY'],
+    }
+    if settings['format'] != 'keep' and settings['format'] not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"Unsupported IMAGE_FORMAT: {settings['format']}")
+    workers = workers or config['IMAGE_BACKFILL_WORKERS'] or os.cpu_count() or 1
+    batch_size = batch_size or config['IMAGE_BACKFILL_BATCH_SIZE']
+    report = BackfillReport(profile)
+
+    context = multiprocessing.get_context(config['IMAGE_BACKFILL_MP_CONTEXT'])
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                   max_tasks_per_child=config['IMAGE_BACKFILL_TASKS_PER_CHILD'])
+    try:
+        last_id = 0
+        while limit is None or report.processed < limit:
+            rows = db.session.execute(
+                select(Sneaker.id, Sneaker.image_filename, ImageBackfill.profile, ImageBackfill.sha256)
+                .outerjoin(ImageBackfill, ImageBackfill.filename == Sneaker.image_filename)
+                .where(Sneaker.id > last_id, Sneaker.image_filename.is_not(None))
+                .order_by(Sneaker.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            tasks = {}
+            for row in rows:
+                if row.profile == profile and not verify:
+                    report.counts['checkpointed'] += 1
+                elif row.image_filename not in tasks:
+                    tasks[row.image_filename] = row.sha256 if row.profile == profile else None
+            if limit is not None:
+                tasks = dict(list(tasks.items())[:limit - report.processed])
+            # 読み取りのトランザクションを、ワーカーの処理の間ずっと開いたままにしない
+            db.session.rollback()
+            if not tasks:
+                continue
+
+            results = list(executor.map(process_image, tasks.keys(), tasks.values(),
+                                        [settings] * len(tasks), chunksize=max(1, len(tasks) // (workers * 4))))
+            _checkpoint(results, profile, report)
+            for result in results:
+                report.add(result)
+                if on_result is not None:
+                    on_result(result)
+            if on_batch is not None:
+                on_batch(report)
+    finally:
+        # 中断された場合も、コミット済みのバッチまでは次回スキップされる
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    report.elapsed = time.monotonic() - report.started
+    return report
+
+
+def _checkpoint(results: list, profile: str, report: BackfillReport):
+    now = datetime.now(timezone.utc)
+    done = [result for result in results if result['status'] in DONE_STATUSES]
+    renamed = [result for result in done if result['new_filename'] != result['filename']]
+    for result in renamed:
+        # 処理中にアップロードなどで画像が差し替えられた行は書き換えない
+        updated = db.session.execute(
+            update(Sneaker).where(Sneaker.image_filename == result['filename'])
+            .values(image_filename=result['new_filename'])
+        ).rowcount
+        report.renamed += updated
+
+    names = {result['filename'] for result in done} | {result['new_filename'] for result in done}
+    if names:
+        db.session.execute(delete(ImageBackfill).where(ImageBackfill.filename.in_(names)))
+        db.session.execute(insert(ImageBackfill), [
+            {'filename': result['new_filename'], 'profile': profile, 'sha256': result['sha256'], 'processed_at': now}
+            for result in done
+        ])
+    db.session.commit()
+    if renamed:
+        # image_urlが変わったので、ワーカー間で共有しているキャッシュを無効にする
+        current_app.extensions['cache'].invalidate('sneakers')
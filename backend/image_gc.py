@@ -0,0 +1,170 @@
+"""
+Garbage collection of uploaded images that no sneaker references any more.
+
+create_itemでコミットが失敗した場合や、update_item/delete_itemでremove_old_imageが失敗した場合に、
+どの行からも参照されない画像がUPLOAD_FOLDERに残る。collect()はディレクトリをos.scandirで1件ずつ読み、
+IMAGE_GC_BATCH_SIZE件ごとに `image_filename IN (...)` で参照されているものだけをDBに問い合わせるので、
+ファイル数がどれだけ多くてもメモリに載るのは1バッチ分だけで済む(sneakers.image_filenameにはインデックスがある)。
+
+アップロード直後(コミット前)のファイルを消さないよう、最終更新からIMAGE_GC_GRACE_SECONDS秒以内のファイルは
+対象外にする。save_imageは毎回新しい名前で保存するので、一度どの行からも参照されなくなったファイルが
+再び参照されることはない。
+
+`flask images gc` で実行でき、IMAGE_GC_INTERVAL_SECONDSを設定するとワーカー内のスレッドが定期的に実行する
+(複数のワーカーが同時に走らないようファイルロックを取る)。
+"""
+import fcntl
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import select
+
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+from backend.utils_image import ALLOWED_EXTENSIONS
+
+
+LOCK_NAME = '.image-gc.lock'
+
+
+class GcReport:
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.skipped = 0      # 画像以外のファイルや猶予期間内のファイル
+        self.referenced = 0
+        self.orphaned = 0
+        self.orphaned_bytes = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self), elapsed=round(self.elapsed, 3))
+
+
+class OrphanImageCollector:
+    def __init__(self, app=None):
+        self.grace_seconds = 3600
+        self.batch_size = 500
+        self.interval_seconds = 0
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IMAGE_GC_GRACE_SECONDS', 3600)
+        app.config.setdefault('IMAGE_GC_BATCH_SIZE', 500)
+        app.config.setdefault('IMAGE_GC_INTERVAL_SECONDS', 0)
+        self.grace_seconds = app.config['IMAGE_GC_GRACE_SECONDS']
+        self.batch_size = app.config['IMAGE_GC_BATCH_SIZE']
+        self.interval_seconds = app.config['IMAGE_GC_INTERVAL_SECONDS']
+        app.extensions['image_gc'] = self
+        if self.interval_seconds > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run_periodically, args=(app,),
+                                            name='image-gc', daemon=True)
+            self._thread.start()
+
+    # --- public API ---
+
+    def collect(self, dry_run: bool = False, grace_seconds: int | None = None,
+                batch_size: int | None = None, on_orphan=None) -> GcReport | None:
+        """
+        Removes (or with dry_run only reports) orphaned images. Requires an app context.
+        on_orphan(filename, size) is called for each orphan. Returns None when another
+        process is already collecting.
+        """
+        grace_seconds = self.grace_seconds if grace_seconds is None else grace_seconds
+        batch_size = batch_size or self.batch_size
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        report = GcReport(dry_run)
+        started = time.monotonic()
+
+        with open(os.path.join(upload_folder, LOCK_NAME), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                cutoff = time.time() - grace_seconds
+                batch = []
+                with os.scandir(upload_folder) as entries:
+                    for entry in entries:
+                        report.scanned += 1
+                        candidate = self._candidate(entry, cutoff)
+                        if candidate is None:
+                            report.skipped += 1
+                            continue
+                        batch.append(candidate)
+                        if len(batch) >= batch_size:
+                            self._sweep(upload_folder, batch, report, on_orphan)
+                            batch = []
+                self._sweep(upload_folder, batch, report, on_orphan)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        report.elapsed = time.monotonic() - started
+        return report
+
+    # --- internals ---
+
+    @staticmethod
+    def _candidate(entry, cutoff: float) -> tuple[str, int] | None:
+        # save_imageが保存する画像だけを対象にする(.gitkeepやロックファイルなどは触らない)
+        name = entry.name
+        if name.startswith('.') or os.path.splitext(name)[1].lower().lstrip('.') not in ALLOWED_EXTENSIONS:
+            return None
+        try:
+            if not entry.is_file(follow_symlinks=False):
+                return None
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            return None
+        # 猶予期間内のファイルはDBに問い合わせる前に除外する
+        if stat.st_mtime > cutoff:
+            return None
+        return name, stat.st_size
+
+    def _sweep(self, upload_folder: str, batch: list, report: GcReport, on_orphan):
+        if not batch:
+            return
+        names = [name for name, _ in batch]
+        referenced = set(db.session.execute(
+            select(Sneaker.image_filename).where(Sneaker.image_filename.in_(names))
+        ).scalars())
+        # バッチごとにトランザクションを終えて、長いスキャンの間ずっと読み取りを開いたままにしない
+        db.session.rollback()
+
+        for name, size in batch:
+            if name in referenced:
+                report.referenced += 1
+                continue
+            if not report.dry_run:
+                try:
+                    os.remove(os.path.join(upload_folder, name))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    current_app.logger.error(f"Failed to remove orphaned image {name}: {e}")
+                    report.failed += 1
+                    continue
+            report.orphaned += 1
+            report.orphaned_bytes += size
+            if on_orphan is not None:
+                on_orphan(name, size)
+
+    def _run_periodically(self, app):
+        while True:
+            time.sleep(self.interval_seconds)
+            try:
+                with app.app_context():
+                    report = self.collect()
+                if report is not None and report.orphaned:
+                    app.logger.info(f"Image GC removed {report.orphaned} orphaned images "
+                                    f"({report.orphaned_bytes} bytes) in {report.elapsed:.1f}s")
+            except Exception:
+                app.logger.exception("Image GC failed")
+
+
+image_gc = OrphanImageCollector()
@@ -0,0 +1,241 @@
+"""
+Non-blocking, structured logging.
+
+リクエストを処理するスレッドではログレコードをキューに入れるだけにして、フォーマットと書き出し(I/O)は
+QueueListenerのスレッドで行う。キューが一杯のときはレコードを捨てて数だけ数えるので(次に書き出すときに報告する)、
+出力先が詰まってもリクエストが待たされることはない。
+
+各レコードには、リクエストごとのID(X-Request-IDヘッダー。無ければ生成する)を付けてJSONの1行として出力する。
+ロガーごとのレベルはLOG_LEVELS('backend.passwords=DEBUG,werkzeug=WARNING' のような形式)で指定できる。
+DEBUGのレコードは呼び出し箇所ごとにLOG_DEBUG_SAMPLE_EVERY件に1件だけ出力する。
+"""
+import atexit
+import itertools
+import json
+import logging
+import queue
+import re
+import sys
+import threading
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, request, request_started
+
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# クライアントから受け取ったIDはそのままログとレスポンスに出すので、形式と長さを制限する
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+request_id_var: ContextVar[str | None] = ContextVar('request_id', default=None)
+
+# LogRecordが最初から持つ属性。これ以外(extra=で渡されたもの)はJSONのフィールドとして出力する
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id'}
+
+
+def new_request_id(incoming: str | None = None) -> str:
+    if incoming and REQUEST_ID_RE.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+def parse_levels(value) -> dict:
+    """'name=LEVEL,name=LEVEL' (or a dict) -> {logger name: level name}."""
+    if isinstance(value, dict):
+        return {name: str(level).upper() for name, level in value.items()}
+    levels = {}
+    for item in (value or '').split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class RequestIdFilter(logging.Filter):
+    # キューに入れる前(ログを出したスレッド)で実行されるので、そのリクエストのIDが取れる
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Lets through the first and then every n-th DEBUG record of each call site."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        counter = self._counters.get(site)
+        if counter is None:
+            counter = self._counters.setdefault(site, itertools.count())
+        # itertools.countのnext()はGILの下でアトミックなのでロックは要らない
+        if next(counter) % self.every:
+            return False
+        record.sample_rate = self.every
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # メッセージの組み立てと例外の文字列化だけをここで行い(引数のオブジェクトは別スレッドに渡さない)、
+        # JSONへの変換は書き出す側のスレッドに任せる
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if record.stack_info:
+            record.stack_info = str(record.stack_info)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] [%(request_id)s] %(message)s')
+
+
+class DropReporter(logging.Handler):
+    """Runs on the listener thread: reports how many records were dropped since the last record."""
+
+    def __init__(self, queue_handler, target):
+        super().__init__()
+        self.queue_handler = queue_handler
+        self.target = target
+        self._reported = 0
+
+    def emit(self, record):
+        dropped = self.queue_handler.dropped
+        if dropped != self._reported:
+            self.target.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'request_id': None,
+                'msg': f"Log queue was full; dropped {dropped - self._reported} records",
+            }))
+            self._reported = dropped
+
+
+class LogPipeline:
+    """
+    Routes every logger through one queue so request threads never block on log I/O.
+
+    ルートロガーにQueueHandlerを1つだけ付け、(app.loggerを含む)すべてのロガーのレコードをそこに流す。
+    リスナーのスレッドはプロセスごとに1つで、create_appが何度呼ばれても設定を更新するだけになる。
+    """
+
+    def __init__(self, app=None):
+        self.handler = None
+        self.listener = None
+        self._sampler = None
+        self._stream = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LOG_LEVEL', 'INFO')
+        app.config.setdefault('LOG_LEVELS', '')
+        app.config.setdefault('LOG_FORMAT', 'json')
+        app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+        app.config.setdefault('LOG_DEBUG_SAMPLE_EVERY', 10)
+        app.extensions['log_pipeline'] = self
+
+        self._start(app.config)
+        # Flaskのdefault_handler(wsgi_errorsへ同期的に書き出す)は外し、ルートロガーのキューに流す
+        from flask.logging import default_handler
+        app.logger.removeHandler(default_handler)
+
+        logging.getLogger().setLevel(app.config['LOG_LEVEL'].upper())
+        for name, level in parse_levels(app.config['LOG_LEVELS']).items():
+            logging.getLogger(name).setLevel(level)
+
+        # before_requestの関数は途中(障害の注入など)で打ち切られることがあるので、それより前に送られるシグナルでIDを決める
+        request_started.connect(self._begin_request, app)
+        app.after_request(self._end_request)
+        app.teardown_request(self._reset_request_id)
+
+    # --- internals ---
+
+    def _start(self, config):
+        with self._lock:
+            formatter = JsonFormatter() if config['LOG_FORMAT'] == 'json' else TextFormatter()
+            if self.listener is not None:
+                self._sampler.every = config['LOG_DEBUG_SAMPLE_EVERY']
+                self._stream.setFormatter(formatter)
+                return
+
+            log_queue = queue.Queue(maxsize=config['LOG_QUEUE_SIZE'])
+            self.handler = NonBlockingQueueHandler(log_queue)
+            self._sampler = DebugSampler(config['LOG_DEBUG_SAMPLE_EVERY'])
+            self.handler.addFilter(RequestIdFilter())
+            self.handler.addFilter(self._sampler)
+
+            self._stream = logging.StreamHandler(sys.stderr)
+            self._stream.setFormatter(formatter)
+            self.listener = QueueListener(log_queue, DropReporter(self.handler, self._stream), self._stream,
+                                          respect_handler_level=True)
+            self.listener.start()
+            # 終了時にキューに残ったレコードを書き出してからスレッドを止める
+            atexit.register(self.listener.stop)
+
+            root = logging.getLogger()
+            for existing in list(root.handlers):
+                root.removeHandler(existing)
+            root.addHandler(self.handler)
+
+    @staticmethod
+    def _begin_request(sender, **extra):
+        g.request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+        request_id_var.set(g.request_id)
+
+    @staticmethod
+    def _end_request(response):
+        if 'request_id' in g:
+            # 保存されたレスポンスの再送(@idempotent)でも、このリクエストのIDを返す
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
+
+    @staticmethod
+    def _reset_request_id(exc):
+        request_id_var.set(None)
+
+
+log_pipeline = LogPipeline()
@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from backend.extensions import db
+
+
+class CatalogChange(db.Model):
+    """
+    Append-only log of catalog writes. The id is the event id of the SSE change feed.
+
+    sqlite_autoincrementを指定しているので、行が削除されてもidが再利用されず、常に単調増加する
+    """
+    __tablename__ = 'catalog_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id: Mapped[int] = mapped_column(db.Integer(), primary_key=True)
+    # 'created' / 'updated' / 'deleted' / 'stock'
+    event: Mapped[str] = mapped_column(db.String(20))
+    # スニーカーが削除された後も行は残るので、外部キーにはしない
+    sneaker_id: Mapped[int] = mapped_column(db.Integer(), index=True)
+    data: Mapped[dict] = mapped_column(db.JSON())
+    created_at: Mapped[datetime] = mapped_column(db.DateTime(timezone=True),
+                                                default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<CatalogChange id:{self.id}, event:{self.event}, sneaker_id:{self.sneaker_id}>"
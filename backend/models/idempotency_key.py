@@ -0,0 +1,30 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from backend.extensions import db
+
+
+class IdempotencyKey(db.Model):
+    """The first response to a request sent with an Idempotency-Key header (backend/idempotency.py)."""
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (db.UniqueConstraint('scope', 'key'),)
+
+    id: Mapped[int] = mapped_column(db.Integer(), primary_key=True)
+    # キーはクライアントが生成するので、ユーザーごと(未ログインなら'anonymous:<IPアドレス>')に区別する
+    scope: Mapped[str] = mapped_column(db.String(64))
+    key: Mapped[str] = mapped_column(db.String(255))
+    # メソッド・パス・リクエストボディのsha256。同じキーで別の内容が送られてきたことを検出する
+    fingerprint: Mapped[str] = mapped_column(db.String(64))
+    # 'pending'(最初のリクエストを処理中) / 'completed'
+    state: Mapped[str] = mapped_column(db.String(10), default='pending')
+    response_status: Mapped[int|None] = mapped_column(db.Integer())
+    response_headers: Mapped[dict|None] = mapped_column(db.JSON())
+    response_body: Mapped[bytes|None] = mapped_column(db.LargeBinary())
+    response_hash: Mapped[str|None] = mapped_column(db.String(64))
+    created_at: Mapped[datetime] = mapped_column(db.DateTime(timezone=True),
+                                                default=lambda: datetime.now(timezone.utc))
+    expires_at: Mapped[datetime] = mapped_column(db.DateTime(timezone=True), index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey scope:{self.scope}, key:{self.key}, state:{self.state}>"
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from backend.extensions import db
+
+
+class ImageBackfill(db.Model):
+    """
+    Checkpoint of `flask images backfill` (backend/image_backfill.py): one row per processed image.
+
+    profileは処理したときの設定(形式:最大辺:品質)、sha256は処理後のファイルの内容のハッシュ。
+    profileが現在の設定と同じ行の画像は、中断後の再実行でもファイルを開かずにスキップされる。
+    """
+    __tablename__ = 'image_backfill'
+
+    filename: Mapped[str] = mapped_column(db.String(256), primary_key=True)
+    profile: Mapped[str] = mapped_column(db.String(50))
+    sha256: Mapped[str] = mapped_column(db.String(64))
+    processed_at: Mapped[datetime] = mapped_column(db.DateTime(timezone=True),
+                                                   default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<ImageBackfill {self.filename} ({self.profile})>"
@@ -0,0 +1,29 @@
+from decimal import Decimal
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from backend.extensions import db
+from backend.enums import CategoryEnum
+
+
+class InventoryStat(db.Model):
+    """
+    Running inventory aggregates per (category, price band), maintained by backend/analytics.py.
+
+    各スニーカーはちょうど1行に集計される。price_bandはanalytics.PRICE_BANDSの添字で、
+    価格が未設定のスニーカーは -1 の行に入る。カテゴリごとの合計はこの表のその行を足し合わせる。
+    """
+    __tablename__ = 'inventory_stats'
+
+    category: Mapped[CategoryEnum] = mapped_column(db.Enum(CategoryEnum, native_enum=False), primary_key=True)
+    price_band: Mapped[int] = mapped_column(db.Integer(), primary_key=True, autoincrement=False)
+    sneaker_count: Mapped[int] = mapped_column(db.Integer(), default=0)
+    units: Mapped[int] = mapped_column(db.Integer(), default=0)
+    stock_value: Mapped[Decimal] = mapped_column(db.Numeric(14, 2), default=0)
+    price_sum: Mapped[Decimal] = mapped_column(db.Numeric(14, 2), default=0)
+    featured_count: Mapped[int] = mapped_column(db.Integer(), default=0)
+    low_stock_count: Mapped[int] = mapped_column(db.Integer(), default=0)
+    out_of_stock_count: Mapped[int] = mapped_column(db.Integer(), default=0)
+
+    def __repr__(self):
+        return f"<InventoryStat {self.category.value}/{self.price_band}: {self.sneaker_count} sneakers>"
@@ -1,3 +1,4 @@
+from sqlalchemy import FetchedValue
 from sqlalchemy.orm import Mapped, mapped_column
 from backend.extensions import db
 
@@ -8,23 +9,30 @@ from backend.enums import CategoryEnum
 
 class Sneaker(db.Model):
     __tablename__ = 'sneakers'
+    # priceはDBが丸めて保存するので、INSERT/UPDATEのRETURNINGで保存された値を読み戻す
+    # (backend/database.pyのflush_returning_stored)。FetchedValueはDDLには影響しない
+    __mapper_args__ = {'eager_defaults': True}
 
     id: Mapped[int] = mapped_column(db.Integer(), primary_key=True)
     name: Mapped[str] = mapped_column(db.String(50))
     description: Mapped[str] = mapped_column(db.String(1000), default='')
     category: Mapped[CategoryEnum] = mapped_column(db.Enum(CategoryEnum, native_enum=False), index=True)
-    price: Mapped[Decimal|None] = mapped_column(db.Numeric(10, 2), index=True)
+    price: Mapped[Decimal|None] = mapped_column(db.Numeric(10, 2), index=True,
+                                               server_default=FetchedValue(), server_onupdate=FetchedValue())
     stock: Mapped[int|None] = mapped_column(db.Integer())
     featured: Mapped[bool] = mapped_column(db.Boolean(), default=False)
-    image_filename: Mapped[str|None] = mapped_column(db.String(256))
+    # 孤立した画像の掃除(backend/image_gc.py)でファイル名から行を引くのでインデックスを張る
+    image_filename: Mapped[str|None] = mapped_column(db.String(256), index=True)
     created_at: Mapped[datetime] = mapped_column(
         db.DateTime(timezone=True),
         default=lambda: datetime.now(timezone.utc)
     )
+    # 差分同期(backend/sync.py)で (updated_at, id) のキーセットで読むのでインデックスを張る
     updated_at: Mapped[datetime] = mapped_column(
         db.DateTime(timezone=True),
         default=lambda: datetime.now(timezone.utc),
-        onupdate=lambda: datetime.now(timezone.utc)
+        onupdate=lambda: datetime.now(timezone.utc),
+        index=True
     )
 
     def __repr__(self):
@@ -0,0 +1,23 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from backend.extensions import db
+
+
+class SneakerTombstone(db.Model):
+    """
+    Record of a deleted sneaker for the delta sync (backend/sync.py). Written by delete_item.
+
+    同じidで削除が繰り返された場合(SQLiteではidが再利用されることがある)は、最後の削除の時刻に更新される。
+    SYNC_TOMBSTONE_RETENTION_DAYS日を過ぎた行は削除のたびに消される
+    """
+    __tablename__ = 'sneaker_tombstones'
+
+    # スニーカーの行はもう無いので、外部キーにはしない
+    sneaker_id: Mapped[int] = mapped_column(db.Integer(), primary_key=True, autoincrement=False)
+    deleted_at: Mapped[datetime] = mapped_column(db.DateTime(timezone=True), index=True,
+                                                 default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<SneakerTombstone sneaker_id:{self.sneaker_id}, deleted_at:{self.deleted_at}>"
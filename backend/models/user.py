@@ -1,10 +1,15 @@
 from uuid import UUID, uuid4
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from sqlalchemy.orm import Mapped, mapped_column
-from werkzeug.security import generate_password_hash, check_password_hash
 
-from backend.extensions import db
+from backend.extensions import db, password_hasher
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# JWTのiatは秒単位なので、発行時刻をマイクロ秒単位で入れるクレーム(blueprints/users/routes.pyのadditional_claims_loader)
+ISSUED_AT_US_CLAIM = 'iat_us'
+
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -23,12 +28,25 @@ class User(db.Model):
     def __repr__(self):
         return f'<User id:{self.id}, username:"{self.username}", email:"{self.email}">'
 
+    def token_predates_valid_from(self, jwt_payload) -> bool:
+        """True when the token was issued before tokens_valid_from (e.g. before a password change)."""
+        valid_from = self.tokens_valid_from.replace(tzinfo=timezone.utc)
+        if ISSUED_AT_US_CLAIM in jwt_payload:
+            # 同じ秒のうちのパスワード変更の前後も区別できる
+            return EPOCH + timedelta(microseconds=jwt_payload[ISSUED_AT_US_CLAIM]) < valid_from
+        # クレームの無い(この変更より前に発行された)トークンは、秒単位に切り捨てたtokens_valid_fromと比べる
+        return jwt_payload['iat'] < int(valid_from.timestamp())
+
+    # ハッシュ計算はpassword_hasher(backend/passwords.py)のプロセスプールで行われる
     @classmethod
     def create_password_hash(cls, raw_password: str) -> str:
-        return generate_password_hash(raw_password)
+        return password_hasher.hash(raw_password)
 
     def check_password(self, raw_password: str) -> bool:
-        return check_password_hash(self.password, raw_password)
+        return password_hasher.verify(self.password, raw_password)
+
+    def password_needs_rehash(self) -> bool:
+        return password_hasher.needs_rehash(self.password)
 
 
 class TokenBlocklist(db.Model):
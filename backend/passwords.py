@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, BrokenExecutor
+
+from flask import g, has_app_context
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_method(method: str) -> str:
+    """
+    Expands a werkzeug hash method to the exact prefix werkzeug stores in the hash.
+
+    'scrypt' -> 'scrypt:32768:8:1', 'pbkdf2' -> 'pbkdf2:sha256:<default iterations>'
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = (args + ['32768', '8', '1'][len(args):])[:3]
+        return f"scrypt:{int(n)}:{int(r)}:{int(p)}"
+    if name == 'pbkdf2':
+        hash_name, iterations = (args + ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)][len(args):])[:2]
+        return f"pbkdf2:{hash_name}:{int(iterations)}"
+    return method
+
+
+class PasswordHasher:
+    """
+    Password hashing service backed by a process pool.
+
+    scrypt/pbkdf2 are CPU-bound, so hashing in the request thread pegs every worker during
+    login storms. Hashes are computed in a separate process pool instead; the request thread
+    only waits on the result. The algorithm and its cost come from config, so login throughput
+    can be tuned against security without a code change:
+
+        PASSWORD_HASH_METHOD       e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'
+        PASSWORD_HASH_SALT_LENGTH  salt length passed to werkzeug
+        PASSWORD_HASH_WORKERS      pool size (0 = hash inline in the calling thread)
+
+    Latency of each call (queue wait included) is logged, aggregated in stats() and added to
+    the response as a Server-Timing entry.
+    """
+
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.salt_length = 16
+        self.workers = 0
+        self.mp_context = 'spawn'
+        self._normalized_method = normalize_method(self.method)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.salt_length = app.config.get('PASSWORD_HASH_SALT_LENGTH', self.salt_length)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.mp_context = app.config.get('PASSWORD_HASH_MP_CONTEXT', self.mp_context)
+        self._normalized_method = normalize_method(self.method)
+        app.extensions['password_hasher'] = self
+        app.after_request(self._add_server_timing)
+
+    # --- public API ---
+
+    def hash(self, raw_password: str) -> str:
+        return self._run('hash', generate_password_hash, raw_password, self.method, self.salt_length)
+
+    def verify(self, password_hash: str, raw_password: str) -> bool:
+        return self._run('verify', check_password_hash, password_hash, raw_password)
+
+    def submit_hash(self, raw_password: str) -> Future:
+        """Non-blocking variant for the ASGI app (wrap with asyncio.wrap_future)."""
+        return self._submit('hash', generate_password_hash, raw_password, self.method, self.salt_length)
+
+    def submit_verify(self, password_hash: str, raw_password: str) -> Future:
+        return self._submit('verify', check_password_hash, password_hash, raw_password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True when the stored hash was produced with a different method or cost than configured."""
+        stored_method = password_hash.split('$', 1)[0]
+        return stored_method != self._normalized_method
+
+    def stats(self) -> dict:
+        """Per-operation latency stats of this process: count, avg_ms, max_ms, last_ms."""
+        with self._lock:
+            return {
+                op: {
+                    'count': s['count'],
+                    'avg_ms': round(s['total'] / s['count'] * 1000, 2) if s['count'] else 0.0,
+                    'max_ms': round(s['max'] * 1000, 2),
+                    'last_ms': round(s['last'] * 1000, 2),
+                }
+                for op, s in self._stats.items()
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # --- internals ---
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # multiprocessingはプールを初めて使うときに読み込む(コールドスタート対策)
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                context = multiprocessing.get_context(self.mp_context)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def _submit(self, op, fn, *args) -> Future:
+        started = time.perf_counter()
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            try:
+                future = self._get_executor().submit(fn, *args)
+            except BrokenExecutor:
+                # ワーカープロセスが落ちていた場合はプールを作り直す
+                logger.error("Password hashing pool was broken. Recreating it.")
+                self.shutdown()
+                future = self._get_executor().submit(fn, *args)
+        future.add_done_callback(lambda f: self._record(op, time.perf_counter() - started))
+        return future
+
+    def _run(self, op, fn, *args):
+        started = time.perf_counter()
+        result = self._submit(op, fn, *args).result()
+        if has_app_context():
+            g.password_hash_seconds = g.get('password_hash_seconds', 0.0) + (time.perf_counter() - started)
+        return result
+
+    def _record(self, op: str, elapsed: float):
+        with self._lock:
+            s = self._stats.setdefault(op, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            s['count'] += 1
+            s['total'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+            s['last'] = elapsed
+        logger.debug(f"password {op} took {elapsed * 1000:.1f}ms (method={self.method})")
+
+    def _add_server_timing(self, response):
+        elapsed = g.get('password_hash_seconds')
+        if elapsed is not None:
+            response.headers.add('Server-Timing', f'pwhash;dur={elapsed * 1000:.1f}')
+        return response
@@ -0,0 +1,290 @@
+"""
+On-demand request profiling with flamegraph output.
+
+本番で特定のエンドポイントだけが遅くなったときに、その中(JWTのコールバック、backend/schemasのpydanticの検証、
+validate_imageのPillowの処理など)のどこで時間を使っているかを見るためのもの。PROFILING_ENABLEDが
+有効なときだけフックを登録するので、無効なときのオーバーヘッドは無い。
+
+プロファイルを取るリクエスト:
+- `X-Profile: 1`(または `sampling` / `tracing`)ヘッダー付きの、管理者のアクセストークンを持つリクエスト
+- PROFILING_SAMPLE_RATE の割合で無作為に選ばれたリクエスト
+
+プロファイラー(PROFILING_MODE、ヘッダーで指定も可):
+- sampling  別スレッドがPROFILING_INTERVAL_MSごとにリクエストのスレッドのスタックを読む。オーバーヘッドが小さい。
+            GILの切り替え間隔(sys.getswitchinterval()、既定5ms)より細かくは読めないので、遅いリクエスト向き
+- tracing   sys.setprofileで全ての呼び出しを記録する(決定的)。短いリクエストの内訳向きだが、数倍遅くなる
+
+結果はPROFILING_DIRに、flamegraph.pl などで使える collapsed stack 形式(<id>.folded)と
+https://www.speedscope.app で開ける形式(<id>.speedscope.json)で保存し、新しいものからPROFILING_MAX_PROFILES件だけ残す。
+レスポンスのX-Profile-Idヘッダーのidで /api/admin/profiles/<id>/<folded|speedscope> からダウンロードできる。
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from flask import current_app, g, request, request_started
+from flask_jwt_extended import get_current_user, verify_jwt_in_request
+
+
+HEADER = 'X-Profile'
+ID_HEADER = 'X-Profile-Id'
+MODES = ('sampling', 'tracing')
+FILE_SUFFIXES = {'folded': '.folded', 'speedscope': '.speedscope.json'}
+META_SUFFIX = '.meta.json'
+
+
+def frame_label(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples the call stack of one thread from a background thread."""
+
+    unit = 'samples'
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+class StackTracer:
+    """Deterministic profiler: attributes the time between profile events to the current stack (microseconds)."""
+
+    unit = 'microseconds'
+
+    def __init__(self):
+        self.stacks = Counter()
+        self._stack = []
+        self._last = 0
+
+    def start(self):
+        self._last = time.perf_counter_ns()
+        sys.setprofile(self._event)
+
+    def stop(self):
+        sys.setprofile(None)
+        # ナノ秒で積算した値をマイクロ秒にする
+        self.stacks = Counter({stack: ns // 1000 for stack, ns in self.stacks.items() if ns >= 1000})
+
+    def _event(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        if self._stack:
+            self.stacks[tuple(self._stack)] += now - self._last
+        if event == 'call':
+            self._stack.append(frame_label(frame.f_code))
+        elif event == 'c_call':
+            self._stack.append(f"{getattr(arg, '__qualname__', repr(arg))} (builtin)")
+        elif self._stack:
+            # 'return' / 'c_return' / 'c_exception'。開始時より外側のフレームから戻る場合は何もしない
+            self._stack.pop()
+        # 記録の処理自体にかかった時間は含めない
+        self._last = time.perf_counter_ns()
+
+
+def to_folded(stacks: Counter) -> str:
+    return ''.join(f"{';'.join(stack)} {weight}\n" for stack, weight in stacks.most_common())
+
+
+def to_speedscope(stacks: Counter, name: str, unit: str) -> dict:
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, weight in stacks.items():
+        sample = []
+        for label in stack:
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(weight)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'sneakers-api',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled', 'name': name, 'unit': 'none' if unit == 'samples' else unit,
+            'startValue': 0, 'endValue': sum(weights), 'samples': samples, 'weights': weights,
+        }],
+    }
+
+
+class RequestProfiler:
+    """Profiles selected requests from request_started to teardown and keeps the newest results on disk."""
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_profiles = 50
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILING_ENABLED', False)
+        app.config.setdefault('PROFILING_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILING_MODE', 'sampling')
+        app.config.setdefault('PROFILING_INTERVAL_MS', 2)
+        app.config.setdefault('PROFILING_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PROFILING_MAX_PROFILES', 50)
+        if app.config['PROFILING_MODE'] not in MODES:
+            raise ValueError(f"PROFILING_MODE must be one of {MODES}")
+        self.directory = app.config['PROFILING_DIR']
+        self.max_profiles = app.config['PROFILING_MAX_PROFILES']
+        app.extensions['request_profiler'] = self
+        if not app.config['PROFILING_ENABLED']:
+            return
+        # before_requestの関数(障害の注入など)も含めるため、それより前に送られるシグナルで開始する
+        request_started.connect(self._start, app)
+        app.after_request(self._add_header)
+        app.teardown_request(self._finish)
+
+    # --- stored profiles ---
+
+    def list_profiles(self) -> list[dict]:
+        """Metadata of the stored profiles, newest first."""
+        profiles = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if not name.endswith(META_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(profiles, key=lambda p: p['created_at'], reverse=True)
+
+    def file_path(self, profile_id: str, kind: str) -> str | None:
+        """Path of a stored file, or None for an unknown id/kind (ids are generated, never user paths)."""
+        if kind not in FILE_SUFFIXES or not profile_id.replace('-', '').isalnum():
+            return None
+        path = os.path.join(self.directory, profile_id + FILE_SUFFIXES[kind])
+        return path if os.path.isfile(path) else None
+
+    # --- internals ---
+
+    def _start(self, sender, **extra):
+        if 'profile' in g:
+            # /api/batchのサブリクエストはバッチのgを共有し、バッチのプロファイルに含まれる
+            return
+        config = current_app.config
+        requested = request.headers.get(HEADER)
+        if requested:
+            mode = requested if requested in MODES else config['PROFILING_MODE']
+        elif random.random() < config['PROFILING_SAMPLE_RATE']:
+            mode = config['PROFILING_MODE']
+        else:
+            return
+
+        profiler = StackTracer() if mode == 'tracing' else StackSampler(config['PROFILING_INTERVAL_MS'] / 1000)
+        g.profile = {'id': f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}", 'mode': mode,
+                     'profiler': profiler, 'started': time.perf_counter(), 'request': request._get_current_object()}
+        profiler.start()
+        if requested and not self._is_admin():
+            # ヘッダーでの指定は管理者のリクエストに限る
+            profiler.stop()
+            del g.profile
+
+    @staticmethod
+    def _is_admin() -> bool:
+        # JWTのコールバック(ブロックリストとユーザーの確認)もプロファイルに含まれる。結果はgに残るのでビューで再利用される
+        try:
+            verify_jwt_in_request(optional=True, locations=['headers'])
+            user = get_current_user()
+        except Exception:
+            return False
+        return bool(user is not None and user.is_admin)
+
+    @staticmethod
+    def _current_profile() -> dict | None:
+        profile = g.get('profile')
+        if profile is None or profile['request'] is not request._get_current_object():
+            return None
+        return profile
+
+    def _add_header(self, response):
+        if (profile := self._current_profile()) is not None:
+            response.headers[ID_HEADER] = profile['id']
+        return response
+
+    def _finish(self, exc):
+        profile = self._current_profile()
+        if profile is None:
+            return
+        del g.profile
+        profile['profiler'].stop()
+        duration_ms = (time.perf_counter() - profile['started']) * 1000
+        try:
+            self._save(profile, duration_ms)
+        except OSError:
+            current_app.logger.exception("Failed to save a request profile")
+
+    def _save(self, profile: dict, duration_ms: float):
+        profiler = profile['profiler']
+        meta = {
+            'id': profile['id'],
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'mode': profile['mode'],
+            'unit': profiler.unit,
+            'duration_ms': round(duration_ms, 2),
+            'stacks': len(profiler.stacks),
+            'total': sum(profiler.stacks.values()),
+        }
+        name = f"{request.method} {request.path} ({profile['mode']}, {meta['duration_ms']} ms)"
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, profile['id'])
+        with open(base + FILE_SUFFIXES['folded'], 'w', encoding='utf-8') as f:
+            f.write(to_folded(profiler.stacks))
+        with open(base + FILE_SUFFIXES['speedscope'], 'w', encoding='utf-8') as f:
+            json.dump(to_speedscope(profiler.stacks, name, profiler.unit), f, separators=(',', ':'))
+        # 一覧に出るのはメタデータが書かれた後なので、書きかけのファイルは見えない
+        with open(base + META_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            metas = sorted(name for name in os.listdir(self.directory) if name.endswith(META_SUFFIX))
+            # idはミリ秒の時刻から始まるので、名前の順が古い順になる
+            for name in metas[:max(0, len(metas) - self.max_profiles)]:
+                profile_id = name[:-len(META_SUFFIX)]
+                for suffix in (META_SUFFIX, *FILE_SUFFIXES.values()):
+                    try:
+                        os.remove(os.path.join(self.directory, profile_id + suffix))
+                    except FileNotFoundError:
+                        pass
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,236 @@
+"""
+Query-plan regression checks for the hot SQL paths.
+
+各シナリオ(SCENARIOS)のリクエストを、マイグレーションを適用してデータを入れた一時的なSQLiteのDBに対して
+テストクライアントで送り、発行されたSQLを記録して `EXPLAIN QUERY PLAN` を実行する。
+期待するプランはシナリオごとにJSONのフィクスチャ(QUERY_PLAN_FIXTURES_DIR)に保存してレビューの対象にする。
+
+    flask sql-plans record   現在のプランでフィクスチャを書き直す
+    flask sql-plans check    フィクスチャと比較する
+
+check は、フィクスチャに無い全件走査(SCAN ...)や一時B-treeによるソート(USE TEMP B-TREE ...)が
+プランに現れた場合に失敗する。インデックス名の変更などそれ以外の違いは報告だけ行う(--strictで失敗扱い)。
+一覧の件数のCOUNTや部分一致検索のように元から全件走査になるクエリは、フィクスチャに記録されていれば許容される。
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import event, insert
+
+from backend.enums import CategoryEnum
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+from backend.models.user import TokenBlocklist
+
+
+# 退行とみなすプランの行
+FLAGGED_RE = re.compile(r'^\s*(SCAN |USE TEMP B-TREE)')
+# 書き込み先のテーブル。重複の検出をユニーク制約に任せているので(INSERTして失敗を捕まえる)、そのインデックスも確認する
+WRITE_RE = re.compile(r'^(?:INSERT INTO|UPDATE) (\w+)')
+SEED_SNEAKERS = 200
+SEED_BLOCKED_TOKENS = 200
+SEED_USER = {'username': 'planner', 'email': 'planner@example.com', 'raw_password': 'planner-password'}
+
+# name: (method, path, 送信するJSON, アクセストークンを付けるか)
+SCENARIOS = {
+    'get_items': ('GET', '/api/sneakers/?page=2&per_page=6', None, False),
+    'get_items_search': ('GET', '/api/sneakers/?q=run&page=1', None, False),
+    'get_item': ('GET', '/api/sneakers/1', None, True),
+    'get_changes': ('GET', '/api/sneakers/changes?limit=50', None, False),
+    'login_user': ('POST', '/api/users/login',
+                   {'email': SEED_USER['email'], 'raw_password': SEED_USER['raw_password']}, False),
+    'refresh_token': ('POST', '/api/users/refresh', None, False),
+    'create_user': ('POST', '/api/users/',
+                    {'username': 'planner2', 'email': SEED_USER['email'], 'raw_password': 'another-password'}, False),
+}
+
+
+def normalize_sql(statement: str) -> str:
+    return ' '.join(statement.split())
+
+
+def is_flagged(line: str) -> bool:
+    return bool(FLAGGED_RE.match(line))
+
+
+def explain(connection, statement: str, parameters) -> list[str]:
+    """EXPLAIN QUERY PLAN as indented lines (two spaces per nesting level)."""
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+
+def unique_indexes(connection, table: str) -> list[str]:
+    """Column lists of the table's unique indexes, e.g. ['email', 'id', 'username']."""
+    columns = []
+    for index in connection.exec_driver_sql(f"PRAGMA index_list('{table}')").mappings():
+        if index['unique']:
+            names = [row['name'] for row in connection.exec_driver_sql(f"PRAGMA index_info('{index['name']}')").mappings()]
+            columns.append(','.join(names))
+    return sorted(columns)
+
+
+class PlanCapture:
+    """Collects (sql, parameters) of the statements an engine runs while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            self.statements.append((statement, parameters))
+
+
+def _make_app(database_path: str):
+    from flask_migrate import Migrate, upgrade
+    from backend import create_app
+    from backend.config import TestingConfig
+
+    class PlanConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{database_path}"
+        SQLALCHEMY_BINDS = {}
+        JWT_SECRET_KEY = 'query-plan-harness-secret-key-0123456789'
+        PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+        SNAPSHOTS_ENABLED = False
+        SIMILARITY_ENABLED = False
+        IMAGE_GC_INTERVAL_SECONDS = 0
+        COALESCE_ENABLED = False
+
+    app = create_app(PlanConfig)
+    if 'migrate' not in app.extensions:
+        Migrate(app, db)
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with app.app_context():
+        # スキーマはモデルではなくマイグレーションから作る(マイグレーションでのインデックスの消失を検出するため)
+        upgrade(directory=os.path.join(project_root, 'migrations'))
+    return app
+
+
+def _seed(app, client):
+    now = datetime.now(timezone.utc)
+    categories = list(CategoryEnum)
+    with app.app_context():
+        db.session.execute(insert(Sneaker), [
+            {'name': f"Plan Sneaker {i}", 'description': f"seed row {i}", 'category': categories[i % len(categories)],
+             'price': Decimal(40 + i % 300), 'stock': i % 50, 'featured': i % 7 == 0,
+             'created_at': now, 'updated_at': now}
+            for i in range(SEED_SNEAKERS)
+        ])
+        db.session.execute(insert(TokenBlocklist), [
+            {'jti': f"00000000-0000-0000-0000-{i:012d}", 'created_at': now} for i in range(SEED_BLOCKED_TOKENS)
+        ])
+        db.session.commit()
+    client.post('/api/users/', json=SEED_USER)
+    response = client.post('/api/users/login', json={k: SEED_USER[k] for k in ('email', 'raw_password')})
+    return response.get_json()['access_token']
+
+
+def capture_plans(scenarios=None) -> dict:
+    """Runs the scenarios against a fresh seeded database and returns {name: fixture dict}."""
+    workdir = tempfile.mkdtemp(prefix='sql-plans-')
+    try:
+        app = _make_app(os.path.join(workdir, 'plans.db'))
+        app.config['UPLOAD_FOLDER'] = workdir
+        client = app.test_client()
+        access_token = _seed(app, client)
+
+        results = {}
+        for name in scenarios or SCENARIOS:
+            method, path, body, auth = SCENARIOS[name]
+            headers = {'Authorization': f"Bearer {access_token}"} if auth else {}
+            with app.app_context():
+                engine = db.engine
+            with PlanCapture(engine) as capture:
+                response = client.open(path, method=method, json=body, headers=headers)
+
+            queries, indexes = [], {}
+            seen = set()
+            with engine.connect() as connection:
+                for statement, parameters in capture.statements:
+                    sql = normalize_sql(statement)
+                    if sql in seen:
+                        continue
+                    seen.add(sql)
+                    queries.append({'sql': sql, 'plan': explain(connection, statement, parameters)})
+                    if match := WRITE_RE.match(sql):
+                        indexes[match.group(1)] = unique_indexes(connection, match.group(1))
+            results[name] = {
+                'scenario': name,
+                'request': f"{method} {path}",
+                'status': response.status_code,
+                'queries': queries,
+                'unique_indexes': indexes,
+            }
+        with app.app_context():
+            db.engine.dispose()
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def fixture_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}.json")
+
+
+def write_fixture(directory: str, fixture: dict):
+    os.makedirs(directory, exist_ok=True)
+    with open(fixture_path(directory, fixture['scenario']), 'w', encoding='utf-8') as f:
+        json.dump(fixture, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+
+def load_fixture(directory: str, name: str) -> dict | None:
+    try:
+        with open(fixture_path(directory, name), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def compare(expected: dict | None, actual: dict) -> tuple[list[str], list[str]]:
+    """Returns (failures, notes) for one scenario."""
+    if expected is None:
+        return ["no fixture (run `flask sql-plans record`)"], []
+    failures, notes = [], []
+    if expected.get('status') != actual['status']:
+        notes.append(f"status changed: {expected.get('status')} -> {actual['status']}")
+
+    expected_plans = {q['sql']: q['plan'] for q in expected['queries']}
+    actual_sqls = set()
+    for query in actual['queries']:
+        sql, plan = query['sql'], query['plan']
+        actual_sqls.add(sql)
+        known = expected_plans.get(sql)
+        new_flagged = [line.strip() for line in plan if is_flagged(line)
+                       and line.strip() not in {old.strip() for old in known or ()}]
+        if new_flagged:
+            failures.append(f"{', '.join(new_flagged)}\n      in: {sql}")
+        elif known is None:
+            notes.append(f"new query: {sql}")
+        elif known != plan:
+            notes.append(f"plan changed: {' / '.join(line.strip() for line in plan)}\n      in: {sql}")
+    for sql in expected_plans.keys() - actual_sqls:
+        notes.append(f"no longer emitted: {sql}")
+    actual_indexes = actual.get('unique_indexes', {})
+    for table, expected_columns in expected.get('unique_indexes', {}).items():
+        for columns in expected_columns:
+            if table in actual_indexes and columns not in actual_indexes[table]:
+                failures.append(f"unique index on {table}({columns}) is missing")
+    return failures, notes
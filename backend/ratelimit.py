@@ -0,0 +1,177 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate: str) -> tuple[int, float]:
+    """
+    Parses '10/minute' into (capacity, tokens refilled per second).
+
+    '10/minute' は「最大10回まで連続で許可し、6秒に1回分ずつ回復する」トークンバケットになる。
+    """
+    count, _, period = rate.partition('/')
+    count = int(count)
+    seconds = PERIODS[period.strip().rstrip('s')]
+    return count, count / seconds
+
+
+class RateLimitExceeded(TooManyRequests):
+    """429 Too Many Requests with the number of seconds until the next token is available."""
+
+    def __init__(self, scope: str, key_type: str, retry_after: int):
+        super().__init__(description="Too many requests. Please try again later.", retry_after=retry_after)
+        self.scope = scope
+        self.key_type = key_type
+        self.retry_after = retry_after
+
+
+class MemoryStorage:
+    """Per-process token buckets kept in an LRU dict (bounded by max_keys)."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, refill_rate: float, now: float) -> float:
+        """Takes one token. Returns 0 if allowed, otherwise the seconds to wait for the next token."""
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            wait, tokens, updated_at = _take_token(tokens, updated_at, capacity, refill_rate, now)
+            self._buckets[key] = (tokens, updated_at)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStorage:
+    """
+    Token buckets in a local SQLite file shared by every worker process on the host.
+
+    BEGIN IMMEDIATE で書き込みロックを取ってから読み書きするので、複数プロセスから同時に
+    アクセスされてもバケットの残量がずれない。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def consume(self, key: str, capacity: int, refill_rate: float, now: float) -> float:
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            wait, tokens, updated_at = _take_token(tokens, updated_at, capacity, refill_rate, now)
+            conn.execute(
+                "INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, tokens, updated_at),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def reset(self):
+        self._connect().execute("DELETE FROM rate_limit_buckets")
+
+
+def _take_token(tokens: float, updated_at: float, capacity: int, refill_rate: float, now: float):
+    """Refills the bucket for the elapsed time and takes one token. Returns (wait, tokens, updated_at)."""
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+    if tokens >= 1:
+        return 0.0, tokens - 1, now
+    return (1 - tokens) / refill_rate, tokens, now
+
+
+def create_storage(url: str):
+    """'memory' or 'sqlite:///path/to/ratelimit.db'"""
+    if not url or url == 'memory':
+        return MemoryStorage()
+    if url.startswith('sqlite:///'):
+        return SQLiteStorage(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported RATE_LIMIT_STORAGE_URL: {url}")
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter for the auth endpoints.
+
+    Limits are configured per scope and key type in RATE_LIMITS, e.g.
+
+        RATE_LIMITS = {'login': {'ip': '20/minute', 'email': '5/minute'}}
+
+    and applied from a view with `limiter.hit('login', ip=client_ip(), email=dto.email)`.
+    Exceeding any of the buckets raises RateLimitExceeded, which register_error_handlers
+    turns into a 429 response with a Retry-After header.
+    """
+
+    def __init__(self, app=None):
+        self.storage = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('RATE_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_STORAGE_URL', 'memory')
+        self.storage = create_storage(app.config['RATE_LIMIT_STORAGE_URL'])
+        app.extensions['rate_limiter'] = self
+
+    def hit(self, scope: str, **identifiers):
+        """Consumes one request from every configured bucket of the scope. Raises RateLimitExceeded."""
+        if not current_app.config['RATE_LIMIT_ENABLED']:
+            return
+        limits = current_app.config['RATE_LIMITS'].get(scope, {})
+        now = time.time()
+        for key_type, rate in limits.items():
+            identifier = identifiers.get(key_type)
+            if identifier is None:
+                continue
+            capacity, refill_rate = parse_rate(rate)
+            key = f"{scope}:{key_type}:{str(identifier).lower()}"
+            wait = self.storage.consume(key, capacity, refill_rate, now)
+            if wait > 0:
+                current_app.logger.warning(f"Rate limit exceeded: scope={scope} key_type={key_type}")
+                raise RateLimitExceeded(scope, key_type, max(1, math.ceil(wait)))
+
+
+def client_ip() -> str:
+    # Vercelなどのプロキシ配下ではX-Forwarded-Forの先頭が実際のクライアントIPになる
+    if current_app.config.get('RATE_LIMIT_TRUST_FORWARDED_FOR'):
+        forwarded_for = request.headers.get('X-Forwarded-For', '')
+        if forwarded_for:
+            return forwarded_for.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
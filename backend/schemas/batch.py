@@ -0,0 +1,30 @@
+from typing import Any, Literal
+from pydantic import BaseModel, Field, ConfigDict, field_validator
+from pydantic_core import PydanticCustomError
+
+
+class SubRequest(BaseModel):
+    # レスポンスとの対応付けのためにクライアントが任意に付けるID
+    id: str | None = Field(None, max_length=64)
+    method: Literal['GET', 'POST', 'PUT', 'PATCH', 'DELETE']
+    path: str = Field(..., max_length=2048)
+    headers: dict[str, str] = Field(default_factory=dict)
+    # JSONのボディ。multipart/form-data(画像のアップロードなど)はバッチにできない
+    body: Any = None
+
+    model_config = ConfigDict(defer_build=True)
+
+    @field_validator('path')
+    @classmethod
+    def check_path(cls, path: str) -> str:
+        if not path.startswith('/api/') or path.split('?', 1)[0].rstrip('/') == '/api/batch':
+            # ValueErrorだとエラーの詳細(ctx)に例外オブジェクトが入り、JSONにできない
+            raise PydanticCustomError('batch_path', 'path must be an /api/ path other than /api/batch')
+        return path
+
+
+class BatchRequest(BaseModel):
+    # 件数の上限(BATCH_MAX_REQUESTS)はbatch_dispatcherで確認する
+    requests: list[SubRequest] = Field(..., min_length=1)
+
+    model_config = ConfigDict(defer_build=True)
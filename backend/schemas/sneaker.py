@@ -1,4 +1,5 @@
 from typing import Annotated
+from contextvars import ContextVar
 from flask import url_for, current_app
 from pydantic import BaseModel, Field, ConfigDict, computed_field
 
@@ -7,6 +8,11 @@ from decimal import Decimal
 from datetime import datetime
 
 
+# Flaskのリクエストコンテキストが存在しない場所(ASGIアプリ backend/aio など)で画像URLを組み立てる際の
+# staticディレクトリのベースURL(例: 'http://localhost:8000/static/')。設定されていなければurl_forを使う
+static_base_url: ContextVar[str | None] = ContextVar('static_base_url', default=None)
+
+
 class CreateSneaker(BaseModel):
     name: str = Field(..., max_length=50)
     description: str = Field('', max_length=1000)
@@ -18,6 +24,9 @@ class CreateSneaker(BaseModel):
     stock: int|None = Field(None, ge=0, le=10000)
     featured: bool = Field(False)
 
+    # 書き込み系のスキーマは管理者のリクエストでしか使わないので、バリデータの構築を初回使用時まで遅らせる
+    model_config = ConfigDict(defer_build=True)
+
 # このスキーマにより、model_validateの直後はキーバリューが存在しないフィールドは強引にNoneが設定される。
 # そのかとでmodel_dump()において、exclude_unset=Trueが有効になっているので、それらは再度消去される。 
 # これにより、Patchがうまく働くことになる。
@@ -32,6 +41,8 @@ class UpdateSneaker(BaseModel):
     stock: int|None = Field(None, ge=0, le=10000)
     featured: bool|None = Field(None)
 
+    model_config = ConfigDict(defer_build=True)
+
 
 class SneakerWithImageUrl(BaseModel):
     """
@@ -48,6 +59,9 @@ class SneakerWithImageUrl(BaseModel):
         # つまり、image_urlメソッド内のselfは、idやnameといった定義済みのフィールドを持っているだけでなく、データソースとなったsneakerオブジェクトが持っていた**image_filename属性にもアクセスできる状態**になっているのです。
         image_filename = getattr(self, 'image_filename', None)
         if image_filename:
+            base_url = static_base_url.get()
+            if base_url is not None:
+                return f"{base_url}uploads/{image_filename}"
             # UPLOAD_FOLDER内のファイルへの静的URLを生成
             return url_for('static', filename=f'uploads/{image_filename}', _external=True)
         return None
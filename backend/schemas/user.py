@@ -1,29 +1,41 @@
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
 from uuid import UUID, uuid4
 
+# ユーザー系のスキーマはEmailStr(email_validator)を含み、バリデータの構築コストが大きい。
+# 閲覧系のリクエストだけを処理するコールドスタートでは不要なので、defer_buildで初回使用時まで構築を遅らせる
+DEFERRED = ConfigDict(defer_build=True)
+
 class CreateUser(BaseModel):
     username: str = Field(min_length=2, max_length=30)
     email: EmailStr
     raw_password: str = Field(min_length=7, max_length=40)
 
+    model_config = DEFERRED
+
 class LoginUser(BaseModel):
     email: EmailStr
     raw_password: str = Field(min_length=7, max_length=40)
 
+    model_config = DEFERRED
+
 
 class ChangeUsernameUser(BaseModel):
     username: str = Field(min_length=2, max_length=30)
 
+    model_config = DEFERRED
+
 class ChangePasswordUser(BaseModel):
     old_raw_password: str = Field(min_length=7, max_length=40)
     new_raw_password: str = Field(min_length=7, max_length=40)
 
+    model_config = DEFERRED
+
 class ReadUser(BaseModel):
     id: UUID
     username: str
     email: EmailStr
     is_admin: bool
 
-    model_config = ConfigDict(from_attributes=True)
+    model_config = ConfigDict(from_attributes=True, defer_build=True)
 
 
@@ -0,0 +1,17 @@
+from blinker import Namespace
+
+# スニーカーの作成/更新/削除がコミットされた後に送られるシグナル。
+# senderはFlaskアプリ。スナップショットの再生成などの後処理はこれを購読して行う
+#   sneaker_created: sneaker
+#   sneaker_updated: sneaker, previous (更新前のカラム値のdict)
+#   sneaker_deleted: sneaker_id, previous
+_signals = Namespace()
+
+sneaker_created = _signals.signal('sneaker-created')
+sneaker_updated = _signals.signal('sneaker-updated')
+sneaker_deleted = _signals.signal('sneaker-deleted')
+
+
+def column_values(sneaker) -> dict:
+    """Returns a plain dict of the sneaker's column values (used as `previous` in the signals)."""
+    return {column.key: getattr(sneaker, column.key) for column in sneaker.__table__.columns}
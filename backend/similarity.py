@@ -0,0 +1,386 @@
+"""
+Similar-sneaker recommendations from a precomputed nearest-neighbour index.
+
+各スニーカーの名前・説明・カテゴリ・価格帯を、特徴量ハッシングで SIMILARITY_DIM 次元のベクトルに変換し
+(L2正規化したTF。IDFはカタログ全体に依存して差分更新と相性が悪いので使わない)、コサイン類似度の上位
+SIMILARITY_TOP_K 件をあらかじめ計算してディスクに保存する。リクエスト時は memory-map したファイルから
+1行読むだけで、カタログを走査しない。
+
+SIMILARITY_INDEX_DIR のレイアウト:
+
+    current                 現在のバージョンのディレクトリ名(書き換えはos.replaceで原子的に行う)
+    v<ns>/ids.npy           int64 (N,)   ソート済みのスニーカーID。行番号はsearchsortedで引く
+    v<ns>/neighbors.npy     int64 (N, K) 類似スニーカーのID(足りない分は-1)
+    v<ns>/scores.npy        float32 (N, K)
+    v<ns>/vectors.npy       float32 (N, D) 差分更新で使う特徴ベクトル
+
+`flask similarity build` で全体を作り、SIMILARITY_ENABLED=True の場合はスニーカーの作成/更新/削除のたびに
+影響を受ける行だけを計算し直した新しいバージョンが書き出される。差分更新はリクエストを返した後に
+バックグラウンドのスレッド(backend/background.py)で行い、続けて書き込まれた分はまとめて1回で処理する。
+インデックスがまだ無い場合は何もしない(DBもNumPyも使わない)。
+
+NumPyはこの機能でしか使わないので、コールドスタートを軽くするため各関数の中で読み込む。
+"""
+import fcntl
+import hashlib
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+from sqlalchemy import select
+
+from backend.background import deferred_work
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+from backend.signals import sneaker_created, sneaker_updated, sneaker_deleted
+
+
+CURRENT_NAME = 'current'
+ARRAY_NAMES = ('ids', 'neighbors', 'scores', 'vectors')
+# 一度に類似度を計算する行数(N x CHUNK_ROWS の行列がメモリに乗る)
+CHUNK_ROWS = 1024
+
+# 特徴量の重み。名前とカテゴリは説明文よりも強く効かせる
+NAME_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+CATEGORY_WEIGHT = 3.0
+PRICE_WEIGHT = 1.5
+# 価格帯の境界(ドル)。隣の価格帯にも半分の重みを付けて、境界付近の商品が極端に離れないようにする
+PRICE_BANDS = (50, 80, 120, 160, 220, 300)
+
+STOP_WORDS = frozenset({'the', 'and', 'for', 'with', 'from', 'this', 'that', 'are', 'you', 'your', 'our'})
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text: str) -> list[str]:
+    return [t for t in TOKEN_RE.findall((text or '').lower()) if len(t) > 1 and t not in STOP_WORDS]
+
+
+def _price_band(price) -> int | None:
+    if price is None:
+        return None
+    price = float(price)
+    for band, upper in enumerate(PRICE_BANDS):
+        if price < upper:
+            return band
+    return len(PRICE_BANDS)
+
+
+def _features(name: str, description: str, category, price) -> dict[str, float]:
+    features = {}
+    for text, weight in ((name, NAME_WEIGHT), (description, DESCRIPTION_WEIGHT)):
+        counts = {}
+        for token in _tokens(text):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            # 名前と説明で同じ単語が出てきた場合も同じ特徴として足し合わせる
+            features[token] = features.get(token, 0.0) + weight * (1 + math.log(count))
+    if category is not None:
+        features[f"category:{getattr(category, 'value', category)}"] = CATEGORY_WEIGHT
+    band = _price_band(price)
+    if band is not None:
+        features[f"price:{band}"] = PRICE_WEIGHT
+        for neighbour in (band - 1, band + 1):
+            if 0 <= neighbour <= len(PRICE_BANDS):
+                features[f"price:{neighbour}"] = PRICE_WEIGHT / 2
+    return features
+
+
+def vectorize(name: str, description: str, category, price, dim: int):
+    """Hashed, L2-normalised float32 vector of a sneaker's text, category and price band."""
+    import numpy as np
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, weight in _features(name, description, category, price).items():
+        digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        # 符号付きハッシュにすると、衝突した特徴同士が打ち消し合って偏りが出にくい
+        vector[value % dim] += weight if (value >> 63) & 1 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _top_k(similarities, row_ids, ids, k: int):
+    """Top-k (ids, scores) for each row of a similarity matrix, excluding the row's own id."""
+    import numpy as np
+
+    rows = similarities.shape[0]
+    neighbors = np.full((rows, k), -1, dtype=np.int64)
+    scores = np.zeros((rows, k), dtype=np.float32)
+    if rows == 0 or len(ids) == 0:
+        return neighbors, scores
+    similarities = similarities.copy()
+    # 自分自身は候補から外す
+    own_columns = np.searchsorted(ids, row_ids)
+    similarities[np.arange(rows), own_columns] = -np.inf
+    count = min(k, len(ids) - 1)
+    if count <= 0:
+        return neighbors, scores
+    top = np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+    top_scores = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    neighbors[:, :count] = ids[top]
+    scores[:, :count] = np.take_along_axis(top_scores, order, axis=1)
+    return neighbors, scores
+
+
+def _compute_rows(vectors, ids, rows, k: int):
+    """Recomputes the neighbour lists of the given row indexes in chunks."""
+    import numpy as np
+
+    neighbors = np.full((len(rows), k), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), k), dtype=np.float32)
+    for start in range(0, len(rows), CHUNK_ROWS):
+        chunk = rows[start:start + CHUNK_ROWS]
+        similarities = vectors[chunk] @ vectors.T
+        neighbors[start:start + len(chunk)], scores[start:start + len(chunk)] = _top_k(similarities, ids[chunk], ids, k)
+    return neighbors, scores
+
+
+def _sneaker_rows(sneaker_ids=None):
+    stmt = select(Sneaker.id, Sneaker.name, Sneaker.description, Sneaker.category, Sneaker.price).order_by(Sneaker.id)
+    if sneaker_ids is not None:
+        stmt = stmt.where(Sneaker.id.in_(sneaker_ids))
+    return db.session.execute(stmt).all()
+
+
+# --- on-disk versions ---
+
+@contextmanager
+def _locked(root: str):
+    # 複数のワーカーが同時に差分更新すると互いの変更を上書きしてしまうので、ファイルロックで直列化する
+    with open(os.path.join(root, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _current_version(root: str) -> str | None:
+    try:
+        with open(os.path.join(root, CURRENT_NAME), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _load_arrays(root: str, version: str, mmap_mode=None) -> dict:
+    import numpy as np
+    return {name: np.load(os.path.join(root, version, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES}
+
+
+def _write_version(root: str, arrays: dict) -> str:
+    import numpy as np
+
+    version = f"v{time.time_ns()}"
+    directory = os.path.join(root, version)
+    os.makedirs(directory)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(directory, f"{name}.npy"), arrays[name])
+    tmp_path = os.path.join(root, f"{CURRENT_NAME}.tmp{os.getpid()}")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(root, CURRENT_NAME))
+
+    # 読み込み中のプロセスがあるかもしれないので、直前のバージョンは残しておく
+    versions = sorted(name for name in os.listdir(root) if name.startswith('v'))
+    for old in versions[:-2]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return version
+
+
+# --- build / incremental update ---
+
+def build_index() -> int:
+    """Rebuilds the whole index from the database. Returns the number of indexed sneakers."""
+    import numpy as np
+
+    config = current_app.config
+    dim, k = config['SIMILARITY_DIM'], config['SIMILARITY_TOP_K']
+    rows = _sneaker_rows()
+    ids = np.array([row.id for row in rows], dtype=np.int64)
+    vectors = np.zeros((len(rows), dim), dtype=np.float32)
+    for i, row in enumerate(rows):
+        vectors[i] = vectorize(row.name, row.description, row.category, row.price, dim)
+    neighbors, scores = _compute_rows(vectors, ids, np.arange(len(ids)), k)
+
+    root = config['SIMILARITY_INDEX_DIR']
+    os.makedirs(root, exist_ok=True)
+    with _locked(root):
+        _write_version(root, {'ids': ids, 'neighbors': neighbors, 'scores': scores, 'vectors': vectors})
+    return len(ids)
+
+
+def update_index(sneaker_ids=(), deleted_ids=()) -> bool:
+    """
+    Incrementally applies created/updated and deleted sneakers to the current index.
+
+    変更されたスニーカー自身の行に加えて、変更前にそのスニーカーを近傍に含んでいた行と、
+    変更後に近傍に入るようになった行だけを計算し直す。インデックスがまだ無い場合は何もしない(False)。
+    """
+    config = current_app.config
+    root = config['SIMILARITY_INDEX_DIR']
+    # インデックスが無ければ、DBの読み込みもNumPyの読み込みもしない
+    if _current_version(root) is None:
+        return False
+
+    import numpy as np
+
+    dim, k = config['SIMILARITY_DIM'], config['SIMILARITY_TOP_K']
+    rows = _sneaker_rows(list(sneaker_ids)) if sneaker_ids else []
+
+    with _locked(root):
+        version = _current_version(root)
+        if version is None:
+            return False
+        # 変更の無い配列はコピーせずに済むよう、memory-mapで開く
+        arrays = _load_arrays(root, version, mmap_mode='r')
+        ids, neighbors, scores, vectors = arrays['ids'], arrays['neighbors'], arrays['scores'], arrays['vectors']
+        if vectors.shape[1] != dim or neighbors.shape[1] != k:
+            current_app.logger.warning("Similarity index settings changed. Run `flask similarity build`.")
+            return False
+
+        changed_ids = list(set(deleted_ids) | {row.id for row in rows})
+        # 変更前に変更対象を近傍に含んでいた行は、スコアが変わるので計算し直す
+        stale = np.isin(neighbors, changed_ids).any(axis=1)
+        remove = np.isin(ids, list(deleted_ids))
+        if not rows and not remove.any() and not stale.any():
+            # インデックスに含まれていないスニーカーの削除などは、書き出すものが無い
+            return False
+
+        keep = ~remove
+        # ブールのインデックスはコピーを返すので、ここからは書き換えられる
+        ids, neighbors, scores, vectors, stale = ids[keep], neighbors[keep], scores[keep], vectors[keep], stale[keep]
+
+        for row in rows:
+            vector = vectorize(row.name, row.description, row.category, row.price, dim)
+            position = np.searchsorted(ids, row.id)
+            if position < len(ids) and ids[position] == row.id:
+                vectors[position] = vector
+            else:
+                ids = np.insert(ids, position, row.id)
+                vectors = np.insert(vectors, position, vector, axis=0)
+                neighbors = np.insert(neighbors, position, -1, axis=0)
+                scores = np.insert(scores, position, 0.0, axis=0)
+                stale = np.insert(stale, position, False)
+
+        recompute = stale.copy()
+        if rows:
+            changed_rows = np.searchsorted(ids, [row.id for row in rows])
+            recompute[changed_rows] = True
+            # 変更後のスニーカーが、いまの最下位よりも似ている行は近傍が入れ替わる
+            similarities = vectors @ vectors[changed_rows].T
+            worst = np.where(neighbors[:, -1] >= 0, scores[:, -1], -np.inf)
+            recompute |= (similarities > worst[:, None]).any(axis=1)
+
+        targets = np.flatnonzero(recompute)
+        if len(targets):
+            neighbors[targets], scores[targets] = _compute_rows(vectors, ids, targets, k)
+        _write_version(root, {'ids': ids, 'neighbors': neighbors, 'scores': scores, 'vectors': vectors})
+    current_app.logger.info(f"Similarity index updated: {len(targets)} of {len(ids)} rows recomputed")
+    return True
+
+
+# --- lookup ---
+
+class SimilarityIndex:
+    """
+    Memory-mapped read side of the index, shared by the requests of a process.
+
+    currentファイルのmtimeが変わっていたら(他のワーカーやCLIが新しいバージョンを書き出したら)読み込み直す。
+    """
+
+    def __init__(self, app=None):
+        self.root = None
+        self._version = None
+        self._stamp = None
+        self._arrays = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SIMILARITY_ENABLED', False)
+        app.config.setdefault('SIMILARITY_INDEX_DIR', os.path.join(app.root_path, 'instance', 'similarity'))
+        app.config.setdefault('SIMILARITY_DIM', 512)
+        app.config.setdefault('SIMILARITY_TOP_K', 10)
+        self.root = app.config['SIMILARITY_INDEX_DIR']
+        app.extensions['similarity_index'] = self
+
+    def neighbors(self, sneaker_id: int, limit: int) -> list[tuple[int, float]] | None:
+        """[(sneaker id, score)] most similar first, or None when the sneaker is not indexed."""
+        import numpy as np
+
+        arrays = self._current_arrays()
+        if arrays is None:
+            return None
+        ids = arrays['ids']
+        position = int(np.searchsorted(ids, sneaker_id))
+        if position >= len(ids) or ids[position] != sneaker_id:
+            return None
+        row_ids, row_scores = arrays['neighbors'][position], arrays['scores'][position]
+        return [(int(i), round(float(s), 4)) for i, s in zip(row_ids[:limit], row_scores[:limit]) if i >= 0]
+
+    def _current_arrays(self):
+        try:
+            stamp = os.stat(os.path.join(self.root, CURRENT_NAME)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if stamp == self._stamp:
+            return self._arrays
+        with self._lock:
+            if stamp != self._stamp:
+                version = _current_version(self.root)
+                try:
+                    self._arrays = _load_arrays(self.root, version, mmap_mode='r')
+                except FileNotFoundError:
+                    # 書き換えの途中で古いバージョンが消された。次のリクエストで読み込み直す
+                    return self._arrays
+                self._version, self._stamp = version, stamp
+            return self._arrays
+
+
+similarity_index = SimilarityIndex()
+
+
+SIMILARITY_COLUMNS = ('name', 'description', 'category', 'price')
+
+
+def affects_similarity(sneaker, previous: dict) -> bool:
+    """True when an update changed a column the vectors are built from."""
+    return any(previous.get(key) != getattr(sneaker, key) for key in SIMILARITY_COLUMNS)
+
+
+def apply_changes(app, sneaker_ids=(), deleted_ids=()):
+    """Queues committed changes for the background index update when SIMILARITY_ENABLED is set (hooks and ASGI app)."""
+    if not app.config['SIMILARITY_ENABLED']:
+        return
+    deferred_work.submit(app, update_index, sneaker_ids=sneaker_ids, deleted_ids=deleted_ids)
+
+
+def register_similarity_hooks(app):
+    """Connects the incremental update to the sneaker signals when SIMILARITY_ENABLED is set."""
+    if not app.config['SIMILARITY_ENABLED']:
+        return
+
+    def on_created(sender, sneaker, **extra):
+        apply_changes(sender, sneaker_ids=[sneaker.id])
+
+    def on_updated(sender, sneaker, previous, **extra):
+        # 類似度に関係するカラムが変わっていなければ何もしない(在庫の更新など)
+        if affects_similarity(sneaker, previous):
+            apply_changes(sender, sneaker_ids=[sneaker.id])
+
+    def on_deleted(sender, sneaker_id, **extra):
+        apply_changes(sender, deleted_ids=[sneaker_id])
+
+    sneaker_created.connect(on_created, sender=app, weak=False)
+    sneaker_updated.connect(on_updated, sender=app, weak=False)
+    sneaker_deleted.connect(on_deleted, sender=app, weak=False)
@@ -0,0 +1,238 @@
+"""
+Pre-rendered static JSON snapshots of the public catalog.
+
+vercel.jsonは/static/(.*)をディスク上のファイルに直接ルーティングしているので、ここで書き出した
+JSONをフロントエンドが直接読めば、匿名の閲覧トラフィックはPython関数(コールドスタート)を経由しない。
+
+SNAPSHOT_DIR 以下のレイアウト:
+
+    catalog/page-<n>.json                 get_items と同じ形式の一覧(先頭 SNAPSHOT_PAGES ページ)
+    categories/<category>/page-<n>.json   カテゴリごとの一覧
+    sneakers/<id>.json                    PublicSneaker
+    manifest.json                         各ファイルのsha256・サイズ・圧縮レベル
+
+各JSONには .gz と(brotliが入っていれば) .br の圧縮済みファイルが並ぶ。
+`flask snapshots build` で全体を生成し、SNAPSHOTS_ENABLED=True の場合は
+スニーカーの作成/更新/削除のたびに影響を受けるファイルだけが書き換えられる。書き換えはリクエストを返した後に
+バックグラウンドのスレッド(backend/background.py)で行い、続けて書き込まれた分はまとめて1回で処理する。
+圧縮はbuildでは最大の圧縮率、差分更新では速い設定で行う(差分更新で書いたファイルは次のbuildで圧縮し直す)。
+"""
+import fcntl
+import gzip
+import hashlib
+import json
+import math
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import current_app, has_request_context
+from sqlalchemy import select, func
+
+from backend.background import deferred_work
+from backend.enums import CategoryEnum
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+from backend.schemas.sneaker import ReadSneaker, PublicSneaker
+from backend.signals import sneaker_created, sneaker_updated, sneaker_deleted
+
+try:
+    import brotli
+except ImportError:  # brotliは任意の依存。無ければ.gzだけを生成する
+    brotli = None
+
+
+MANIFEST_NAME = 'manifest.json'
+# (gzipのcompresslevel, brotliのquality)
+BUILD_LEVELS = (9, 11)
+REFRESH_LEVELS = (6, 5)
+
+
+class SnapshotWriter:
+    """Writes snapshot files atomically and skips files whose content did not change."""
+
+    def __init__(self, root: str, levels: tuple[int, int] = BUILD_LEVELS):
+        self.root = root
+        self.levels = levels
+        self.manifest = self._load_manifest()
+        self.written = []
+        self.removed = []
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.root, MANIFEST_NAME), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'files': {}}
+
+    def write(self, relative_path: str, data) -> bool:
+        body = current_app.json.dumps(data, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()
+        path = os.path.join(self.root, relative_path)
+        entry = self.manifest['files'].get(relative_path)
+        if (entry and entry['sha256'] == digest and os.path.exists(path)
+                and tuple(entry.get('levels', BUILD_LEVELS)) >= self.levels):
+            return False
+
+        gzip_level, brotli_quality = self.levels
+        _atomic_write(path, body)
+        _atomic_write(path + '.gz', gzip.compress(body, compresslevel=gzip_level, mtime=0))
+        if brotli is not None:
+            _atomic_write(path + '.br', brotli.compress(body, quality=brotli_quality))
+        self.manifest['files'][relative_path] = {'sha256': digest, 'size': len(body), 'levels': list(self.levels)}
+        self.written.append(relative_path)
+        return True
+
+    def remove(self, relative_path: str):
+        path = os.path.join(self.root, relative_path)
+        for suffix in ('', '.gz', '.br'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        if self.manifest['files'].pop(relative_path, None) is not None:
+            self.removed.append(relative_path)
+
+    def save_manifest(self):
+        if not (self.written or self.removed):
+            return
+        self.manifest['generated_at'] = datetime.now(timezone.utc).isoformat()
+        self.manifest['per_page'] = current_app.config['SNAPSHOT_PER_PAGE']
+        self.manifest['pages'] = current_app.config['SNAPSHOT_PAGES']
+        body = json.dumps(self.manifest, sort_keys=True, indent=1).encode('utf-8')
+        _atomic_write(os.path.join(self.root, MANIFEST_NAME), body)
+
+
+def _atomic_write(path: str, body: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _locked(root: str):
+    # 複数のワーカーが同時に書き込むとmanifest.jsonの更新が失われるので、ファイルロックで直列化する
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _url_context():
+    # image_urlはurl_for(_external=True)で組み立てられるので、CLIから実行する場合は
+    # SNAPSHOT_BASE_URLを使ってリクエストコンテキストを用意する
+    if has_request_context():
+        yield
+        return
+    with current_app.test_request_context(base_url=current_app.config['SNAPSHOT_BASE_URL']):
+        yield
+
+
+def _write_listing(writer: SnapshotWriter, prefix: str, category: CategoryEnum | None = None):
+    """Writes the first SNAPSHOT_PAGES pages of a listing with one count and one range query."""
+    per_page = current_app.config['SNAPSHOT_PER_PAGE']
+    max_pages = current_app.config['SNAPSHOT_PAGES']
+
+    stmt = select(Sneaker)
+    if category is not None:
+        stmt = stmt.where(Sneaker.category == category)
+    total = db.session.execute(select(func.count()).select_from(stmt.subquery())).scalar_one()
+    total_pages = math.ceil(total / per_page) if total else 0
+    sneakers = db.session.execute(
+        stmt.order_by(Sneaker.id.desc()).limit(per_page * max_pages)
+    ).scalars().all()
+
+    for page in range(1, max_pages + 1):
+        relative_path = f"{prefix}/page-{page}.json"
+        if page > max(total_pages, 1):
+            writer.remove(relative_path)
+            continue
+        items = sneakers[(page - 1) * per_page: page * per_page]
+        writer.write(relative_path, {
+            "items": [ReadSneaker.model_validate(sneaker).model_dump() for sneaker in items],
+            "meta": {
+                "page": page,
+                "per_page": per_page,
+                "total_pages": total_pages,
+                "total_items": total
+            }
+        })
+
+
+def _write_sneaker(writer: SnapshotWriter, sneaker: Sneaker):
+    writer.write(f"sneakers/{sneaker.id}.json", PublicSneaker.model_validate(sneaker).model_dump())
+
+
+def build_all() -> SnapshotWriter:
+    """Regenerates every snapshot file. Unchanged files are left untouched."""
+    root = current_app.config['SNAPSHOT_DIR']
+    with _locked(root), _url_context():
+        writer = SnapshotWriter(root)
+        _write_listing(writer, 'catalog')
+        for category in CategoryEnum:
+            _write_listing(writer, f"categories/{category.value}", category)
+
+        seen = set()
+        stmt = select(Sneaker).order_by(Sneaker.id).execution_options(yield_per=500)
+        for sneaker in db.session.execute(stmt).scalars():
+            _write_sneaker(writer, sneaker)
+            seen.add(f"sneakers/{sneaker.id}.json")
+        for relative_path in list(writer.manifest['files']):
+            if relative_path.startswith('sneakers/') and relative_path not in seen:
+                writer.remove(relative_path)
+        writer.save_manifest()
+    return writer
+
+
+def refresh(sneaker_ids=(), deleted_ids=(), categories=()) -> SnapshotWriter:
+    """
+    Incrementally refreshes the snapshots affected by a catalog write: the given sneakers'
+    files, the catalog listing and the listings of the given categories.
+    """
+    root = current_app.config['SNAPSHOT_DIR']
+    with _locked(root), _url_context():
+        writer = SnapshotWriter(root, REFRESH_LEVELS)
+        for sneaker_id in deleted_ids:
+            writer.remove(f"sneakers/{sneaker_id}.json")
+        if sneaker_ids:
+            stmt = select(Sneaker).where(Sneaker.id.in_(sneaker_ids))
+            for sneaker in db.session.execute(stmt).scalars():
+                _write_sneaker(writer, sneaker)
+        _write_listing(writer, 'catalog')
+        for category in {CategoryEnum(c) for c in categories if c is not None}:
+            _write_listing(writer, f"categories/{category.value}", category)
+        writer.save_manifest()
+    return writer
+
+
+def _refresh_in_background(sneaker_ids=(), deleted_ids=(), categories=()):
+    # DBへのコミットは既に完了しているので、失敗してもリクエストには影響しない(deferred_workがログに残す)
+    writer = refresh(sneaker_ids=sneaker_ids, deleted_ids=deleted_ids, categories=categories)
+    current_app.logger.info(f"Snapshots refreshed: {len(writer.written)} written, {len(writer.removed)} removed")
+
+
+def register_snapshot_hooks(app):
+    """Queues the incremental refresh on the sneaker signals when SNAPSHOTS_ENABLED is set."""
+    if not app.config['SNAPSHOTS_ENABLED']:
+        return
+
+    def on_created(sender, sneaker, **extra):
+        deferred_work.submit(sender, _refresh_in_background, sneaker_ids=[sneaker.id], categories=[sneaker.category])
+
+    def on_updated(sender, sneaker, previous, **extra):
+        deferred_work.submit(sender, _refresh_in_background, sneaker_ids=[sneaker.id],
+                             categories=[sneaker.category, previous['category']])
+
+    def on_deleted(sender, sneaker_id, previous, **extra):
+        deferred_work.submit(sender, _refresh_in_background, deleted_ids=[sneaker_id],
+                             categories=[previous['category']])
+
+    sneaker_created.connect(on_created, sender=app, weak=False)
+    sneaker_updated.connect(on_updated, sender=app, weak=False)
+    sneaker_deleted.connect(on_deleted, sender=app, weak=False)
@@ -0,0 +1,155 @@
+"""
+In-memory prefix index for search-as-you-type suggestions.
+
+スニーカー名(全体と、各単語から始まる部分)とカテゴリを正規化したキーを (key, sneaker_id) の
+ソート済みリストに持ち、bisectで前方一致する範囲を取り出す。候補は featured → 在庫あり → 在庫数 → 名前
+の順に並べる。リクエストの処理でDBには触れない。
+
+インデックスは各ワーカープロセスが最初の問い合わせの時にDBから作り、以降は変更フィード(backend/changefeed.py)
+のイベントを適用して差分更新する。変更フィードは他のワーカーでコミットされた変更も含むので、
+どのワーカーのインデックスも CHANGE_FEED_POLL_INTERVAL 秒以内に追いつく(このプロセスでの変更は即座に反映される)。
+
+更新はリストと辞書をコピーしてから差し替える(copy-on-write)ので、読み取り側はロックを取らない。
+"""
+import heapq
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+from sqlalchemy import select
+
+from backend.changefeed import change_feed
+from backend.extensions import db
+from backend.models.sneaker import Sneaker
+
+
+def normalize(text: str) -> str:
+    # 全角/半角や大文字/小文字の違いを吸収し、連続する空白を1つにまとめる
+    return ' '.join(unicodedata.normalize('NFKC', text or '').casefold().split())
+
+
+def _keys(name: str, category: str) -> set[str]:
+    words = normalize(name).split(' ')
+    # "EdgeRunner Light" は "edge..." でも "light" でも見つかるよう、各単語から始まる部分をキーにする
+    keys = {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+    keys.add(normalize(category))
+    return keys
+
+
+class SuggestIndex:
+    """Sorted (key, sneaker_id) list searched with bisect, kept in sync through the change feed."""
+
+    def __init__(self, app=None):
+        self.max_limit = 20
+        self._entries = []  # [(key, sneaker_id)] キーの昇順
+        self._docs = {}     # sneaker_id -> 候補として返す値と並び順
+        self._categories = []
+        self._cursor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SUGGEST_MAX_LIMIT', 20)
+        self.max_limit = app.config['SUGGEST_MAX_LIMIT']
+        app.extensions['suggest_index'] = self
+
+    # --- public API ---
+
+    def suggest(self, prefix: str, limit: int = 8) -> dict:
+        """Sneakers whose name (or one of its words) or category starts with the prefix, best first."""
+        self._sync()
+        prefix = normalize(prefix)
+        limit = min(max(limit, 1), self.max_limit)
+        if not prefix:
+            return {"prefix": prefix, "items": [], "categories": []}
+
+        entries, docs = self._entries, self._docs
+        start = bisect_left(entries, (prefix,))
+        end = bisect_left(entries, (prefix + '\uffff',), start)
+        ids = {sneaker_id for _, sneaker_id in entries[start:end]}
+        ranked = heapq.nsmallest(limit, (docs[i] for i in ids if i in docs), key=lambda d: d['_rank'])
+        return {
+            "prefix": prefix,
+            "items": [{key: value for key, value in d.items() if key != '_rank'} for d in ranked],
+            "categories": [c for c in self._categories if c.startswith(prefix)],
+        }
+
+    def rebuild(self):
+        """Reloads every sneaker from the database."""
+        with self._lock:
+            self._rebuild()
+
+    # --- internals ---
+
+    def _rebuild(self):
+        # 読み込み中にコミットされた変更を取りこぼさないよう、先に変更フィードの位置を控えておく
+        cursor = change_feed.head_id()
+        docs = {}
+        stmt = select(Sneaker.id, Sneaker.name, Sneaker.category, Sneaker.stock, Sneaker.featured)
+        for row in db.session.execute(stmt):
+            docs[row.id] = self._doc(row.id, row.name, row.category.value, row.stock, row.featured)
+        self._entries = sorted((key, i) for i, doc in docs.items() for key in _keys(doc['name'], doc['category']))
+        self._docs = docs
+        self._categories = sorted({doc['category'] for doc in docs.values()})
+        self._cursor = cursor
+
+    def _sync(self):
+        if self._cursor is None:
+            with self._lock:
+                # 同時に届いた最初の問い合わせのうち、1つだけがDBから読み込む
+                if self._cursor is None:
+                    self._rebuild()
+            return
+        # 変更フィードのバッファの読み足しはプロセス内で間引かれているので、毎回呼んでもDBにはほとんど触れない
+        if not change_feed.events_after(self._cursor, limit=1):
+            return
+        with self._lock:
+            events = change_feed.events_after(self._cursor)
+            entries, docs = list(self._entries), dict(self._docs)
+            while events:
+                for change in events:
+                    if change['id'] > self._cursor:
+                        self._apply(entries, docs, change)
+                        self._cursor = change['id']
+                events = change_feed.events_after(self._cursor)
+            self._entries, self._docs = entries, docs
+            self._categories = sorted({doc['category'] for doc in docs.values()})
+
+    def _apply(self, entries: list, docs: dict, change: dict):
+        data = change['data']
+        sneaker_id = data['sneaker_id']
+        old = docs.get(sneaker_id)
+        if change['event'] == 'stock':
+            if old is not None:
+                docs[sneaker_id] = self._doc(sneaker_id, old['name'], old['category'], data['stock'], old['featured'])
+            return
+
+        if old is not None:
+            for key in _keys(old['name'], old['category']):
+                position = bisect_left(entries, (key, sneaker_id))
+                if position < len(entries) and entries[position] == (key, sneaker_id):
+                    del entries[position]
+            del docs[sneaker_id]
+        if change['event'] in ('created', 'updated'):
+            sneaker = data['sneaker']
+            doc = self._doc(sneaker_id, sneaker['name'], sneaker['category'], sneaker['stock'], sneaker['featured'])
+            docs[sneaker_id] = doc
+            for key in _keys(doc['name'], doc['category']):
+                insort(entries, (key, sneaker_id))
+
+    @staticmethod
+    def _doc(sneaker_id: int, name: str, category: str, stock, featured: bool) -> dict:
+        in_stock = bool(stock)
+        return {
+            "id": sneaker_id,
+            "name": name,
+            "category": category,
+            "featured": bool(featured),
+            "in_stock": in_stock,
+            # 並び順: featured → 在庫あり → 在庫が多い → 名前
+            "_rank": (not featured, not in_stock, -(stock or 0), normalize(name)),
+        }
+
+
+suggest_index = SuggestIndex()
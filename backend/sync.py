@@ -0,0 +1,140 @@
+"""
+Delta sync of the catalog for offline mirrors (GET /api/sneakers/changes).
+
+モバイルアプリやパートナーのフィードがカタログ全体をページ単位で取り直さなくて済むように、前回の同期以降に
+作成・更新されたスニーカー(Sneaker.updated_atのインデックスを使う)と、削除されたスニーカーのid
+(delete_itemが書くsneaker_tombstonesテーブル)だけを返す。1回の同期のコストは変更の件数に比例する。
+
+    GET /api/sneakers/changes                初回。全件を (updated_at, id) の順に返す
+    GET /api/sneakers/changes?since=<token>  前回のレスポンスのnext_token以降の変更
+
+レスポンス: {"items": [ReadSneaker], "deleted": [id], "next_token": "...", "has_more": bool}
+has_moreがtrueの間はnext_tokenで続けて取得する。各ページではdeletedを先に、itemsを後に適用すること
+(SQLiteでは削除されたidが再利用されることがある)。
+
+トークンは更新と削除それぞれの (時刻, id) のキーセットのカーソルをまとめたもので、クライアントには
+不透明な文字列として扱わせる。updated_atはflushの時刻でコミットの順序とは一致しないので、
+直近SYNC_SETTLE_SECONDS秒の変更はまだ返さず(後からそれより前の時刻でコミットされる行を取りこぼさないため)、
+次回の同期で返す。削除の記録はSYNC_TOMBSTONE_RETENTION_DAYS日で消えるので、それより古いトークンは
+410 Goneになり、クライアントはトークン無しで全件を取り直す。
+"""
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, insert, select, tuple_
+from werkzeug.exceptions import BadRequest, Gone
+
+from backend.models.sneaker import Sneaker
+from backend.models.sneaker_tombstone import SneakerTombstone
+from backend.schemas.sneaker import ReadSneaker
+
+
+TOKEN_VERSION = 1
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class SyncCursor:
+    """Exclusive lower bounds (time, id) of the sneakers and the tombstones a client has already seen."""
+
+    def __init__(self, updated: tuple[datetime, int], deleted: tuple[datetime, int]):
+        self.updated = updated
+        self.deleted = deleted
+
+    @classmethod
+    def initial(cls, upper: datetime) -> 'SyncCursor':
+        # 初回は全件を返すので、それまでの削除は返さなくてよい
+        return cls((EPOCH, 0), (upper, 0))
+
+
+def encode_token(cursor: SyncCursor) -> str:
+    payload = {
+        'v': TOKEN_VERSION,
+        'u': [cursor.updated[0].isoformat(), cursor.updated[1]],
+        'd': [cursor.deleted[0].isoformat(), cursor.deleted[1]],
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_token(token: str) -> SyncCursor:
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        if payload['v'] != TOKEN_VERSION:
+            raise ValueError(payload['v'])
+        return SyncCursor(*(
+            (_as_utc(datetime.fromisoformat(payload[key][0])), int(payload[key][1])) for key in ('u', 'd')
+        ))
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, IndexError, TypeError):
+        raise BadRequest("Invalid sync token.")
+
+
+def parse_since(token: str | None, now: datetime, upper: datetime, retention_days: int) -> SyncCursor:
+    """The cursor of the `since` parameter (initial sync when absent). Raises Gone when tombstones may be pruned."""
+    if not token:
+        return SyncCursor.initial(upper)
+    cursor = decode_token(token)
+    if cursor.deleted[0] < now - timedelta(days=retention_days):
+        raise Gone("The sync token has expired. Sync again without a token.")
+    return cursor
+
+
+def changes_stmt(cursor: SyncCursor, upper: datetime, limit: int):
+    # 1件多く読んで、続きがあるかどうかを判定する
+    return (
+        select(Sneaker)
+        .where(tuple_(Sneaker.updated_at, Sneaker.id) > tuple_(*cursor.updated), Sneaker.updated_at <= upper)
+        .order_by(Sneaker.updated_at, Sneaker.id)
+        .limit(limit + 1)
+    )
+
+
+def tombstones_stmt(cursor: SyncCursor, upper: datetime, limit: int):
+    # 削除後に同じidで作り直された行の記録は返さない(カーソルは進める)ので、存在するかも一緒に読む
+    return (
+        select(SneakerTombstone.deleted_at, SneakerTombstone.sneaker_id, Sneaker.id.label('existing_id'))
+        .outerjoin(Sneaker, Sneaker.id == SneakerTombstone.sneaker_id)
+        .where(tuple_(SneakerTombstone.deleted_at, SneakerTombstone.sneaker_id) > tuple_(*cursor.deleted),
+               SneakerTombstone.deleted_at <= upper)
+        .order_by(SneakerTombstone.deleted_at, SneakerTombstone.sneaker_id)
+        .limit(limit + 1)
+    )
+
+
+def build_page(cursor: SyncCursor, upper: datetime, sneakers: list, tombstones: list, limit: int) -> dict:
+    """The response body from the rows of changes_stmt() and tombstones_stmt()."""
+    has_more = len(sneakers) > limit or len(tombstones) > limit
+    sneakers, tombstones = sneakers[:limit], tombstones[:limit]
+    next_cursor = SyncCursor(
+        _advance(cursor.updated, [(_as_utc(s.updated_at), s.id) for s in sneakers], upper, limit),
+        _advance(cursor.deleted, [(_as_utc(t.deleted_at), t.sneaker_id) for t in tombstones], upper, limit),
+    )
+    return {
+        "items": [ReadSneaker.model_validate(sneaker).model_dump() for sneaker in sneakers],
+        "deleted": [t.sneaker_id for t in tombstones if t.existing_id is None],
+        "next_token": encode_token(next_cursor),
+        "has_more": has_more,
+    }
+
+
+def tombstone_stmts(sneaker_id: int, now: datetime, retention_days: int) -> list:
+    """Statements that record a deletion (run them in the deleting transaction) and prune expired tombstones."""
+    return [
+        delete(SneakerTombstone).where(SneakerTombstone.sneaker_id == sneaker_id),
+        insert(SneakerTombstone).values(sneaker_id=sneaker_id, deleted_at=now),
+        delete(SneakerTombstone).where(SneakerTombstone.deleted_at < now - timedelta(days=retention_days)),
+    ]
+
+
+def _advance(position: tuple, seen: list, upper: datetime, limit: int) -> tuple:
+    if len(seen) < limit:
+        # upperまで読み終えたので、カーソルをupperまで進める(削除の無い期間が長くてもトークンが期限切れにならない)
+        return max(seen[-1] if seen else position, (upper, 0))
+    return seen[-1]
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLiteはタイムゾーンを保存しないので、読み出した値はnaiveなUTCになる
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
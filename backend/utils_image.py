@@ -1,6 +1,6 @@
 import os
+from uuid import uuid4
 from werkzeug.utils import secure_filename
-from PIL import Image, UnidentifiedImageError
 from flask import current_app
 
 # 許可する拡張子とフォーマット、ファイルサイズ上限
@@ -69,6 +69,8 @@ def validate_image(file):
     file.stream.seek(0)
 
     # 6. Check image content using Pillow (format, dimensions, and integrity)
+    # Pillowは画像を扱うリクエストでしか必要ないので、コールドスタートを軽くするためここで読み込む
+    from PIL import Image, UnidentifiedImageError
     try:
         # Use a single `with` block to open the image once.
         # This also implicitly checks for corruption.
@@ -103,6 +105,21 @@ def validate_image(file):
     return filename
 
 
+def save_image(file) -> str:
+    """
+    Validates an uploaded image and saves it to the UPLOAD_FOLDER under a unique name.
+
+    Returns:
+        str: The stored filename (e.g. 'sneaker_<uuid>.jpg').
+    """
+    safe_basename = validate_image(file)
+    name_part, extension = os.path.splitext(safe_basename)
+    filename = f"{name_part}_{uuid4()}{extension}"
+    save_dir = current_app.config['UPLOAD_FOLDER']
+    save_path = os.path.join(save_dir, filename)
+    file.save(save_path)
+    return filename
+
 
 def remove_old_image(filename: str):
     """
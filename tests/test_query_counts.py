@@ -0,0 +1,152 @@
+"""
+Number of SQL statements per request on the hot read/write paths.
+
+書き込みの経路から余分なSELECT(重複確認、コミット後の読み直し、削除前の読み込み)を取り除いたので、
+その回数が元に戻っていないことを確かめる。リポジトリのルートで実行する:
+
+    python -m unittest discover -s tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+# backend.configはimport時に環境変数を読むので、先に設定しておく
+_TMP = tempfile.mkdtemp()
+os.environ.update({
+    'TEST_DATABASE_URL': f"sqlite:///{os.path.join(_TMP, 'test.db')}",
+    'JWT_SECRET_KEY': 'test-secret-key-for-query-count-tests-0123',
+    'SECRET_KEY': 'test-secret-key',
+    'CACHE_URL': 'null',
+    'LOG_LEVEL': 'ERROR',
+})
+
+from sqlalchemy import event  # noqa: E402
+
+from backend import create_app  # noqa: E402
+from backend.extensions import db  # noqa: E402
+
+
+class QueryCountTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app('testing')
+        cls.app.config.update(UPLOAD_FOLDER=_TMP)
+        with cls.app.app_context():
+            db.create_all()
+        cls.client = cls.app.test_client()
+        response = cls.client.post('/api/users/', json={
+            'username': 'counter', 'email': 'counter@example.com', 'raw_password': 'secret123'})
+        cls.user_id = response.get_json()['id']
+        response = cls.client.post('/api/users/login', json={
+            'email': 'counter@example.com', 'raw_password': 'secret123'})
+        cls.auth = {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.engine.dispose()
+        shutil.rmtree(_TMP, ignore_errors=True)
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def create_sneaker(self) -> str:
+        response = self.client.post('/api/sneakers/', headers=self.auth, data={
+            'name': 'Fixture', 'category': 'running', 'price': '110', 'stock': '5'})
+        self.assertEqual(response.status_code, 201, response.get_data(as_text=True))
+        return response.headers['Location']
+
+    def assertQueryCount(self, statements, expected):
+        self.assertEqual(len(statements), expected, '\n'.join(statements))
+
+    def test_get_user(self):
+        # ブロックリストの確認とユーザーの読み込みだけ。user_lookupとビューのget_or_404はidentity mapを使う
+        with self.count_queries() as statements:
+            response = self.client.get(f'/api/users/{self.user_id}', headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryCount(statements, 2)
+
+    def test_create_user(self):
+        # 重複確認のSELECTは無く、INSERTだけ(重複はユニーク制約違反として扱う)
+        with self.count_queries() as statements:
+            response = self.client.post('/api/users/', json={
+                'username': 'fresh', 'email': 'fresh@example.com', 'raw_password': 'secret123'})
+        self.assertEqual(response.status_code, 201, response.get_data(as_text=True))
+        self.assertQueryCount(statements, 1)
+
+    def test_login_user(self):
+        # メールアドレスでのユーザーの読み込みだけ
+        with self.count_queries() as statements:
+            response = self.client.post('/api/users/login', json={
+                'email': 'counter@example.com', 'raw_password': 'secret123'})
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryCount(statements, 1)
+
+    def test_change_username(self):
+        # 認証(2) + UPDATE。重複確認もコミット後の読み直しも無い
+        with self.count_queries() as statements:
+            response = self.client.patch(f'/api/users/{self.user_id}/username', headers=self.auth,
+                                         json={'username': 'counter3'})
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+        self.assertEqual(response.get_json()['user_data']['username'], 'counter3')
+        self.assertQueryCount(statements, 3)
+
+    def test_create_item(self):
+        # 認証(2) + INSERT(RETURNINGでpriceも読み戻す) + 変更ログのINSERT + 在庫集計のUPSERT。
+        # 類似度インデックスとスナップショットの更新はリクエストの後(backend/background.py)
+        with self.count_queries() as statements:
+            response = self.client.post('/api/sneakers/', headers=self.auth, data={
+                'name': 'Counted', 'description': 'query count', 'category': 'running', 'price': '100', 'stock': '3'})
+        self.assertEqual(response.status_code, 201, response.get_data(as_text=True))
+        # レスポンスはDBに保存された値で作られる
+        self.assertEqual(response.get_json()['price'], '100.00')
+        self.assertQueryCount(statements, 5)
+
+    def test_update_item(self):
+        location = self.create_sneaker()
+        # 認証(2) + 読み込み + UPDATE(RETURNING price) + 変更ログのINSERT + 在庫集計のUPSERT(同じ価格帯なので1行)
+        with self.count_queries() as statements:
+            response = self.client.patch(location, headers=self.auth, data={'price': '120.5', 'stock': '1'})
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+        self.assertEqual(response.get_json()['price'], '120.50')
+        self.assertQueryCount(statements, 6)
+
+    def test_delete_item(self):
+        location = self.create_sneaker()
+        # 認証(2) + DELETE ... RETURNING(削除前の行の読み込みは無い) + 変更ログのINSERT + 在庫集計のUPSERT
+        # + 差分同期のトゥームストーン(古いものの削除、置き換えのDELETEとINSERT)
+        with self.count_queries() as statements:
+            response = self.client.delete(location, headers=self.auth)
+        self.assertEqual(response.status_code, 204)
+        self.assertQueryCount(statements, 8)
+
+    def test_batch(self):
+        # トークンの確認(2)はバッチ全体で1回。get_userはバッチのセッションのidentity mapを使い、change_usernameはUPDATEだけ
+        with self.count_queries() as statements:
+            response = self.client.post('/api/batch', headers=self.auth, json={'requests': [
+                {'id': 'me', 'method': 'GET', 'path': f'/api/users/{self.user_id}'},
+                {'id': 'username', 'method': 'PATCH', 'path': f'/api/users/{self.user_id}/username',
+                 'body': {'username': 'counter2'}},
+            ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.get_json()['responses']], [200, 200])
+        self.assertQueryCount(statements, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
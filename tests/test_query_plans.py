@@ -0,0 +1,42 @@
+"""
+Query plans of the hot SQL paths against the recorded fixtures.
+
+`flask sql-plans check` と同じ比較をテストとして実行し、フィクスチャ(query_plans/)に無い全件走査や
+一時B-treeによるソートが現れたら失敗させる。プランを意図して変えた場合は `flask sql-plans record` で
+フィクスチャを書き直す。リポジトリのルートで実行する:
+
+    python -m unittest discover -s tests
+"""
+import os
+import unittest
+
+# backend.configはimport時に環境変数を読むので、先に設定しておく(他のテストが設定済みならそちらを使う)
+for _name, _value in {
+    'JWT_SECRET_KEY': 'test-secret-key-for-query-plan-tests-01234',
+    'SECRET_KEY': 'test-secret-key',
+    'CACHE_URL': 'null',
+    'LOG_LEVEL': 'ERROR',
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from backend import query_plans  # noqa: E402
+from backend.config import BaseConfig  # noqa: E402
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # マイグレーションの適用とデータの投入は重いので、全シナリオを1回でまとめて記録する
+        cls.actual = query_plans.capture_plans()
+
+    def test_every_scenario_matches_its_fixture(self):
+        for name in query_plans.SCENARIOS:
+            with self.subTest(scenario=name):
+                expected = query_plans.load_fixture(BaseConfig.QUERY_PLAN_FIXTURES_DIR, name)
+                failures, _ = query_plans.compare(expected, self.actual[name])
+                self.assertEqual(failures, [], '\n'.join(failures))
+
+
+if __name__ == '__main__':
+    unittest.main()